@@ -0,0 +1,132 @@
+import os
+import uuid
+from threading import Lock
+
+# bytes of a build log kept on disk; once exceeded the oldest half is dropped
+default_max_bytes = 4 * 1024 * 1024
+
+# characters of the server's log remembered to tell when a new build has replaced it
+head_size = 256
+
+
+class BuildLog:
+    """On-disk copy of a build log, read from byte offsets so clients only fetch what is new
+
+    The compilation server always returns the whole log; update() appends
+    whatever was added since the last call. A shorter log, or one that starts
+    differently, belongs to a new build and starts a new log with a new id.
+    Offsets are absolute, so they stay valid when the start is dropped.
+    """
+
+    def __init__(self, path, max_bytes=default_max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._reset()
+
+    def _reset(self):
+        self.log_id = uuid.uuid4().hex[:12]
+        self.start = 0  # offset of the first byte still in the file
+        self.end = 0
+        self.server_length = 0  # characters of the server's log seen so far
+        self.head = ''
+        open(self.path, 'wb').close()
+
+    def _append(self, text):
+        data = text.encode('utf-8')
+        with open(self.path, 'ab') as f:
+            f.write(data)
+        self.end += len(data)
+
+        if self.end - self.start > self.max_bytes:
+            with open(self.path, 'rb') as f:
+                f.seek(-(self.max_bytes // 2), os.SEEK_END)
+                kept = f.read()
+            kept = kept[kept.find(b'\n') + 1:]  # start on a whole line
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(kept)
+            os.replace(self.path + '.tmp', self.path)
+            self.start = self.end - len(kept)
+
+    def update(self, logs):
+        """Take in the full log as the server currently reports it"""
+        with self.lock:
+            if len(logs) < self.server_length or logs[:len(self.head)] != self.head:
+                self._reset()
+            if len(logs) > self.server_length:
+                self._append(logs[self.server_length:])
+                self.server_length = len(logs)
+            if len(self.head) < head_size:
+                self.head = logs[:head_size]
+
+    def note(self, text):
+        """Add a line of the daemon's own to the log"""
+        with self.lock:
+            self._append(text)
+
+    def read(self, offset, log_id=None):
+        """Log text from an offset onwards, as the fields of a build status
+
+        log_reset is set when the client's offset belongs to a different log,
+        in which case the whole log is returned.
+        """
+        with self.lock:
+            reset = (log_id is not None and log_id != self.log_id) or offset > self.end
+            offset = self.start if reset else max(offset, self.start)
+            with open(self.path, 'rb') as f:
+                f.seek(offset - self.start)
+                text = f.read(self.end - offset).decode('utf-8', 'replace')
+            return {'logs': text, 'log_offset': self.end, 'log_id': self.log_id, 'log_reset': reset}
+
+
+# *****************************************
+# Unit tests
+# *****************************************
+
+import unittest
+
+
+class TestBuildLog(unittest.TestCase):
+
+    path = '/tmp/_build_log_test/log'
+
+    def test_incremental(self):
+        log = BuildLog(self.path)
+        log.update("Synthesis\n")
+        first = log.read(0)
+        self.assertEqual(first['logs'], "Synthesis\n")
+        log.update("Synthesis\nPlace\n")
+        log.note("Copying\n")
+        self.assertEqual(log.read(first['log_offset'], first['log_id']),
+                         {'logs': "Place\nCopying\n", 'log_offset': 24, 'log_id': first['log_id'], 'log_reset': False})
+
+        # the server's log carries on after the daemon's own line
+        log.update("Synthesis\nPlace\nRoute\n")
+        self.assertEqual(log.read(16)['logs'], "Copying\nRoute\n")
+
+    def test_new_build(self):
+        log = BuildLog(self.path)
+        log.update("Synthesis\nPlace\nRoute\n")
+        old = log.read(0)
+        log.update("Starting\n")
+        result = log.read(old['log_offset'], old['log_id'])
+        self.assertTrue(result['log_reset'])
+        self.assertEqual(result['logs'], "Starting\n")
+        self.assertNotEqual(result['log_id'], old['log_id'])
+
+    def test_bounded(self):
+        log = BuildLog(self.path, max_bytes=1000)
+        text = ""
+        for i in range(100):
+            text += "line %d\n" % i
+            log.update(text)
+        self.assertLessEqual(os.path.getsize(self.path), 1000)
+        self.assertEqual(log.end, len(text))
+        # offsets stay absolute, and an offset that has been dropped gets what is left
+        self.assertEqual(log.read(len(text) - 8)['logs'], "line 99\n")
+        self.assertTrue(text.endswith(log.read(0)['logs']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,101 +2,316 @@ import uuid
 import hashlib
 import json
 import os
-from threading import Thread
-from urllib.request import Request, urlopen, urlretrieve
+import shutil
+from time import time
+from threading import Thread, Lock, Condition
+from concurrent.futures import ThreadPoolExecutor
+
+import transfer
+import upstream
+import build_log
+import metrics
 
 base = '/home/xilinx/projects'
 compilation_server = 'http://sygnaller.silvestri.io:9000'
 
-downloading_files_thread = None
+# seconds to wait for the compilation server's answer to a call / an overlay download
+server_timeout = 8
+download_timeout = 60
+
+server_client = None
+server_client_lock = Lock()
+
+# seconds between build progress fetches while a build runs / otherwise, and how long
+# a project's poller keeps going after the last client asked for its progress
+poll_interval_building = 1
+poll_interval_idle = 10
+poller_idle_timeout = 60
+
+pollers = {}  # project name -> ProgressPoller
+
+# on-disk copies of build logs, one per project id
+build_logs_dir = os.path.join(base, '.build-logs')
+pollers_lock = Lock()
+
+# build artifacts: compilation server path, and where they go in the project
+overlay_artifacts = [
+    ('/download_overlay_bit', 'overlay.bit'),
+    ('/download_overlay_tcl', 'overlay.tcl'),
+    ('/download_python_api', 'software/sygnaller/hw.py')
+]
+overlay_lock = Lock()  # held while the artifacts are replaced, so they are only ever seen as a set
+
+# project name -> OverlayDownload, running or recently failed
+downloads = {}
+downloads_lock = Lock()
+download_retry_delay = 10  # seconds before a failed download is tried again
+
+# built overlays by hash of their sources and components, least recently used dropped beyond the budget
+overlay_cache_dir = os.path.join(base, '.overlay-cache')
+overlay_cache_budget = 512 * 1024 * 1024
+overlay_cache_lock = Lock()
+
+# project id -> {'files': {path: sha256}, 'manifest': sha256} of the sources the server last accepted
+sent_sources = {}
+sent_sources_lock = Lock()
 
 
 def _project_id(project_name):
     return "%012X_%s" % (uuid.getnode(), hashlib.md5(project_name.encode('utf-8')).hexdigest())
 
 
+def _server():
+    """Shared keep-alive client for the compilation server, replaced if compilation_server changes"""
+    global server_client
+    with server_client_lock:
+        if server_client is None or server_client.base_url != compilation_server:
+            if server_client is not None:
+                server_client.close()
+            server_client = upstream.UpstreamClient(compilation_server, timeout=server_timeout,
+                                                    stats=metrics.upstream)
+        return server_client
+
+
 def clear_cache(data):
     project_name = data['project']
     project_id = _project_id(project_name)
 
-    url = compilation_server + '/clear_cache'
     data = {'project_id': project_id}
 
-    request = Request(url, json.dumps(data).encode('utf-8'))
-    response = urlopen(request, timeout=8).read().decode()
+    # the server forgets the sources too, so the next build sends them all
+    with sent_sources_lock:
+        sent_sources.pop(project_id, None)
 
-    return json.loads(response)
+    return _server().post_json('/clear_cache', data, idempotent=True)
 
 
-def run_build(data):
-    project_name = data['project']
-    project_id = _project_id(project_name)
+def _manifest_hash(hashes):
+    """Hash of a whole source tree, computed the same way by the compilation server"""
+    h = hashlib.sha256()
+    for path in sorted(hashes):
+        h.update(('%s\0%s\n' % (path, hashes[path])).encode('utf-8'))
+    return h.hexdigest()
 
-    # collect all source files
-    sources = {}
-    proj_dir = os.path.join(base, data['project'])
-    hw_dir = os.path.join(proj_dir, 'hardware')
+
+def _hardware_sources(project_name):
+    """sha256 of every Verilog file in a project's hardware directory, keyed by relative path"""
+    hw_dir = os.path.join(base, project_name, 'hardware')
+    hashes = {}
     for r, d, f in os.walk(hw_dir):
         for file in f:
             if file.lower().endswith('.v'):
                 fname = os.path.join(r, file)
                 try:
-                    with open(fname) as fp:
-                        sources[os.path.relpath(fname, hw_dir)] = fp.read()
+                    hashes[os.path.relpath(fname, hw_dir)] = transfer.file_hash(fname)
                 except OSError:
                     pass
+    return hw_dir, hashes
 
-    if len(sources) == 0:
-        raise RuntimeError("Empty")
 
-    # prepare request
-    data = {
-        "project_id": project_id,
-        "sources": sources,
-        "components": data['components']
-    }
+def _read_sources(hw_dir, paths, hashes):
+    """Contents of some of the sources, updating their hashes to match what is actually sent"""
+    sources = {}
+    for path in paths:
+        try:
+            with open(os.path.join(hw_dir, path), 'rb') as fp:
+                sources[path] = fp.read().decode('utf-8', 'replace')
+        except OSError:
+            del hashes[path]
+            continue
+        hashes[path] = hashlib.sha256(sources[path].encode('utf-8')).hexdigest()
+    return sources
 
-    # relay it to compilation server
-    url = compilation_server + '/compile'
-    request = Request(url, json.dumps(data).encode('utf-8'))
-    response = urlopen(request, timeout=8).read().decode()
 
-    return json.loads(response)
+def _send_build(data):
+    # starting a build is not idempotent, so it is never retried
+    return _server().post_json('/compile', data)
+
+
+def run_build(data):
+    """Relay a build to the compilation server, sending only the sources that changed since the last one
+
+    Incremental requests carry the manifest hash the server should already
+    have (base_manifest) and the one it should end up with; if either does not
+    match, the server answers with a 'Manifest mismatch' error. On that or any
+    other error from an incremental request (e.g. a server too old to know
+    manifests), every source is sent again. Each build carries its overlay cache key
+    (build_key), which the server reports back with the build it completed.
+    """
+    project_name = data['project']
+    project_id = _project_id(project_name)
+    components = data['components']
+
+    hw_dir, hashes = _hardware_sources(project_name)
+    if len(hashes) == 0:
+        raise RuntimeError("Empty")
+
+    # the same design has been built before
+    key = _overlay_key(hashes, components)
+    if data.get('rebuild'):
+        _drop_cached_overlay(key)
+    elif _install_cached_overlay(project_name, key):
+        return {'cached': True}
+
+    with sent_sources_lock:
+        sent = sent_sources.get(project_id)
+
+    response = None
+    if sent is not None:
+        changed = _read_sources(hw_dir, [path for path in hashes if sent['files'].get(path) != hashes[path]], hashes)
+        try:
+            response = _send_build({
+                "project_id": project_id,
+                "base_manifest": sent['manifest'],
+                "changed": changed,
+                "deleted": sorted(set(sent['files']) - set(hashes)),
+                "manifest": _manifest_hash(hashes),
+                "components": components,
+                "build_key": key
+            })
+        except upstream.UpstreamError:
+            # the server answered, so nothing was started
+            response = None
+
+    if response is None or 'error' in response:
+        response = _send_build({
+            "project_id": project_id,
+            "sources": _read_sources(hw_dir, list(hashes), hashes),
+            "manifest": _manifest_hash(hashes),
+            "components": components,
+            "build_key": key
+        })
+
+    with sent_sources_lock:
+        if 'error' in response:
+            sent_sources.pop(project_id, None)
+        else:
+            sent_sources[project_id] = {'files': hashes, 'manifest': _manifest_hash(hashes)}
+
+    _refresh_progress(project_name)
+    return response
 
 
 def stop_build(data):
     project_name = data['project']
     project_id = _project_id(project_name)
 
-    url = compilation_server + '/cancel_build'
     data = {"project_id": project_id}
 
-    request = Request(url, json.dumps(data).encode('utf-8'))
-    response = urlopen(request, timeout=8).read().decode()
-
-    return json.loads(response)
+    response = _server().post_json('/cancel_build', data, idempotent=True)
+    _refresh_progress(project_name)
+    return response
+
+
+class ProgressPoller:
+    """Fetches one project's build progress in the background, so client polls never wait on the server
+
+    However many clients poll, there is only ever one request to the server
+    in flight for the project. The poller fetches every
+    poll_interval_building seconds while a build runs and every
+    poll_interval_idle seconds otherwise, and stops once nobody has asked
+    for poller_idle_timeout seconds.
+    """
+
+    def __init__(self, project_name):
+        self.project_name = project_name
+        self.project_id = _project_id(project_name)
+        self.status = None  # last status fetched
+        self.log = build_log.BuildLog(os.path.join(build_logs_dir, self.project_id))
+        self.error = None  # exception from the last fetch, if it failed
+        self.last_request = time()
+        self.poke = False
+        self.condition = Condition()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _fetch(self):
+        try:
+            status = _server().post_json('/build_progress', {'project_id': self.project_id}, idempotent=True)
+            self.log.update(status.get('logs', ''))
+            error = None
+        except Exception as e:
+            status, error = None, e
+        with self.condition:
+            if error is None:
+                self.status = status
+            self.error = error
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            self._fetch()
+            with self.condition:
+                building = self.status is not None and self.status.get('running') or _downloading(self.project_name)
+                self.condition.wait_for(lambda: self.poke, poll_interval_building if building else poll_interval_idle)
+                self.poke = False
+                if time() - self.last_request > poller_idle_timeout:
+                    break
+        with pollers_lock:
+            if pollers.get(self.project_name) is self:
+                del pollers[self.project_name]
+
+    def refresh(self):
+        """Fetch again now rather than at the next interval, e.g. after a build was started"""
+        with self.condition:
+            self.poke = True
+            self.condition.notify_all()
+
+    def get(self):
+        """Latest status, waiting for the first fetch if there has not been one yet"""
+        with self.condition:
+            self.last_request = time()
+            self.condition.wait_for(lambda: self.status is not None or self.error is not None, server_timeout * 2)
+            if self.error is not None:
+                raise self.error
+            if self.status is None:
+                raise upstream.UpstreamUnavailable("No build progress from the compilation server")
+            return dict(self.status)
+
+    def alive(self):
+        return self.thread.is_alive() and time() - self.last_request <= poller_idle_timeout
+
+
+def _poller(project_name):
+    with pollers_lock:
+        poller = pollers.get(project_name)
+        if poller is None or not poller.alive():
+            poller = pollers[project_name] = ProgressPoller(project_name)
+        return poller
+
+
+def _refresh_progress(project_name):
+    with pollers_lock:
+        poller = pollers.get(project_name)
+    if poller is not None:
+        poller.refresh()
 
 
 def get_build_status(data):
-    global downloading_files_thread
+    """Build progress of a project
 
+    With a log_offset (and the log_id it came with) only the part of the log
+    after the offset is returned, along with the offset to ask from next time.
+    """
     project_name = data['project']
-    project_id = _project_id(project_name)
 
-    url = compilation_server + '/build_progress'
-    data = {'project_id': project_id}
-
-    request = Request(url, json.dumps(data).encode('utf-8'))
-    response = urlopen(request, timeout=8).read().decode()
+    poller = _poller(project_name)
+    status = poller.get()
+    incremental = data.get('log_offset') is not None
+    if incremental:
+        status.update(poller.log.read(int(data['log_offset']), data.get('log_id')))
 
     # update overlay files if there are newer ones on the server
-    status = json.loads(response)
     if status['last_completed'] > local_last_modified_overlay(project_name) and not status['running']:
         status['running'] = True
         status['downloading'] = True
-        if downloading_files_thread is None:
-            status['logs'] += "Copying bit files back to Pynq board\n"
-            downloading_files_thread = Thread(target=download_overlay_files, args=(project_name,), daemon=True).start()
+        download, started = _start_download(project_name, status['last_completed'], status.get('build_key'))
+        if started:
+            if incremental:
+                poller.log.note("Copying bit files back to Pynq board\n")
+            else:
+                status['logs'] += "Copying bit files back to Pynq board\n"
+        status['download'] = download.describe()
 
     return status
 
@@ -105,28 +320,223 @@ def local_last_modified_overlay(project_name):
     overlay_dir = os.path.join(base, project_name)
     bitfile = os.path.join(overlay_dir, 'overlay.bit')
     tclfile = os.path.join(overlay_dir, 'overlay.tcl')
-    if os.path.exists(bitfile) and os.path.exists(tclfile):
-        return min(os.path.getmtime(bitfile), os.path.getmtime(tclfile))
-    else:
-        return 0
+    with overlay_lock:
+        if os.path.exists(bitfile) and os.path.exists(tclfile):
+            return min(os.path.getmtime(bitfile), os.path.getmtime(tclfile))
+        else:
+            return 0
 
 
-def download_overlay_files(project_name):
-    try:
-        overlay_dir = os.path.join(base, project_name)
-        api_dir = os.path.join(base, project_name, 'software/sygnaller')
+def _install_overlay(project_name, staged_files):
+    """Move a complete set of (staged file, artifact name) into the project, all with the same mtime
 
-        project_id = _project_id(project_name)
-        data = json.dumps({'project_id': project_id}).encode('utf-8')
+    Artifacts under software/ (the Python API) go in through a new software
+    snapshot, so an upload at the same time cannot put back the old copy and
+    a rollback takes the API back along with the code that used it.
+    """
+    project_dir = os.path.join(base, project_name)
+    with transfer._staged(project_dir, 'software') as stage, overlay_lock:
+        now = time()
+        for staged, name in staged_files:
+            target = stage(os.path.join(project_dir, name))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            transfer.fix_owner_and_permissions(staged)
+            os.utime(staged, (now, now))
+            os.replace(staged, target)
 
-        urlretrieve(compilation_server + '/download_overlay_bit', os.path.join(overlay_dir, 'overlay.bit'), data=data)
-        urlretrieve(compilation_server + '/download_overlay_tcl', os.path.join(overlay_dir, 'overlay.tcl'), data=data)
-        urlretrieve(compilation_server + '/download_python_api', os.path.join(api_dir, 'hw.py'), data=data)
-    except Exception as e:
-        print("Overlay download failed:", e.__name__)
 
-    global downloading_files_thread
-    downloading_files_thread = None
+def _overlay_key(hashes, components):
+    return hashlib.sha256((_manifest_hash(hashes) + json.dumps(components, sort_keys=True)).encode('utf-8')).hexdigest()
+
+
+def _link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def _cache_overlay(project_name, key):
+    """Keep a newly installed overlay in the cache under the key the server says it was built for
+
+    The cache entries are hard links to the installed files, which are only
+    ever replaced, never rewritten, so caching costs no extra space until the
+    project moves on to another overlay.
+    """
+    if not isinstance(key, str) or not key.isalnum():
+        return  # the server did not say which sources it was built from
+
+    project_dir = os.path.join(base, project_name)
+    entry = os.path.join(overlay_cache_dir, key)
+    with overlay_cache_lock:
+        if os.path.isdir(entry):
+            return
+        os.makedirs(entry + '.tmp', exist_ok=True)
+        try:
+            for _, name in overlay_artifacts:
+                _link_or_copy(os.path.join(project_dir, name), os.path.join(entry + '.tmp', os.path.basename(name)))
+        except OSError as e:
+            shutil.rmtree(entry + '.tmp', True)
+            print("Could not cache overlay:", type(e).__name__, e)
+            return
+        os.rename(entry + '.tmp', entry)
+        _evict_overlays(keep=key)
+
+
+def _evict_overlays(keep):
+    """Drop the least recently used cache entries until the cache fits its budget"""
+    entries = []
+    for key in os.listdir(overlay_cache_dir):
+        path = os.path.join(overlay_cache_dir, key)
+        size = sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+        entries.append((os.path.getmtime(path), size, key))
+    entries.sort()
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in entries:
+        if total <= overlay_cache_budget:
+            break
+        if key != keep:
+            shutil.rmtree(os.path.join(overlay_cache_dir, key), True)
+            total -= size
+
+
+def _drop_cached_overlay(key):
+    with overlay_cache_lock:
+        shutil.rmtree(os.path.join(overlay_cache_dir, key), True)
+
+
+def _install_cached_overlay(project_name, key):
+    """Install the overlay cached for a cache key, if there is one; returns whether it did"""
+    entry = os.path.join(overlay_cache_dir, key)
+    with overlay_cache_lock:
+        if not os.path.isdir(entry):
+            return False
+        os.utime(entry)  # most recently used
+
+        staging_dir = os.path.join(base, project_name, '.overlay-cached')
+        shutil.rmtree(staging_dir, True)
+        try:
+            os.makedirs(staging_dir)
+            staged_files = []
+            for _, name in overlay_artifacts:
+                staged = os.path.join(staging_dir, os.path.basename(name))
+                _link_or_copy(os.path.join(entry, os.path.basename(name)), staged)
+                staged_files.append((staged, name))
+            _install_overlay(project_name, staged_files)
+        except OSError:
+            return False
+        finally:
+            shutil.rmtree(staging_dir, True)
+    return True
+
+
+class OverlayDownload:
+    """Fetches a build's artifacts in parallel, then installs them all at once
+
+    Files are downloaded into the project's .overlay-download directory. If a
+    download is interrupted, the next one for the same build carries on from
+    what is already there. Artifacts the server sends an X-Content-SHA256
+    header with are checked against it.
+    """
+
+    def __init__(self, project_name, build_time, build_key=None):
+        self.project_name = project_name
+        self.build_time = build_time
+        self.build_key = build_key
+        self.staging_dir = os.path.join(base, project_name, '.overlay-download')
+        self.progress = {path: (0, None) for path, _ in overlay_artifacts}
+        self.error = None
+        self.finished = None  # time it ended
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def describe(self):
+        progress = list(self.progress.values())
+        return {
+            'bytes': sum(done for done, total in progress),
+            'total': sum(total for done, total in progress) if all(total is not None for done, total in progress)
+            else None,
+            'error': self.error
+        }
+
+    def _prepare_staging(self):
+        """Keep what an earlier attempt left only if it was for the same build"""
+        marker = os.path.join(self.staging_dir, 'build')
+        try:
+            with open(marker) as f:
+                same_build = float(f.read()) == self.build_time
+        except (OSError, ValueError):
+            same_build = False
+        if not same_build:
+            shutil.rmtree(self.staging_dir, True)
+            os.makedirs(self.staging_dir)
+            with open(marker, 'w') as f:
+                f.write(repr(self.build_time))
+
+    def _fetch(self, path, staged):
+        if os.path.exists(staged):
+            return  # completed by an earlier attempt
+
+        def progress(done, total):
+            self.progress[path] = (done, total)
+
+        data = json.dumps({'project_id': _project_id(self.project_name)}).encode('utf-8')
+        headers = _server().download(path, data, staged + '.part', progress, timeout=download_timeout)
+
+        checksum = headers.get('X-Content-SHA256')
+        if checksum is not None:
+            h = hashlib.sha256()
+            with open(staged + '.part', 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    h.update(chunk)
+            if h.hexdigest() != checksum.lower():
+                os.remove(staged + '.part')
+                raise ValueError("Checksum mismatch for " + path)
+        os.replace(staged + '.part', staged)
+
+    def _run(self):
+        try:
+            self._prepare_staging()
+            staged_files = [(os.path.join(self.staging_dir, os.path.basename(name)), name)
+                            for _, name in overlay_artifacts]
+            with ThreadPoolExecutor(len(overlay_artifacts)) as pool:
+                fetches = [pool.submit(self._fetch, path, staged)
+                           for (path, _), (staged, _) in zip(overlay_artifacts, staged_files)]
+                for fetch in fetches:
+                    fetch.result()
+            _install_overlay(self.project_name, staged_files)
+            shutil.rmtree(self.staging_dir, True)
+            _cache_overlay(self.project_name, self.build_key)
+        except Exception as e:
+            print("Overlay download failed:", type(e).__name__, e)
+            self.error = '%s: %s' % (type(e).__name__, e)
+
+        self.finished = time()
+
+
+def _downloading(project_name):
+    download = downloads.get(project_name)
+    return download is not None and download.finished is None
+
+
+def _start_download(project_name, build_time, build_key=None):
+    """The project's overlay download, started unless one is running; and whether it was just started
+
+    A build that has already been installed is not downloaded again, and a
+    failed download is only retried after download_retry_delay seconds.
+    """
+    with downloads_lock:
+        download = downloads.get(project_name)
+        if download is not None:
+            if download.finished is None:
+                return download, False
+            if download.error is None and download.build_time >= build_time:
+                return download, False
+            if download.error is not None and time() - download.finished < download_retry_delay:
+                return download, False
+        download = downloads[project_name] = OverlayDownload(project_name, build_time, build_key)
+        return download, True
 
 
 # *****************************************
@@ -134,6 +544,8 @@ def download_overlay_files(project_name):
 # *****************************************
 
 import unittest
+import http.server
+from time import sleep
 
 
 class TestCompiler(unittest.TestCase):
@@ -151,5 +563,386 @@ class TestCompiler(unittest.TestCase):
         self.assertEqual(result, 0)
 
 
+class StandInCompiler(http.server.BaseHTTPRequestHandler):
+    """Just enough of the compilation server to check what the daemon sends it"""
+
+    projects = {}  # project id -> {path: source}
+    received = []  # (path, request body size)
+    progress = {'running': False, 'last_completed': 0, 'logs': ''}
+    progress_delay = 0
+    build_key = None  # of the last build asked for
+    legacy = None  # how an older server rejects incremental requests: 'error' or 'status'
+    artifacts = {}  # download path -> contents
+    checksums = {}  # download path -> checksum to claim instead of the real one
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['content-length']))
+        self.received.append((self.path, len(body)))
+        request = json.loads(body)
+        response = {}
+
+        if self.path == '/compile':
+            project_id = request['project_id']
+            if 'sources' in request:
+                sources = dict(request['sources'])
+            elif self.legacy == 'status':
+                self.send_response(400)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            elif self.legacy == 'error':
+                sources = None
+                response = {'error': 'Missing sources'}
+            else:
+                sources = dict(self.projects.get(project_id, {}))
+                if self._manifest(sources) != request['base_manifest']:
+                    sources = None
+                else:
+                    sources.update(request['changed'])
+                    for path in request['deleted']:
+                        del sources[path]
+            if response:
+                pass
+            elif sources is None or self._manifest(sources) != request['manifest']:
+                response = {'error': 'Manifest mismatch'}
+            else:
+                self.projects[project_id] = sources
+                StandInCompiler.build_key = request.get('build_key')
+                response = {'building': True}
+        elif self.path == '/clear_cache':
+            self.projects.pop(request['project_id'], None)
+        elif self.path == '/build_progress':
+            sleep(self.progress_delay)
+            response = dict(self.progress)
+        elif self.path in self.artifacts:
+            contents = self.artifacts[self.path]
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(contents)))
+            self.send_header('X-Content-SHA256', self.checksums.get(self.path, hashlib.sha256(contents).hexdigest()))
+            self.end_headers()
+            sleep(0.1)
+            self.wfile.write(contents)
+            return
+
+        payload = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    @staticmethod
+    def _manifest(sources):
+        return _manifest_hash({path: hashlib.sha256(source.encode('utf-8')).hexdigest()
+                               for path, source in sources.items()})
+
+    def log_message(self, *args):
+        pass
+
+
+class TestBuildRelay(unittest.TestCase):
+
+    hw_dir = '/home/xilinx/projects/_test_dummy/hardware'
+
+    def setUp(self):
+        global compilation_server
+        import shutil
+        shutil.rmtree('/home/xilinx/projects/_test_dummy', True)
+        os.makedirs(self.hw_dir)
+        sent_sources.clear()
+        pollers.clear()
+        StandInCompiler.projects.clear()
+        StandInCompiler.received.clear()
+        StandInCompiler.progress = {'running': False, 'last_completed': 0, 'logs': ''}
+        StandInCompiler.progress_delay = 0
+        StandInCompiler.artifacts = {
+            '/download_overlay_bit': os.urandom(200000),
+            '/download_overlay_tcl': b'# tcl\n',
+            '/download_python_api': b'# hw\n'
+        }
+        StandInCompiler.checksums = {}
+        downloads.clear()
+        StandInCompiler.build_key = None
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInCompiler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.original_server = compilation_server
+        compilation_server = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        global compilation_server
+        compilation_server = self.original_server
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _write(self, path, source):
+        with open(os.path.join(self.hw_dir, path), 'w') as f:
+            f.write(source)
+
+    def _server_sources(self):
+        return StandInCompiler.projects[_project_id('_test_dummy')]
+
+    def test_incremental(self):
+        self._write('top.v', 'module top(); endmodule\n')
+        self._write('sub.v', 'module sub(); endmodule\n')
+        self.assertEqual(run_build({'project': '_test_dummy', 'components': []}), {'building': True})
+
+        self._write('top.v', 'module top(); sub s(); endmodule\n')
+        os.remove(os.path.join(self.hw_dir, 'sub.v'))
+        self._write('new.v', 'module new(); endmodule\n')
+        StandInCompiler.received.clear()
+        self.assertEqual(run_build({'project': '_test_dummy', 'components': []}), {'building': True})
+        self.assertEqual(len(StandInCompiler.received), 1)
+        self.assertEqual(self._server_sources(), {
+            'top.v': 'module top(); sub s(); endmodule\n',
+            'new.v': 'module new(); endmodule\n'
+        })
+
+    def test_mismatch_falls_back(self):
+        self._write('top.v', 'module top(); endmodule\n')
+        run_build({'project': '_test_dummy', 'components': []})
+
+        # e.g. the server was restarted and lost the sources
+        StandInCompiler.projects.clear()
+        self._write('top.v', 'module top(); wire a; endmodule\n')
+        StandInCompiler.received.clear()
+        self.assertEqual(run_build({'project': '_test_dummy', 'components': []}), {'building': True})
+        self.assertEqual(len(StandInCompiler.received), 2)
+        self.assertEqual(self._server_sources(), {'top.v': 'module top(); wire a; endmodule\n'})
+
+    def test_incremental_error_falls_back(self):
+        for legacy in ('error', 'status'):
+            with self.subTest(legacy=legacy):
+                self._write('top.v', 'module top(); endmodule\n')
+                run_build({'project': '_test_dummy', 'components': []})
+
+                # a server that only knows full sends
+                StandInCompiler.legacy = legacy
+                self._write('top.v', 'module top(); wire %s; endmodule\n' % legacy)
+                StandInCompiler.received.clear()
+                try:
+                    self.assertEqual(run_build({'project': '_test_dummy', 'components': []}), {'building': True})
+                finally:
+                    StandInCompiler.legacy = None
+                self.assertEqual(len(StandInCompiler.received), 2)
+                self.assertEqual(self._server_sources(), {'top.v': 'module top(); wire %s; endmodule\n' % legacy})
+
+    def _progress_requests(self):
+        return sum(path == '/build_progress' for path, _ in StandInCompiler.received)
+
+    def test_progress_coalesced(self):
+        StandInCompiler.progress_delay = 0.3
+        results = []
+        threads = [Thread(target=lambda: results.append(get_build_status({'project': '_test_dummy'})))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 20)
+        self.assertEqual(self._progress_requests(), 1)
+
+        # answered from the cached status until the next poll
+        started = time()
+        get_build_status({'project': '_test_dummy'})
+        self.assertLess(time() - started, 0.1)
+        self.assertEqual(self._progress_requests(), 1)
+
+    def test_progress_refreshed(self):
+        global poll_interval_building
+        original_interval = poll_interval_building
+        poll_interval_building = 0.1
+        try:
+            self._write('top.v', 'module top(); endmodule\n')
+            self.assertFalse(get_build_status({'project': '_test_dummy'})['running'])
+
+            # starting a build fetches again straight away, then polls at the faster rate
+            StandInCompiler.progress = {'running': True, 'last_completed': 0, 'logs': 'Synthesis\n'}
+            run_build({'project': '_test_dummy', 'components': []})
+            sleep(0.05)
+            self.assertTrue(get_build_status({'project': '_test_dummy'})['running'])
+            before = self._progress_requests()
+            sleep(0.55)
+            self.assertGreaterEqual(self._progress_requests() - before, 3)
+        finally:
+            poll_interval_building = original_interval
+
+    def test_progress_log_offset(self):
+        StandInCompiler.progress = {'running': True, 'last_completed': 0, 'logs': 'Synthesis\n' * 1000}
+        status = get_build_status({'project': '_test_dummy', 'log_offset': 0})
+        self.assertEqual(len(status['logs']), 10000)
+
+        StandInCompiler.progress = {'running': True, 'last_completed': 0, 'logs': 'Synthesis\n' * 1000 + 'Place\n'}
+        _refresh_progress('_test_dummy')
+        sleep(0.1)
+        status = get_build_status({'project': '_test_dummy', 'log_offset': status['log_offset'],
+                                   'log_id': status['log_id']})
+        self.assertEqual(status['logs'], 'Place\n')
+        self.assertFalse(status['log_reset'])
+
+        # without an offset the whole log is returned, as before
+        self.assertEqual(len(get_build_status({'project': '_test_dummy'})['logs']), 10006)
+
+    def _downloaded(self, path):
+        with open(os.path.join('/home/xilinx/projects/_test_dummy', path), 'rb') as f:
+            return f.read()
+
+    def test_overlay_download(self):
+        transfer.upload_files({'project': '_test_dummy', 'directory': 'software', 'files': [
+            {'path': 'software/main.py', 'contents': ''}
+        ]})
+        StandInCompiler.progress = {'running': False, 'last_completed': time(), 'logs': 'Done\n'}
+        statuses = []
+        threads = [Thread(target=lambda: statuses.append(get_build_status({'project': '_test_dummy'})))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(status['downloading'] for status in statuses))
+        self.assertEqual(sum('Copying bit files' in status['logs'] for status in statuses), 1)
+
+        downloads['_test_dummy'].thread.join(10)
+        self.assertIsNone(downloads['_test_dummy'].error)
+        self.assertEqual(sum(path == '/download_overlay_bit' for path, _ in StandInCompiler.received), 1)
+        self.assertEqual(self._downloaded('overlay.bit'), StandInCompiler.artifacts['/download_overlay_bit'])
+        self.assertEqual(self._downloaded('software/sygnaller/hw.py'), b'# hw\n')
+        self.assertEqual(os.path.getmtime('/home/xilinx/projects/_test_dummy/overlay.bit'),
+                         os.path.getmtime('/home/xilinx/projects/_test_dummy/overlay.tcl'))
+        self.assertFalse(os.path.exists('/home/xilinx/projects/_test_dummy/.overlay-download'))
+
+        # the API went in as a new software snapshot, which a rollback takes back out
+        self.assertTrue(os.path.islink('/home/xilinx/projects/_test_dummy/software'))
+        transfer.rollback_project({'project': '_test_dummy', 'directory': 'software'})
+        self.assertFalse(os.path.exists('/home/xilinx/projects/_test_dummy/software/sygnaller/hw.py'))
+
+        status = get_build_status({'project': '_test_dummy'})
+        self.assertNotIn('downloading', status)
+
+    def test_overlay_checksum_mismatch(self):
+        StandInCompiler.progress = {'running': False, 'last_completed': time(), 'logs': ''}
+        StandInCompiler.checksums = {'/download_overlay_tcl': '0' * 64}
+        get_build_status({'project': '_test_dummy'})
+        downloads['_test_dummy'].thread.join(10)
+
+        status = get_build_status({'project': '_test_dummy'})
+        self.assertIn('Checksum mismatch', status['download']['error'])
+        # nothing is installed unless all of it checks out
+        self.assertFalse(os.path.exists('/home/xilinx/projects/_test_dummy/overlay.bit'))
+        self.assertEqual(local_last_modified_overlay('_test_dummy'), 0)
+
+    def _wait_for_download(self, build_time, build_key=None):
+        StandInCompiler.progress = {'running': False, 'last_completed': build_time, 'logs': '',
+                                    'build_key': build_key or StandInCompiler.build_key}
+        _refresh_progress('_test_dummy')
+        sleep(0.1)
+        get_build_status({'project': '_test_dummy'})
+        downloads['_test_dummy'].thread.join(10)
+
+    def test_overlay_cache(self):
+        import shutil
+        shutil.rmtree(overlay_cache_dir, True)
+        first = dict(StandInCompiler.artifacts)
+
+        self._write('top.v', 'module top(); endmodule\n')
+        run_build({'project': '_test_dummy', 'components': ['gpio']})
+        self._wait_for_download(time())
+        self.assertEqual(len(os.listdir(overlay_cache_dir)), 1)
+
+        # a different design is built and installed
+        self._write('top.v', 'module top(); wire a; endmodule\n')
+        run_build({'project': '_test_dummy', 'components': ['gpio']})
+        StandInCompiler.artifacts = dict(first, **{'/download_overlay_bit': b'second'})
+        self._wait_for_download(time())
+        self.assertEqual(self._downloaded('overlay.bit'), b'second')
+
+        # going back to the first design needs no build at all
+        self._write('top.v', 'module top(); endmodule\n')
+        StandInCompiler.received.clear()
+        self.assertEqual(run_build({'project': '_test_dummy', 'components': ['gpio']}), {'cached': True})
+        self.assertEqual(StandInCompiler.received, [])
+        self.assertEqual(self._downloaded('overlay.bit'), first['/download_overlay_bit'])
+        self.assertGreater(local_last_modified_overlay('_test_dummy'), StandInCompiler.progress['last_completed'])
+
+        # different components are a different overlay
+        self.assertNotEqual(run_build({'project': '_test_dummy', 'components': ['uart']}), {'cached': True})
+
+        # a rebuild goes to the server, and its overlay replaces the cached one
+        StandInCompiler.received.clear()
+        self.assertEqual(run_build({'project': '_test_dummy', 'components': ['gpio'], 'rebuild': True}),
+                         {'building': True})
+        self.assertIn('/compile', [path for path, _ in StandInCompiler.received])
+        StandInCompiler.artifacts = dict(first, **{'/download_overlay_bit': b'rebuilt'})
+        self._wait_for_download(time())
+        self.assertEqual(self._downloaded('overlay.bit'), b'rebuilt')
+        self._write('top.v', 'module top(); wire a; endmodule\n')
+        self.assertEqual(run_build({'project': '_test_dummy', 'components': ['gpio']}), {'cached': True})
+        self._write('top.v', 'module top(); endmodule\n')
+        self.assertEqual(run_build({'project': '_test_dummy', 'components': ['gpio']}), {'cached': True})
+        self.assertEqual(self._downloaded('overlay.bit'), b'rebuilt')
+        StandInCompiler.artifacts = first
+        shutil.rmtree(overlay_cache_dir, True)
+
+    def test_overlay_cache_key_from_server(self):
+        import shutil
+        shutil.rmtree(overlay_cache_dir, True)
+        self._write('top.v', 'module top(); endmodule\n')
+        run_build({'project': '_test_dummy', 'components': []})
+        first = StandInCompiler.build_key
+        self._write('top.v', 'module top(); wire a; endmodule\n')
+        run_build({'project': '_test_dummy', 'components': []})
+
+        # the first build finishes last: its overlay is cached under its own key, whatever the clocks say
+        self._wait_for_download(time() + 3600, first)
+        self.assertEqual(os.listdir(overlay_cache_dir), [first])
+
+        # a server that does not say which build it completed gets nothing cached
+        shutil.rmtree(overlay_cache_dir, True)
+        StandInCompiler.progress = {'running': False, 'last_completed': time() + 7200, 'logs': ''}
+        _refresh_progress('_test_dummy')
+        sleep(0.1)
+        get_build_status({'project': '_test_dummy'})
+        downloads['_test_dummy'].thread.join(10)
+        self.assertFalse(os.path.exists(overlay_cache_dir) and os.listdir(overlay_cache_dir))
+
+    def test_overlay_cache_budget(self):
+        global overlay_cache_budget
+        import shutil
+        shutil.rmtree(overlay_cache_dir, True)
+        for key, age in [('old', 300), ('recent', 200), ('new', 100)]:
+            os.makedirs(os.path.join(overlay_cache_dir, key))
+            with open(os.path.join(overlay_cache_dir, key, 'overlay.bit'), 'wb') as f:
+                f.write(b'x' * 1000)
+            os.utime(os.path.join(overlay_cache_dir, key), (time() - age, time() - age))
+
+        original_budget = overlay_cache_budget
+        overlay_cache_budget = 2500
+        try:
+            _evict_overlays(keep='new')
+        finally:
+            overlay_cache_budget = original_budget
+        self.assertEqual(sorted(os.listdir(overlay_cache_dir)), ['new', 'recent'])
+        shutil.rmtree(overlay_cache_dir, True)
+
+    def test_benchmark_large_design(self):
+        from time import time
+        module = 'module m%d(input clk, output reg [31:0] q);\n' + '    always @(posedge clk) q <= q + 1;\n' * 500 + \
+            'endmodule\n'
+        for i in range(200):
+            self._write('m%d.v' % i, module % i)
+
+        started = time()
+        run_build({'project': '_test_dummy', 'components': []})
+        full = time() - started, StandInCompiler.received[-1][1]
+
+        self._write('m7.v', module % 7 + '// edited\n')
+        started = time()
+        run_build({'project': '_test_dummy', 'components': []})
+        incremental = time() - started, StandInCompiler.received[-1][1]
+
+        print("\n200-module design: full send %.1f ms / %d KB, one module changed %.1f ms / %d KB"
+              % (full[0] * 1000, full[1] // 1024, incremental[0] * 1000, incremental[1] // 1024))
+        self.assertLess(incremental[1] * 50, full[1])
+        self.assertEqual(self._server_sources()['m7.v'], module % 7 + '// edited\n')
+
+
 if __name__ == '__main__':
     unittest.main()
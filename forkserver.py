@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import tempfile
+import subprocess
+from threading import Thread, Lock
+
+# the socket lives in a directory only the daemon's user can enter, made when the server starts
+socket_path = None
+
+# imported once by the fork server so that user programs start with them loaded
+warm_modules = ['numpy', 'pynq', 'matplotlib', 'matplotlib.pyplot', 'PIL.Image']
+
+# longest to wait for the fork server to finish importing (seconds)
+startup_timeout = 120
+
+server_process: subprocess.Popen = None
+server_lock = Lock()
+
+
+# *****************************************
+# Client side (runs in the daemon)
+# *****************************************
+
+class WarmProcess:
+    """Program forked by the fork server, with the parts of the Popen interface the runtime uses"""
+
+    def __init__(self, connection, stdin, stdout, stderr):
+        self.connection = connection
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self.received = b''
+        self.lock = Lock()  # poll() and wait() may be called from different threads
+        self.pid = self._receive()['pid']
+
+    def _receive(self, flags=0):
+        """Read the next newline-terminated JSON message from the fork server"""
+        while b'\n' not in self.received:
+            chunk = self.connection.recv(4096, flags)
+            if chunk == b'':
+                return {'status': -1}  # fork server went away
+            self.received += chunk
+        line, self.received = self.received.split(b'\n', 1)
+        return json.loads(line)
+
+    def _set_status(self, message):
+        self.returncode = message['status']
+        self.connection.close()
+
+    def poll(self):
+        # never blocks: if another thread is waiting, it will pick up the status
+        if self.returncode is None and self.lock.acquire(blocking=False):
+            try:
+                if self.returncode is None:
+                    self._set_status(self._receive(socket.MSG_DONTWAIT))
+            except BlockingIOError:
+                pass
+            finally:
+                self.lock.release()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        with self.lock:
+            if self.returncode is None:
+                self.connection.settimeout(timeout)
+                try:
+                    self._set_status(self._receive())
+                except socket.timeout:
+                    self.connection.settimeout(None)
+                    raise subprocess.TimeoutExpired('fork server', timeout)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+def start(modules=None, wait=True):
+    """Start the fork server if it is not already up, and wait until it accepts requests
+
+    Without wait, raises RuntimeError straight away if it is still starting.
+    """
+    global server_process, socket_path
+
+    with server_lock:
+        if server_process is None or server_process.poll() is not None:
+            print("Starting fork server")
+            if socket_path is None:
+                socket_path = os.path.join(tempfile.mkdtemp(prefix='sygnallerd-forkserver-'), 'server.sock')
+            try:
+                os.remove(socket_path)
+            except FileNotFoundError:
+                pass
+            # the server exits when its stdin is closed, i.e. when the daemon goes away
+            server_process = subprocess.Popen([sys.executable, os.path.abspath(__file__), socket_path]
+                                              + (warm_modules if modules is None else modules),
+                                              stdin=subprocess.PIPE)
+        process, path = server_process, socket_path
+
+    deadline = time.time() + (startup_timeout if wait else 0)
+    while not os.path.exists(path):
+        if process.poll() is not None or time.time() > deadline:
+            raise RuntimeError("Fork server is not running" if process.poll() is not None
+                               else "Fork server is not ready yet")
+        time.sleep(0.05)
+
+
+def stop():
+    global server_process
+
+    with server_lock:
+        if server_process is not None:
+            server_process.stdin.close()
+            server_process.wait()
+            server_process = None
+
+
+def spawn(cmd, cwd, env, pass_fd, limits=None):
+    """Run a ['python3', '-u', script, args...] command in a freshly forked warm interpreter
+
+    Behaves like subprocess.Popen with stdin/stdout/stderr pipes and
+    pass_fds=(pass_fd,). The fd number seen by the program may differ, so
+    SYGNALLER_IMAGE_FD in its environment is updated to match. limits
+    ({memory, cpu_time}) are set in the child before the script starts.
+    Raises RuntimeError if the fork server is not ready to take requests.
+    """
+    start(wait=False)
+
+    stdin_r, stdin_w = os.pipe()
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        request = json.dumps({'argv': cmd[2:], 'cwd': cwd, 'env': env, 'limits': limits or {}}).encode('utf-8')
+        socket.send_fds(connection, [request], [stdin_r, stdout_w, stderr_w, pass_fd])
+        connection.shutdown(socket.SHUT_WR)
+        return WarmProcess(connection, open(stdin_w, 'wb', 0), open(stdout_r, 'rb', 0), open(stderr_r, 'rb', 0))
+    except:
+        connection.close()
+        for fd in (stdin_w, stdout_r, stderr_r):
+            os.close(fd)
+        raise
+    finally:
+        for fd in (stdin_r, stdout_w, stderr_w):
+            os.close(fd)
+
+
+# *****************************************
+# Server side (runs in its own process)
+# *****************************************
+
+def _run_child(request, fds):
+    """Turn the freshly forked process into `python3 -u script args...`"""
+    import io
+    import runpy
+    import resource
+    import atexit
+    import threading
+    import traceback
+
+    stdin, stdout, stderr, image = fds
+    for target, fd in enumerate((stdin, stdout, stderr)):
+        os.dup2(fd, target)
+        os.close(fd)
+
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    limits = request.get('limits', {})
+    if limits.get('memory') is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (limits['memory'], limits['memory']))
+    if limits.get('cpu_time') is not None:
+        resource.setrlimit(resource.RLIMIT_CPU, (limits['cpu_time'], limits['cpu_time'] + 5))
+
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    os.environ['SYGNALLER_IMAGE_FD'] = str(image)
+
+    # same stdio set up as python3 -u
+    sys.stdin = io.TextIOWrapper(io.BufferedReader(io.FileIO(0, 'r', closefd=False)), encoding='utf-8')
+    sys.stdout = io.TextIOWrapper(io.FileIO(1, 'w', closefd=False), encoding='utf-8', write_through=True)
+    sys.stderr = io.TextIOWrapper(io.FileIO(2, 'w', closefd=False), encoding='utf-8',
+                                  errors='backslashreplace', write_through=True)
+
+    script = request['argv'][0]
+    sys.argv = request['argv']
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+
+    code = 0
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            code = e.code
+        elif e.code is not None:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+
+    # as at interpreter exit: wait for the script's non-daemon threads, then the atexit handlers
+    try:
+        threading._shutdown()
+    except KeyboardInterrupt:
+        code = 1
+    atexit._run_exitfuncs()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+
+def _report_exit(connection, pid):
+    _, status = os.waitpid(pid, 0)
+    try:
+        connection.sendall(json.dumps({'status': os.waitstatus_to_exitcode(status)}).encode('utf-8') + b'\n')
+    except OSError:
+        pass
+    connection.close()
+
+
+def _serve(path, modules):
+    for module in modules:
+        try:
+            __import__(module)
+        except Exception:
+            pass
+
+    # exit as soon as the daemon closes our stdin
+    Thread(target=lambda: (sys.stdin.buffer.read(), os._exit(0)), daemon=True).start()
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.remove(path + '.tmp')
+    except FileNotFoundError:
+        pass
+    listener.bind(path + '.tmp')
+    os.rename(path + '.tmp', path)  # only visible once it is ready
+    listener.listen(16)
+
+    while True:
+        connection, _ = listener.accept()
+        try:
+            message, fds, _, _ = socket.recv_fds(connection, 65536, 4)
+            request = json.loads(message)
+        except Exception:
+            connection.close()
+            continue
+
+        pid = os.fork()
+        if pid == 0:
+            listener.close()
+            connection.close()
+            _run_child(request, fds)
+
+        for fd in fds:
+            os.close(fd)
+        connection.sendall(json.dumps({'pid': pid}).encode('utf-8') + b'\n')
+        Thread(target=_report_exit, args=(connection, pid), daemon=True).start()
+
+
+# *****************************************
+# Unit tests
+# *****************************************
+
+import unittest
+
+
+class TestForkServer(unittest.TestCase):
+
+    modules = ['numpy', 'pynq', 'PIL.Image', 'asyncio', 'unittest', 'email.mime.multipart', 'http.server']
+
+    @classmethod
+    def setUpClass(cls):
+        start(cls.modules)
+
+    def test_private_socket(self):
+        import stat
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(socket_path)).st_mode), 0o700)
+
+    @classmethod
+    def tearDownClass(cls):
+        stop()
+
+    def _spawn(self, source, args=''):
+        with open('/tmp/_forkserver_test.py', 'w') as f:
+            f.write(source)
+        r, w = os.pipe()
+        try:
+            return spawn(['python3', '-u', '/tmp/_forkserver_test.py'] + args.split(), '/tmp',
+                         dict(os.environ, SYGNALLER_TEST='yes'), w), r
+        finally:
+            os.close(w)
+
+    def test_stdio(self):
+        process, image_r = self._spawn("""
+import os, sys
+print(os.getcwd(), sys.argv[1:], os.environ['SYGNALLER_TEST'])
+print(input().upper())
+print('oops', file=sys.stderr)
+os.write(int(os.environ['SYGNALLER_IMAGE_FD']), b'img')
+sys.exit(3)
+""", 'a b')
+        process.stdin.write(b'hello\n')
+        self.assertEqual(process.stdout.readline(), b"/tmp ['a', 'b'] yes\n")
+        self.assertEqual(process.stdout.readline(), b"HELLO\n")
+        self.assertEqual(process.stderr.readline(), b"oops\n")
+        self.assertEqual(os.read(image_r, 10), b'img')
+        self.assertEqual(process.wait(timeout=10), 3)
+        for stream in (process.stdin, process.stdout, process.stderr):
+            stream.close()
+        os.close(image_r)
+
+    def test_threads_finish(self):
+        process, image_r = self._spawn("""
+import threading, time
+threading.Thread(target=lambda: time.sleep(0.5) or print('thread done')).start()
+print('main done')
+""")
+        self.assertEqual(process.wait(timeout=10), 0)
+        self.assertEqual(process.stdout.read(), b"main done\nthread done\n")
+        for stream in (process.stdin, process.stdout, process.stderr):
+            stream.close()
+        os.close(image_r)
+
+    def test_interrupt(self):
+        process, image_r = self._spawn("""
+import time
+print('ready')
+time.sleep(30)
+""")
+        self.assertEqual(process.stdout.readline(), b"ready\n")
+        self.assertIsNone(process.poll())
+        process.send_signal(signal.SIGINT)
+        self.assertEqual(process.wait(timeout=10), 1)
+        self.assertIn(b'KeyboardInterrupt', process.stderr.read())
+        for stream in (process.stdin, process.stdout, process.stderr):
+            stream.close()
+        os.close(image_r)
+
+    def test_benchmark_first_output(self):
+        source = "".join("try:\n    import %s\nexcept ImportError:\n    pass\n" % m for m in self.modules)
+        source += "print('first')\n"
+
+        def median(samples):
+            return sorted(samples)[len(samples) // 2]
+
+        cold = []
+        for i in range(5):
+            started = time.time()
+            with open('/tmp/_forkserver_test.py', 'w') as f:
+                f.write(source)
+            process = subprocess.Popen(['python3', '-u', '/tmp/_forkserver_test.py'], stdout=subprocess.PIPE)
+            self.assertEqual(process.stdout.readline(), b'first\n')
+            cold.append(time.time() - started)
+            process.wait()
+            process.stdout.close()
+
+        warm = []
+        for i in range(5):
+            started = time.time()
+            process, image_r = self._spawn(source)
+            self.assertEqual(process.stdout.readline(), b'first\n')
+            warm.append(time.time() - started)
+            process.wait()
+            for stream in (process.stdin, process.stdout, process.stderr):
+                stream.close()
+            os.close(image_r)
+
+        print("\ntime to first output: cold %.1f ms, warm %.1f ms (median of 5)"
+              % (median(cold) * 1000, median(warm) * 1000))
+        self.assertLess(median(warm), median(cold))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1].endswith('.sock'):
+        _serve(sys.argv[1], sys.argv[2:])
+    else:
+        unittest.main()
@@ -0,0 +1,132 @@
+import struct
+from collections import OrderedDict
+from threading import Lock
+
+# default bounds for images held for the IDE
+default_max_images = 64
+default_max_bytes = 32 * 1024 * 1024
+
+# frame header on the image channel: length of the MIME type, length of the image
+frame_header = struct.Struct('>HI')
+
+
+class ImageStore:
+    """Most recent images emitted by user programs, addressed by id"""
+
+    def __init__(self, max_images=default_max_images, max_bytes=default_max_bytes):
+        self.max_images = max_images
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()  # id -> (mime type, bytes)
+        self.next_id = 1
+        self.size = 0
+        self.lock = Lock()
+
+    def add(self, mime, payload):
+        with self.lock:
+            image_id = self.next_id
+            self.next_id += 1
+            self.images[image_id] = (mime, payload)
+            self.size += len(payload)
+            while len(self.images) > 1 and (len(self.images) > self.max_images or self.size > self.max_bytes):
+                _, (_, old) = self.images.popitem(last=False)
+                self.size -= len(old)
+            return image_id
+
+    def get(self, image_id):
+        with self.lock:
+            return self.images.get(image_id)
+
+
+class FrameReader:
+    """Reassembles length-prefixed images from a byte stream
+
+    Images larger than max_bytes are skipped as they arrive, never buffered.
+    """
+
+    def __init__(self, max_bytes=default_max_bytes):
+        self.max_bytes = max_bytes
+        self.buffer = bytearray()
+        self.skipping = 0  # bytes of an oversized image still to be discarded
+        self.skipped = 0  # number of oversized images
+
+    def feed(self, chunk):
+        """Add bytes read from the channel and return any (mime, payload) images now complete"""
+        if self.skipping:
+            discarded = min(self.skipping, len(chunk))
+            self.skipping -= discarded
+            chunk = chunk[discarded:]
+        self.buffer += chunk
+        frames = []
+        while len(self.buffer) >= frame_header.size:
+            mime_length, payload_length = frame_header.unpack_from(self.buffer)
+            end = frame_header.size + mime_length + payload_length
+            if payload_length > self.max_bytes:
+                self.skipped += 1
+                self.skipping = max(end - len(self.buffer), 0)
+                del self.buffer[:end]
+                continue
+            if len(self.buffer) < end:
+                break
+            mime = bytes(self.buffer[frame_header.size:frame_header.size + mime_length]).decode('ascii', 'replace')
+            frames.append((mime, bytes(self.buffer[frame_header.size + mime_length:end])))
+            del self.buffer[:end]
+        return frames
+
+
+def encode_frame(mime, payload):
+    mime = mime.encode('ascii')
+    return frame_header.pack(len(mime), len(payload)) + mime + payload
+
+
+# *****************************************
+# Unit tests
+# *****************************************
+
+import unittest
+
+
+class TestImageStore(unittest.TestCase):
+
+    def test_add_get(self):
+        store = ImageStore()
+        image_id = store.add('image/png', b'png')
+        self.assertEqual(store.get(image_id), ('image/png', b'png'))
+        self.assertIsNone(store.get(image_id + 1))
+
+    def test_bounds(self):
+        store = ImageStore(max_images=2, max_bytes=10)
+        first = store.add('image/png', b'1234')
+        second = store.add('image/png', b'1234')
+        third = store.add('image/png', b'1234')
+        self.assertIsNone(store.get(first))
+        self.assertIsNotNone(store.get(second))
+        store.add('image/png', b'123456789')
+        self.assertIsNone(store.get(third))
+        self.assertLessEqual(store.size, 10)
+
+    def test_frames(self):
+        reader = FrameReader()
+        data = encode_frame('image/png', b'first') + encode_frame('image/jpeg', b'second')
+        # arrives in arbitrary pieces
+        self.assertEqual(reader.feed(data[:3]), [])
+        self.assertEqual(reader.feed(data[3:20]), [('image/png', b'first')])
+        self.assertEqual(reader.feed(data[20:]), [('image/jpeg', b'second')])
+        self.assertEqual(len(reader.buffer), 0)
+
+    def test_oversized_frame(self):
+        reader = FrameReader(max_bytes=8)
+        data = encode_frame('image/png', b'x' * 100) + encode_frame('image/png', b'small')
+        self.assertEqual(reader.feed(data[:20]), [])
+        self.assertEqual(len(reader.buffer), 0)  # nothing of the oversized image is kept
+        self.assertEqual(reader.feed(data[20:60]), [])
+        self.assertEqual(reader.feed(data[60:]), [('image/png', b'small')])
+        self.assertEqual(reader.skipped, 1)
+
+        # a bogus header claiming gigabytes is not buffered either
+        reader = FrameReader()
+        self.assertEqual(reader.feed(frame_header.pack(9, 0xffffffff) + b'image/png' + b'\0' * 1000), [])
+        self.assertEqual(len(reader.buffer), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,64 +2,268 @@
 
 import http.server
 import urllib.parse
+import email.utils
 import json
+import gzip
+import os
+import re
+import time
 import uuid
+import base64
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import transfer
 import runtime
 import compiler
 import video
+import metrics
 
+# number of requests that can be served at the same time: every video stream and terminal long poll,
+# with room to spare for everything else
+default_workers = video.max_streams + runtime.max_waiting_polls + 8
 
-class DaemonServer(http.server.BaseHTTPRequestHandler):
+# multipart streams: part separator, and how long a client may stall before it is dropped (seconds)
+stream_boundary = 'sygnallerframe'
+stream_send_timeout = 10
 
-    def _error(self, err):
-        return {
-            'error': err
-        }
+# JSON responses at least this large are gzipped for clients that accept it
+gzip_min_size = 4096
+gzip_level = 5
 
-    def api(self, command, data):
-        if command == 'echo':
-            return data
 
-        elif command == 'ping':
-            return {
-                "ping": "pong",
-                "mac": "%012X" % uuid.getnode(),
-                "running": runtime.is_running()
-            }
+class BodyReader:
+    """File-like view of a request body that stops at its Content-Length"""
 
-        elif command == 'upload_files':
-            return transfer.upload_files(data)
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
 
-        elif command == 'run_python':
-            return runtime.run_python(data)
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        return data
 
-        elif command == 'stop_python':
-            return runtime.stop_python()
 
-        elif command == 'python_terminal':
-            return runtime.terminal(data)
+# batches: most commands in one request, and how many of a batch's commands run at once
+max_batch_size = 32
+batch_workers = 4
 
-        elif command == 'python_video_stream':
-            return video.get_last_frame(data)
 
-        elif command == 'clear_build_cache':
-            return compiler.clear_cache(data)
+def ping(data):
+    return {
+        "ping": "pong",
+        "mac": "%012X" % uuid.getnode(),
+        "running": runtime.is_running()
+    }
+
+
+def get_metrics(data):
+    """Counters and latencies of commands and compilation server calls, and terminal activity
+
+    As JSON, or with format 'prometheus' as Prometheus text.
+    """
+    terminal = runtime.terminal_metrics()
+    if (data or {}).get('format') != 'prometheus':
+        return {
+            'commands': metrics.commands.report(),
+            'upstream': metrics.upstream.report(),
+            'terminal': terminal
+        }
+
+    lines = metrics.commands.prometheus('sygnaller_command', 'command',
+                                        'Time to handle an API command and send its response')
+    lines += metrics.upstream.prometheus('sygnaller_upstream', 'path',
+                                         'Time for a call to the compilation server, retries included')
+    lines += metrics.gauge_lines('sygnaller_terminal_stdin_queue', 'gauge',
+                                 'Input waiting to be written to a program',
+                                 [({'session': s['session']}, s['stdin_queue']) for s in terminal['sessions']])
+    lines += metrics.gauge_lines('sygnaller_terminal_output_entries', 'gauge',
+                                 'Lines of program output held for terminal clients',
+                                 [({'session': s['session']}, s['output_entries']) for s in terminal['sessions']])
+    lines += metrics.gauge_lines('sygnaller_program_output_bytes_total', 'counter',
+                                 'Bytes of output written by user programs', [({}, terminal['output_bytes'])])
+    return {'content': ('\n'.join(lines) + '\n').encode('utf-8'), 'content-type': metrics.prometheus_content_type}
+
+
+# commands taking a JSON body, by name
+commands = {
+    'echo': lambda data: data,
+    'ping': ping,
+    'upload_files': transfer.upload_files,
+    'upload_begin': transfer.upload_begin,
+    'upload_status': transfer.upload_status,
+    'upload_commit': transfer.upload_commit,
+    'project_manifest': transfer.project_manifest,
+    'project_snapshots': transfer.project_snapshots,
+    'rollback_project': transfer.rollback_project,
+    'run_python': runtime.run_python,
+    'stop_python': runtime.stop_python,
+    'python_stats': runtime.python_stats,
+    'python_sessions': runtime.list_sessions,
+    'python_terminal': runtime.terminal,
+    'python_image': runtime.get_image,
+    'python_video_stream': video.get_last_frame,
+    'python_video_mjpeg': video.stream_frames,
+    'clear_build_cache': compiler.clear_cache,
+    'start_build': compiler.run_build,
+    'stop_build': compiler.stop_build,
+    'get_build_progress': compiler.get_build_status,
+    'metrics': get_metrics
+}
+
+# commands that can be sent with GET, their parameters in the query string; none of them change anything
+get_commands = {'ping', 'python_stats', 'python_sessions', 'python_video_stream', 'python_video_mjpeg',
+                'get_build_progress', 'metrics'}
+
+# commands that take their parameters from the query string and stream the request body
+streaming_commands = {
+    'upload_tar': transfer.upload_tar,
+    'upload_chunk': transfer.upload_chunk
+}
+
+
+def _error(err):
+    return {
+        'error': err
+    }
+
+
+def _batch_entry(entry):
+    """Result of one command of a batch, as JSON; errors are reported in the entry's result"""
+    command = ''
+    started = time.time()
+    try:
+        command = entry['command']
+        if command not in commands:
+            return _error('Command not supported')
+        resp = commands[command](entry.get('data'))
+    except KeyError:
+        resp = _error('Missing data')
+    except Exception as e:
+        print(type(e).__name__, e)
+        traceback.print_exc()
+        resp = _error('Server error (%s encountered %s)' % (command, type(e).__name__))
+    if command in commands:
+        metrics.commands.record(command, time.time() - started, 'error' in resp)
+    if 'error' in resp:
+        return resp
+
+    if 'stream' in resp:
+        resp['stream'].close()
+        return _error('Not available in a batch')
+    elif 'file' in resp:
+        return _error('Not available in a batch')
+    elif 'content' in resp:
+        resp = dict(resp, content=base64.b64encode(resp['content']).decode('ascii'))
+    return resp
+
+
+def run_batch(data):
+    """Run a list of {command, data} entries and return their results in the same order
+
+    With concurrent set the entries run at the same time, so they should not
+    depend on one another. Each batch has its own threads, so a batch of long
+    polls never holds up another batch.
+    """
+    entries = data['commands']
+    if not isinstance(entries, list) or len(entries) > max_batch_size:
+        return _error('Batch must be a list of at most %d commands' % max_batch_size)
+    if data.get('concurrent') and len(entries) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(entries), batch_workers), thread_name_prefix='batch') as executor:
+            results = list(executor.map(_batch_entry, entries))
+    else:
+        results = [_batch_entry(entry) for entry in entries]
+    return {'results': results}
 
-        elif command == 'start_build':
-            return compiler.run_build(data)
 
-        elif command == 'stop_build':
-            return compiler.stop_build(data)
+class DaemonServer(http.server.BaseHTTPRequestHandler):
 
-        elif command == 'get_build_progress':
-            return compiler.get_build_status(data)
+    def _error(self, err):
+        return _error(err)
 
+    def api(self, command, data):
+        if command == 'batch':
+            return run_batch(data)
+        elif command in commands:
+            return commands[command](data)
         else:
             return self._error('Command not supported')
 
+    def _send_file(self, path, content_type='application/octet-stream'):
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.send_error(404, 'File Not Found')
+            return 0
+
+        with f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            etag = '"%x-%x-%x"' % (stat.st_ino, size, stat.st_mtime_ns)
+
+            # client already has this exact file
+            if _etag_matches(self.headers.get('If-None-Match'), etag):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                return 0
+
+            # partial content, unless If-Range says the client's copy is outdated
+            status = 200
+            start, end = 0, size - 1
+            range_header = self.headers.get('Range')
+            if range_header is not None and self.headers.get('If-Range', etag) == etag:
+                byte_range = _parse_range(range_header, size)
+                if byte_range is None:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.send_header('Access-Control-Allow-Origin', '*')
+                    self.end_headers()
+                    return 0
+                elif byte_range != (0, size - 1):
+                    status = 206
+                    start, end = byte_range
+
+            length = end - start + 1
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(length))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True))
+            self.send_header('Accept-Ranges', 'bytes')
+            if status == 206:
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Access-Control-Expose-Headers', 'ETag, Last-Modified, Content-Range')
+            self.end_headers()
+
+            # uses os.sendfile where the platform has it, otherwise streams in chunks
+            if length > 0:
+                self.connection.sendfile(f, start, length)
+            return length
+
+    def _send_content(self, content, content_type, etag=None, headers=None):
+        status = 304 if etag is not None and _etag_matches(self.headers.get('If-None-Match'), etag) else 200
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', ', '.join(['ETag'] + list(headers or {})))
+        if status == 304:
+            self.end_headers()
+            return 0
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        return len(content)
+
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
@@ -68,36 +272,97 @@ class DaemonServer(http.server.BaseHTTPRequestHandler):
         self.end_headers()
 
 
+    def _send_stream(self, frames, content_type):
+        """Push each part as it is produced, as multipart/x-mixed-replace (e.g. MJPEG)"""
+        sent = 0
+        try:
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + stream_boundary)
+            self.send_header('Cache-Control', 'no-cache, no-store')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.connection.settimeout(stream_send_timeout)
+            for part in frames:
+                part = (b'--%s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n'
+                        % (stream_boundary.encode('ascii'), content_type.encode('ascii'), len(part))
+                        + part + b'\r\n')
+                self.wfile.write(part)
+                sent += len(part)
+        except OSError:
+            pass  # the client went away, or stopped reading
+        finally:
+            frames.close()
+        return sent
+
+    def _send_response(self, resp):
+        """Send a command's response, returning the number of body bytes sent"""
+        if 'file' in resp:
+            return self._send_file(resp['file'])
+        elif 'stream' in resp:
+            return self._send_stream(resp['stream'], resp['content-type'])
+        elif 'content' in resp:
+            return self._send_content(resp['content'], resp['content-type'], resp.get('etag'), resp.get('headers'))
+
+        body = bytes(json.dumps(resp), encoding='utf-8') + b'\n'
+        self.send_response(200)
+        if 'video-error' in resp:
+            self.send_header('X-Video-Error', resp['video-error'])
+        self.send_header('Content-Type', 'application/json')
+        if len(body) >= gzip_min_size and _accepts_gzip(self.headers.get('Accept-Encoding')):
+            body = gzip.compress(body, gzip_level)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def _record(self, command, started, resp, request_bytes, response_bytes):
+        if command not in commands and command not in streaming_commands and command != 'batch':
+            command = 'unknown'  # keeps the set of names bounded
+        metrics.commands.record(command, time.time() - started, 'error' in resp, request_bytes, response_bytes)
+
     def do_GET(self):
+        started = time.time()
+        command = ''
         try:
-            command = urllib.parse.urlparse(self.path).path[1:]
-            resp = self.api(command, {})
+            url_string = urllib.parse.urlparse(self.path)
+            command = url_string.path[1:]
+            if command in get_commands:
+                resp = self.api(command, dict(urllib.parse.parse_qsl(url_string.query)))
+            elif command in commands or command == 'batch':
+                resp = self._error('Use POST')
+            else:
+                resp = self._error('Command not supported')
         except KeyError:
             resp = self._error('Missing data (use POST)')
         except Exception as e:
             print(type(e).__name__, e)
             resp = self._error('Server error')
-        self.send_response(200)
-        self.send_header('Content-Type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(bytes(json.dumps(resp), encoding='utf-8'))
-        self.wfile.write(b'\n')
+        self._record(command, started, resp, 0, self._send_response(resp))
 
 
     def do_POST(self):
+        started = time.time()
         command = ''
+        d_length = 0
         try:
             url_string = urllib.parse.urlparse(self.path)
             d_length = int(self.headers['content-length'])
 
             command = url_string.path[1:]
-            if d_length == 0:
-                data = None
+            if command in streaming_commands:
+                # the body is raw data for the handler to consume as it arrives
+                params = dict(urllib.parse.parse_qsl(url_string.query))
+                resp = streaming_commands[command](params, BodyReader(self.rfile, d_length))
             else:
-                data = json.loads(self.rfile.read(d_length))
+                if d_length == 0:
+                    data = None
+                else:
+                    data = json.loads(self.rfile.read(d_length))
 
-            resp = self.api(command, data)
+                resp = self.api(command, data)
 
         except json.decoder.JSONDecodeError:
             resp = self._error('Invalid JSON')
@@ -110,32 +375,413 @@ class DaemonServer(http.server.BaseHTTPRequestHandler):
             traceback.print_exc()
             resp = self._error('Server error (%s encountered %s)' % (command, type(e).__name__))
 
-        if 'file' in resp:
-            try:
-                with open(resp['file'], 'rb') as f:
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/octet-stream')
-                    self.end_headers()
-                    self.wfile.write(f.read())
-            except IOError:
-                self.send_error(404, 'File Not Found')
-        else:
-            self.send_response(200)
-            if 'video-error' in resp:
-                self.send_header('X-Video-Error', resp['video-error'])
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(bytes(json.dumps(resp), encoding='utf-8'))
-            self.wfile.write(b'\n')
+        self._record(command, started, resp, d_length, self._send_response(resp))
+
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or 'W/' + etag in candidates
+
+
+def _accepts_gzip(accept_encoding):
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+def _parse_range(range_header, size):
+    """Parse a single 'bytes=' range into inclusive (start, end) offsets, or None if unsatisfiable"""
+    match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', range_header)
+    if match is None or match.group(1) == match.group(2) == '':
+        return 0, size - 1  # multiple or malformed ranges: serve the whole file
+
+    if match.group(1) == '':
+        # suffix range: the last n bytes
+        suffix = int(match.group(2))
+        if suffix == 0 or size == 0:
+            return None
+        return max(size - suffix, 0), size - 1
+
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) != '' else size - 1
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """HTTP server that handles requests concurrently on a bounded pool of worker threads"""
 
+    def __init__(self, server_address, handler_class, workers=default_workers):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='httpd')
 
-def start_server(port=8000):
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request_worker, request, client_address)
+
+    def _process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+def start_server(port=8000, workers=default_workers):
     server_address = ('', port)
-    httpd = http.server.HTTPServer(server_address, DaemonServer)
-    print('Starting httpd on port %d...' % port)
+    httpd = PooledHTTPServer(server_address, DaemonServer, workers)
+    runtime.warm_up()
+    print('Starting httpd on port %d with %d workers...' % (port, workers))
     httpd.serve_forever()
 
 
+# *****************************************
+# Unit tests
+# *****************************************
+
+import unittest
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        import shutil
+        import threading
+        shutil.rmtree('/home/xilinx/projects/_test_dummy', True)
+        self.httpd = PooledHTTPServer(('127.0.0.1', 0), DaemonServer, 4)
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _post(self, command, data):
+        from urllib.request import Request, urlopen
+        request = Request('http://127.0.0.1:%d/%s' % (self.port, command), json.dumps(data).encode('utf-8'))
+        return json.loads(urlopen(request, timeout=30).read().decode())
+
+    def _poll_latencies(self, count):
+        from time import time
+        latencies = []
+        for i in range(count):
+            started = time()
+            self._post('python_terminal', {})
+            latencies.append(time() - started)
+        return latencies
+
+    def _post_raw(self, command, data, headers=None):
+        from urllib.request import Request, urlopen
+        from urllib.error import HTTPError
+        request = Request('http://127.0.0.1:%d/%s' % (self.port, command), json.dumps(data).encode('utf-8'),
+                          headers or {})
+        try:
+            with urlopen(request, timeout=30) as response:
+                return response.status, response.headers, response.read()
+        except HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    def _make_file(self, contents):
+        os.makedirs('/home/xilinx/projects/_test_dummy', exist_ok=True)
+        with open('/home/xilinx/projects/_test_dummy/blob.bin', 'wb') as f:
+            f.write(contents)
+        return '/home/xilinx/projects/_test_dummy/blob.bin'
+
+    def test_echo(self):
+        self.assertEqual(self._post('echo', {'a': 1}), {'a': 1})
+
+    def test_gzip(self):
+        data = {'logs': 'Synthesis\n' * 1000}
+        status, headers, body = self._post_raw('echo', data, {'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertLess(len(body), 1000)
+        self.assertEqual(json.loads(gzip.decompress(body)), data)
+
+        # small responses, and clients that did not ask, get plain JSON
+        status, headers, body = self._post_raw('echo', data)
+        self.assertIsNone(headers['Content-Encoding'])
+        self.assertEqual(json.loads(body), data)
+        status, headers, body = self._post_raw('echo', {'a': 1}, {'Accept-Encoding': 'gzip'})
+        self.assertIsNone(headers['Content-Encoding'])
+
+    def test_mjpeg_stream(self):
+        from urllib.request import urlopen
+        from PIL import Image
+        Image.new('RGB', (320, 240)).save('/home/xilinx/projects/videoA.jpg')
+        with open('/home/xilinx/projects/videoSELECT.txt', 'w') as f:
+            f.write('A')
+        with open('/home/xilinx/projects/videoA.jpg', 'rb') as f:
+            jpeg = f.read()
+
+        with urlopen('http://127.0.0.1:%d/python_video_mjpeg?max_fps=5' % self.port, timeout=10) as response:
+            self.assertEqual(response.headers['Content-Type'],
+                             'multipart/x-mixed-replace; boundary=' + stream_boundary)
+            self.assertEqual(response.readline(), b'--' + stream_boundary.encode('ascii') + b'\r\n')
+            headers = {}
+            for line in iter(response.readline, b'\r\n'):
+                name, value = line.decode().split(':', 1)
+                headers[name] = value.strip()
+            self.assertEqual(headers['Content-Type'], 'image/jpeg')
+            self.assertEqual(response.read(int(headers['Content-Length'])), jpeg)
+
+    def test_stream_slot_released(self):
+        from time import sleep
+        from PIL import Image
+        Image.new('RGB', (320, 240)).save('/home/xilinx/projects/videoA.jpg')
+        with open('/home/xilinx/projects/videoSELECT.txt', 'w') as f:
+            f.write('A')
+        sleep(0.1)
+
+        # clients that are gone before the headers go out still give their slot back
+        class Gone(DaemonServer):
+            def send_response(self, code, message=None):
+                raise ConnectionResetError()
+
+        handler = Gone.__new__(Gone)
+        before = video.streams
+        for i in range(video.max_streams + 1):
+            self.assertEqual(handler._send_response(video.stream_frames({})), 0)
+        self.assertEqual(video.streams, before)
+
+    def test_video_frame_not_modified(self):
+        from time import sleep
+        from PIL import Image
+        Image.new('RGB', (320, 240)).save('/home/xilinx/projects/videoA.jpg')
+        with open('/home/xilinx/projects/videoSELECT.txt', 'w') as f:
+            f.write('A')
+        sleep(0.1)
+
+        status, headers, body = self._post_raw('python_video_stream', {'flushCache': False, 'seq': 0})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'image/jpeg')
+        self.assertIsNotNone(headers['X-Frame-Seq'])
+        status, _, body = self._post_raw('python_video_stream', {'flushCache': False, 'seq': 0},
+                                         {'If-None-Match': headers['ETag']})
+        self.assertEqual((status, body), (304, b''))
+
+    def test_batch(self):
+        from PIL import Image
+        Image.new('RGB', (320, 240)).save('/home/xilinx/projects/videoA.jpg')
+        with open('/home/xilinx/projects/videoSELECT.txt', 'w') as f:
+            f.write('A')
+        with open('/home/xilinx/projects/videoA.jpg', 'rb') as f:
+            jpeg = f.read()
+
+        for concurrent in (False, True):
+            results = self._post('batch', {'concurrent': concurrent, 'commands': [
+                {'command': 'echo', 'data': {'a': 1}},
+                {'command': 'ping'},
+                {'command': 'no_such_command'},
+                {'data': {}},
+                {'command': 'python_video_stream', 'data': {'flushCache': False, 'seq': 0}},
+                {'command': 'python_video_mjpeg', 'data': {}},
+                {'command': 'echo', 'data': {'b': 2}}
+            ]})['results']
+            self.assertEqual(results[0], {'a': 1})
+            self.assertEqual(results[1]['ping'], 'pong')
+            self.assertEqual(results[2], {'error': 'Command not supported'})
+            self.assertEqual(results[3], {'error': 'Missing data'})
+            self.assertEqual(base64.b64decode(results[4]['content']), jpeg)
+            self.assertEqual(results[5], {'error': 'Not available in a batch'})
+            self.assertEqual(results[6], {'b': 2})
+        self.assertEqual(video.streams, 0)
+
+        self.assertIn('error', self._post('batch', {'commands': [{'command': 'ping'}] * (max_batch_size + 1)}))
+
+    def test_batches_independent(self):
+        import threading
+        from time import time, sleep
+        commands['_test_sleep'] = lambda data: sleep(data) or {}
+        try:
+            # long polls in one batch do not hold up another
+            started = time()
+            threads = [threading.Thread(target=run_batch, args=({'concurrent': True, 'commands': [
+                {'command': '_test_sleep', 'data': 0.5}] * batch_workers},)) for i in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertLess(time() - started, 1)
+        finally:
+            del commands['_test_sleep']
+
+    def test_benchmark_batch(self):
+        from time import time, sleep
+        from http.client import HTTPConnection
+        polls = [('python_terminal', {}), ('python_video_stream', {'flushCache': False, 'seq': 0}),
+                 ('python_sessions', {}), ('ping', {})]
+        latency = 0.005  # a lab network round trip, added by a proxy in front of the daemon
+
+        def request(connection, command, data):
+            sleep(latency)
+            connection.request('POST', '/' + command, json.dumps(data))
+            return connection.getresponse().read()
+
+        connection = HTTPConnection('127.0.0.1', self.port, timeout=30)
+        started = time()
+        for i in range(10):
+            for command, data in polls:
+                request(connection, command, data)
+        separate = (time() - started) / 10
+
+        started = time()
+        for i in range(10):
+            request(connection, 'batch', {'concurrent': True, 'commands': [
+                {'command': command, 'data': data} for command, data in polls
+            ]})
+        batched = (time() - started) / 10
+        connection.close()
+
+        print('\nIDE poll tick with %d ms round trips: %d requests %.1f ms, one batch %.1f ms'
+              % (latency * 1000, len(polls), separate * 1000, batched * 1000))
+        self.assertLess(batched, separate)
+
+    def test_get_restricted(self):
+        from urllib.request import urlopen
+        path = self._make_file(b'secret')
+        for command in ('echo?file=' + path, 'stop_python', 'batch'):
+            with urlopen('http://127.0.0.1:%d/%s' % (self.port, command), timeout=10) as response:
+                self.assertEqual(json.loads(response.read().decode()), {'error': 'Use POST'})
+        with urlopen('http://127.0.0.1:%d/ping' % self.port, timeout=10) as response:
+            self.assertEqual(json.loads(response.read().decode())['ping'], 'pong')
+
+    def test_metrics(self):
+        from urllib.request import urlopen
+        before = self._post('metrics', {})['commands'].get('ping', {'count': 0, 'response_bytes': 0})
+        for i in range(3):
+            self._post('ping', {})
+        self._post('no_such_command', {})
+        self._post('batch', {'commands': [{'command': 'ping'}]})
+
+        report = self._post('metrics', {})
+        ping = report['commands']['ping']
+        self.assertEqual(ping['count'], before['count'] + 4)
+        self.assertGreater(ping['response_bytes'], before['response_bytes'])
+        self.assertEqual(ping['request_bytes'] % 2, 0)  # '{}' per HTTP request, nothing for the batched one
+        self.assertLessEqual(ping['latency']['p50'], ping['latency']['p99'])
+        self.assertGreaterEqual(report['commands']['unknown']['errors'], 1)
+        self.assertIn('output_bytes', report['terminal'])
+
+        with urlopen('http://127.0.0.1:%d/metrics?format=prometheus' % self.port, timeout=10) as response:
+            self.assertEqual(response.headers['Content-Type'], metrics.prometheus_content_type)
+            text = response.read().decode()
+        self.assertIn('# TYPE sygnaller_command_duration_seconds histogram', text)
+        self.assertIn('sygnaller_command_duration_seconds_count{command="ping"} %d' % ping['count'], text)
+        self.assertIn('sygnaller_program_output_bytes_total ', text)
+
+    def test_file_response(self):
+        path = self._make_file(b'0123456789' * 1000)
+        status, headers, body = self._post_raw('echo', {'file': path})
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'0123456789' * 1000)
+        self.assertEqual(headers['Content-Length'], '10000')
+        self.assertIsNotNone(headers['Last-Modified'])
+        self.assertIsNotNone(headers['ETag'])
+
+    def test_file_not_modified(self):
+        path = self._make_file(b'frame')
+        status, headers, body = self._post_raw('echo', {'file': path})
+        status, _, body = self._post_raw('echo', {'file': path}, {'If-None-Match': headers['ETag']})
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+        # a different file version is sent again
+        path = self._make_file(b'frame2')
+        status, _, body = self._post_raw('echo', {'file': path}, {'If-None-Match': headers['ETag']})
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'frame2')
+
+    def test_file_range(self):
+        path = self._make_file(b'0123456789')
+        status, headers, body = self._post_raw('echo', {'file': path}, {'Range': 'bytes=2-5'})
+        self.assertEqual(status, 206)
+        self.assertEqual(body, b'2345')
+        self.assertEqual(headers['Content-Range'], 'bytes 2-5/10')
+        status, headers, body = self._post_raw('echo', {'file': path}, {'Range': 'bytes=7-'})
+        self.assertEqual(body, b'789')
+        status, headers, body = self._post_raw('echo', {'file': path}, {'Range': 'bytes=-2'})
+        self.assertEqual(body, b'89')
+        status, headers, body = self._post_raw('echo', {'file': path}, {'Range': 'bytes=20-30'})
+        self.assertEqual(status, 416)
+        self.assertEqual(headers['Content-Range'], 'bytes */10')
+
+    def test_file_missing(self):
+        status, _, _ = self._post_raw('echo', {'file': '/home/xilinx/projects/_test_dummy/missing.bin'})
+        self.assertEqual(status, 404)
+
+    def test_upload_tar(self):
+        import io
+        import tarfile
+        from urllib.request import Request, urlopen
+
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            for path, contents in (('software/main.py', b'print(1)\n'), ('data/big.bin', os.urandom(1 << 20))):
+                info = tarfile.TarInfo(path)
+                info.size = len(contents)
+                tar.addfile(info, io.BytesIO(contents))
+
+        request = Request('http://127.0.0.1:%d/upload_tar?project=_test_dummy&directory=software' % self.port,
+                          archive.getvalue())
+        self.assertEqual(json.loads(urlopen(request, timeout=30).read().decode()), {})
+        with open('/home/xilinx/projects/_test_dummy/software/main.py', 'rb') as f:
+            self.assertEqual(f.read(), b'print(1)\n')
+        self.assertEqual(os.path.getsize('/home/xilinx/projects/_test_dummy/data/big.bin'), 1 << 20)
+
+    def test_terminal_latency_during_build(self):
+        import threading
+        from time import sleep
+
+        # stand-in compilation server that takes a while to accept a build
+        class SlowCompiler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers['content-length']))
+                sleep(2)
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        upstream = PooledHTTPServer(('127.0.0.1', 0), SlowCompiler, 2)
+        threading.Thread(target=upstream.serve_forever, daemon=True).start()
+        original_server = compiler.compilation_server
+        compiler.compilation_server = 'http://127.0.0.1:%d' % upstream.server_address[1]
+
+        os.makedirs('/home/xilinx/projects/_test_dummy/hardware')
+        with open('/home/xilinx/projects/_test_dummy/hardware/top.v', 'w') as f:
+            f.write('module top(); endmodule\n')
+
+        try:
+            idle = self._poll_latencies(20)
+
+            build = threading.Thread(target=self._post, args=('start_build', {
+                'project': '_test_dummy',
+                'components': []
+            }))
+            build.start()
+            sleep(0.2)
+            busy = self._poll_latencies(20)
+            self.assertTrue(build.is_alive())
+            build.join()
+        finally:
+            compiler.compilation_server = original_server
+            upstream.shutdown()
+            upstream.server_close()
+
+        print('terminal poll latency idle: %.1f ms max, during build: %.1f ms max'
+              % (max(idle) * 1000, max(busy) * 1000))
+        self.assertLess(max(busy), 0.5)
+
+
 if __name__ == '__main__':
     start_server()
@@ -0,0 +1,183 @@
+import math
+from collections import deque
+from threading import Lock
+
+# upper bounds of the latency histogram buckets (seconds), as exported to Prometheus
+latency_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# how many of the latest observations the percentiles are taken from
+default_window = 1024
+
+prometheus_content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """Latency distribution: cumulative buckets for Prometheus, and percentiles of the latest observations"""
+
+    def __init__(self, window=default_window):
+        self.buckets = [0] * (len(latency_buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(latency_buckets) and seconds > latency_buckets[i]:
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def percentiles(self):
+        samples = sorted(self.recent)
+        if not samples:
+            return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+
+        def rank(p):
+            return samples[min(math.ceil(p * len(samples)) - 1, len(samples) - 1)]
+        return {'p50': rank(0.5), 'p95': rank(0.95), 'p99': rank(0.99), 'max': samples[-1]}
+
+    def cumulative(self):
+        """(upper bound, observations at or below it) for each bucket, ending with +Inf"""
+        total = 0
+        result = []
+        for bound, count in zip(latency_buckets + [math.inf], self.buckets):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class CallStats:
+    """Count, errors, latency and bytes of calls, per name (a command, an upstream path)"""
+
+    def __init__(self):
+        self.calls = {}  # name -> {'latency': Histogram, 'errors', 'request_bytes', 'response_bytes'}
+        self.lock = Lock()
+
+    def record(self, name, seconds, error=False, request_bytes=0, response_bytes=0):
+        with self.lock:
+            call = self.calls.get(name)
+            if call is None:
+                call = self.calls[name] = {'latency': Histogram(), 'errors': 0,
+                                           'request_bytes': 0, 'response_bytes': 0}
+            call['latency'].observe(seconds)
+            call['errors'] += bool(error)
+            call['request_bytes'] += request_bytes
+            call['response_bytes'] += response_bytes
+
+    def report(self):
+        with self.lock:
+            return {name: dict(count=call['latency'].count, errors=call['errors'],
+                               request_bytes=call['request_bytes'], response_bytes=call['response_bytes'],
+                               latency=call['latency'].percentiles())
+                    for name, call in sorted(self.calls.items())}
+
+    def prometheus(self, prefix, label, help_text):
+        """Prometheus text for the histograms and counters, labelled with each call's name"""
+        with self.lock:
+            calls = sorted((name, call['latency'].cumulative(), call['latency'].sum, call['latency'].count,
+                            call['errors'], call['request_bytes'], call['response_bytes'])
+                           for name, call in self.calls.items())
+
+        lines = ['# HELP %s_duration_seconds %s' % (prefix, help_text),
+                 '# TYPE %s_duration_seconds histogram' % prefix]
+        for name, buckets, total, count, *_ in calls:
+            for bound, cumulative in buckets:
+                lines.append('%s_duration_seconds_bucket{%s="%s",le="%s"} %d'
+                             % (prefix, label, _escape(name), '+Inf' if bound == math.inf else bound, cumulative))
+            lines.append('%s_duration_seconds_sum{%s="%s"} %r' % (prefix, label, _escape(name), total))
+            lines.append('%s_duration_seconds_count{%s="%s"} %d' % (prefix, label, _escape(name), count))
+
+        for i, counter in ((4, 'errors'), (5, 'request_bytes'), (6, 'response_bytes')):
+            if counter != 'errors' and not any(call[i] for call in calls):
+                continue  # nothing sent this way, e.g. upstream calls are not measured in bytes
+            lines.append('# TYPE %s_%s_total counter' % (prefix, counter))
+            for call in calls:
+                lines.append('%s_%s_total{%s="%s"} %d' % (prefix, counter, label, _escape(call[0]), call[i]))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def gauge_lines(name, kind, help_text, values):
+    """Prometheus text for a gauge or counter, given a list of (labels dict, value)"""
+    lines = ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, kind)]
+    for labels, value in values:
+        label_text = ','.join('%s="%s"' % (key, _escape(val)) for key, val in labels.items())
+        lines.append('%s%s %r' % (name, '{%s}' % label_text if label_text else '', value))
+    return lines
+
+
+# shared by the modules that are measured
+commands = CallStats()  # API commands handled by the daemon
+upstream = CallStats()  # calls to the compilation server
+
+
+# *****************************************
+# Unit tests
+# *****************************************
+
+import unittest
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for i in range(1, 101):
+            histogram.observe(i / 1000)
+        self.assertEqual(histogram.percentiles(), {'p50': 0.05, 'p95': 0.095, 'p99': 0.099, 'max': 0.1})
+        self.assertEqual(histogram.cumulative()[-1], (math.inf, 100))
+        self.assertEqual(dict(histogram.cumulative())[0.01], 10)
+
+        # percentiles follow the latest observations
+        histogram = Histogram(window=10)
+        for i in range(100):
+            histogram.observe(1 if i < 90 else 0.001)
+        self.assertEqual(histogram.percentiles()['p99'], 0.001)
+        self.assertEqual(histogram.count, 100)
+
+    def test_call_stats(self):
+        stats = CallStats()
+        stats.record('ping', 0.002, request_bytes=2, response_bytes=50)
+        stats.record('ping', 0.004, error=True, request_bytes=2, response_bytes=30)
+        report = stats.report()['ping']
+        self.assertEqual((report['count'], report['errors'], report['request_bytes'], report['response_bytes']),
+                         (2, 1, 4, 80))
+        self.assertEqual(report['latency']['max'], 0.004)
+
+        text = '\n'.join(stats.prometheus('sygnaller_command', 'command', 'Time to handle a command'))
+        self.assertIn('# TYPE sygnaller_command_duration_seconds histogram', text)
+        self.assertIn('sygnaller_command_duration_seconds_bucket{command="ping",le="0.0025"} 1', text)
+        self.assertIn('sygnaller_command_duration_seconds_bucket{command="ping",le="+Inf"} 2', text)
+        self.assertIn('sygnaller_command_duration_seconds_count{command="ping"} 2', text)
+        self.assertIn('sygnaller_command_errors_total{command="ping"} 1', text)
+        self.assertIn('sygnaller_command_response_bytes_total{command="ping"} 80', text)
+
+    def test_benchmark_record(self):
+        import time
+        stats = CallStats()
+        started = time.time()
+        for i in range(100000):
+            stats.record('python_terminal', (i % 1000) / 10000, request_bytes=2, response_bytes=100)
+        per_call = (time.time() - started) / 100000
+        started = time.time()
+        stats.report()
+        reported = time.time() - started
+        print("\nrecording a call: %.2f us, report: %.2f ms" % (per_call * 1e6, reported * 1000))
+        self.assertLess(per_call, 50e-6)
+
+    def test_gauges(self):
+        self.assertEqual(gauge_lines('sygnaller_terminal_stdin_queue', 'gauge', 'Queued stdin',
+                                     [({'session': 1}, 3), ({}, 0)]),
+                         ['# HELP sygnaller_terminal_stdin_queue Queued stdin',
+                          '# TYPE sygnaller_terminal_stdin_queue gauge',
+                          'sygnaller_terminal_stdin_queue{session="1"} 3',
+                          'sygnaller_terminal_stdin_queue 0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+from threading import Condition
+
+# default bounds for one run's output
+default_max_entries = 10000
+default_max_bytes = 4 * 1024 * 1024
+
+
+def _encoded_size(line):
+    """Bytes of a line as UTF-8, without encoding the (usual) ASCII ones"""
+    return len(line) if line.isascii() else len(line.encode('utf-8', 'surrogatepass'))
+
+
+class OutputLog:
+    """Bounded, append-only log of (fd, line) entries addressed by sequence number
+
+    Readers keep their own cursor (the sequence number of the next entry they
+    want), so any number of them can tail the same log without consuming it.
+    Once the entry or byte limit is reached the oldest entries are dropped.
+    """
+
+    def __init__(self, start_seq=0, max_entries=default_max_entries, max_bytes=default_max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ring = [None] * max_entries
+        self.first_seq = start_seq  # oldest entry still held
+        self.next_seq = start_seq  # sequence number of the next entry to be appended
+        self.size = 0  # bytes currently held
+        self.total_bytes = 0  # bytes ever appended
+        self.closed = False
+        self.condition = Condition()
+
+    def _evict(self):
+        fd, line = self.ring[self.first_seq % self.max_entries]
+        self.ring[self.first_seq % self.max_entries] = None
+        self.size -= _encoded_size(line)
+        self.first_seq += 1
+
+    def append(self, fd, line):
+        self.extend([(fd, line)])
+
+    def extend(self, entries):
+        """Append several (fd, line) entries, waking readers only once"""
+        with self.condition:
+            for fd, line in entries:
+                if self.next_seq - self.first_seq == self.max_entries:
+                    self._evict()
+                self.ring[self.next_seq % self.max_entries] = (fd, line)
+                self.next_seq += 1
+                size = _encoded_size(line)
+                self.size += size
+                self.total_bytes += size
+            while self.size > self.max_bytes and self.next_seq - self.first_seq > 1:
+                self._evict()
+            self.condition.notify_all()
+
+    def close(self):
+        """Mark the log as complete, waking up any waiting readers"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        return self.next_seq - self.first_seq
+
+    def read(self, since, wait=0):
+        """Return (entries from cursor onwards, next cursor, number of entries missed)
+
+        If there is nothing after the cursor yet, block for up to `wait`
+        seconds until something is appended or the log is closed.
+        """
+        with self.condition:
+            if wait > 0:
+                self.condition.wait_for(lambda: self.next_seq > since or self.closed, timeout=wait)
+            start = max(since, self.first_seq)
+            missed = max(self.first_seq - since, 0)
+            entries = [list(self.ring[seq % self.max_entries]) for seq in range(start, self.next_seq)]
+            return entries, self.next_seq, missed
+
+
+# *****************************************
+# Unit tests
+# *****************************************
+
+import unittest
+
+
+class TestOutputLog(unittest.TestCase):
+
+    def test_read_since(self):
+        log = OutputLog()
+        log.append(1, "a")
+        log.append(2, "b")
+        self.assertEqual(log.read(0), ([[1, "a"], [2, "b"]], 2, 0))
+        self.assertEqual(log.read(1), ([[2, "b"]], 2, 0))
+        self.assertEqual(log.read(2), ([], 2, 0))
+
+    def test_extend(self):
+        log = OutputLog(max_entries=2)
+        log.extend([(1, "a"), (1, "b"), (2, "c")])
+        self.assertEqual(log.read(0), ([[1, "b"], [2, "c"]], 3, 1))
+
+    def test_multiple_readers(self):
+        log = OutputLog()
+        log.append(1, "a")
+        first, cursor, _ = log.read(0)
+        log.append(1, "b")
+        # a reader that already saw "a" and a new reader both get what they need
+        self.assertEqual(log.read(cursor)[0], [[1, "b"]])
+        self.assertEqual(log.read(0)[0], [[1, "a"], [1, "b"]])
+
+    def test_entry_bound(self):
+        log = OutputLog(max_entries=3)
+        for i in range(5):
+            log.append(1, str(i))
+        self.assertEqual(len(log), 3)
+        self.assertEqual(log.read(0), ([[1, "2"], [1, "3"], [1, "4"]], 5, 2))
+
+    def test_byte_bound(self):
+        log = OutputLog(max_bytes=10)
+        for i in range(5):
+            log.append(1, "xxxx")
+        self.assertLessEqual(log.size, 10)
+        self.assertEqual(log.total_bytes, 20)
+        self.assertEqual(log.read(0)[0], [[1, "xxxx"], [1, "xxxx"]])
+
+        # counted as the UTF-8 sent to clients, not as characters
+        log = OutputLog()
+        log.append(1, "\u00e9t\u00e9 \u2603\n")
+        self.assertEqual(log.total_bytes, len("\u00e9t\u00e9 \u2603\n".encode('utf-8')))
+
+    def test_start_seq(self):
+        log = OutputLog(start_seq=7)
+        log.append(1, "a")
+        self.assertEqual(log.read(7), ([[1, "a"]], 8, 0))
+        self.assertEqual(log.read(3), ([[1, "a"]], 8, 4))
+
+    def test_wait(self):
+        from threading import Timer
+        from time import time
+        log = OutputLog()
+        Timer(0.2, log.append, (1, "late")).start()
+        started = time()
+        self.assertEqual(log.read(0, wait=5)[0], [[1, "late"]])
+        self.assertLess(time() - started, 2)
+
+    def test_wait_closed(self):
+        from time import time
+        log = OutputLog()
+        log.close()
+        started = time()
+        self.assertEqual(log.read(0, wait=5), ([], 0, 0))
+        self.assertLess(time() - started, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import os
+import shutil
+import resource
+from collections import deque
+from time import time
+
+clock_ticks = os.sysconf('SC_CLK_TCK')
+page_size = os.sysconf('SC_PAGE_SIZE')
+
+# cgroup v2 directory the daemon may create per-run groups in, if it exists
+cgroup_root = '/sys/fs/cgroup/sygnallerd'
+
+# how many samples are kept per run
+default_max_samples = 3600
+
+
+def read_proc(pid):
+    """CPU seconds, resident bytes, thread count and disk I/O of a process, or None if it has gone"""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()  # the command name may contain spaces
+    except (OSError, IndexError):
+        return None
+
+    io = {}
+    try:
+        with open('/proc/%d/io' % pid) as f:
+            for line in f:
+                key, value = line.split(':')
+                io[key] = int(value)
+    except OSError:
+        pass
+
+    return {
+        'cpu_time': (int(fields[11]) + int(fields[12])) / clock_ticks,
+        'threads': int(fields[17]),
+        'rss': int(fields[21]) * page_size,
+        'read_bytes': io.get('read_bytes', 0),
+        'write_bytes': io.get('write_bytes', 0)
+    }
+
+
+class StatsRecorder:
+    """Time series of resource usage for one process, sampled at a fixed interval"""
+
+    def __init__(self, interval=1, max_samples=default_max_samples):
+        self.interval = interval
+        self.samples = deque(maxlen=max_samples)
+        self.next_sample = time()
+        self.last_cpu = None  # (wall time, cpu seconds) of the previous sample
+
+    def time_to_next(self):
+        return max(self.next_sample - time(), 0)
+
+    def sample(self, pid, output_bytes):
+        now = time()
+        self.next_sample = now + self.interval
+        usage = read_proc(pid)
+        if usage is None:
+            return
+
+        cpu = 0
+        if self.last_cpu is not None and now > self.last_cpu[0]:
+            cpu = 100 * (usage['cpu_time'] - self.last_cpu[1]) / (now - self.last_cpu[0])
+        self.last_cpu = (now, usage['cpu_time'])
+
+        self.samples.append({
+            'time': now,
+            'cpu': round(cpu, 1),
+            'rss': usage['rss'],
+            'threads': usage['threads'],
+            'output_bytes': output_bytes,
+            'read_bytes': usage['read_bytes'],
+            'write_bytes': usage['write_bytes']
+        })
+
+    def series(self, since=0):
+        return [sample for sample in list(self.samples) if sample['time'] > since]
+
+
+def apply_rlimits(pid, memory=None, cpu_time=None):
+    """Cap a process's address space (bytes) and CPU time (seconds); pid 0 is the calling process"""
+    if memory is not None:
+        resource.prlimit(pid, resource.RLIMIT_AS, (memory, memory))
+    if cpu_time is not None:
+        # SIGXCPU at the soft limit gives the program a moment before the hard kill
+        resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_time, cpu_time + 5))
+
+
+def rlimit_command(cmd, memory=None, cpu_time=None):
+    """cmd run through prlimit(1) with the caps of apply_rlimits, or None if prlimit is not installed
+
+    The limits are in place before the program starts, without running any
+    Python between fork and exec in a daemon full of threads.
+    """
+    prlimit = shutil.which('prlimit')
+    if prlimit is None:
+        return None
+    prefix = [prlimit]
+    if memory is not None:
+        prefix.append('--as=%d:%d' % (memory, memory))
+    if cpu_time is not None:
+        prefix.append('--cpu=%d:%d' % (cpu_time, cpu_time + 5))
+    return prefix + ['--'] + list(cmd)
+
+
+def join_cgroup(name, pid, memory=None, cpu_quota=None):
+    """Move a process into its own cgroup with memory and CPU caps, if cgroups are available
+
+    cpu_quota is in cores, e.g. 0.5 for half of one core. Returns the group's
+    path, or None if the group could not be set up.
+    """
+    if not os.path.isdir(cgroup_root) or (memory is None and cpu_quota is None):
+        return None
+
+    path = os.path.join(cgroup_root, name)
+    try:
+        os.makedirs(path, exist_ok=True)
+        if memory is not None:
+            with open(os.path.join(path, 'memory.max'), 'w') as f:
+                f.write(str(memory))
+        if cpu_quota is not None:
+            with open(os.path.join(path, 'cpu.max'), 'w') as f:
+                f.write('%d 100000' % int(cpu_quota * 100000))
+        with open(os.path.join(path, 'cgroup.procs'), 'w') as f:
+            f.write(str(pid))
+    except OSError:
+        remove_cgroup(path)
+        return None
+    return path
+
+
+def remove_cgroup(path):
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+# *****************************************
+# Unit tests
+# *****************************************
+
+import unittest
+
+
+class TestProcessStats(unittest.TestCase):
+
+    def test_read_self(self):
+        usage = read_proc(os.getpid())
+        self.assertGreater(usage['rss'], 0)
+        self.assertGreaterEqual(usage['threads'], 1)
+
+    def test_read_missing(self):
+        self.assertIsNone(read_proc(2 ** 22 + 1))
+
+    def test_recorder(self):
+        recorder = StatsRecorder(interval=0.1, max_samples=3)
+        for i in range(5):
+            recorder.sample(os.getpid(), i)
+        series = recorder.series()
+        self.assertEqual([sample['output_bytes'] for sample in series], [2, 3, 4])
+        self.assertEqual(recorder.series(since=series[-1]['time']), [])
+        self.assertGreater(recorder.time_to_next(), 0)
+
+    def test_rlimits(self):
+        import subprocess
+        process = subprocess.Popen(['sleep', '5'])
+        try:
+            apply_rlimits(process.pid, memory=256 * 1024 * 1024, cpu_time=10)
+            self.assertEqual(resource.prlimit(process.pid, resource.RLIMIT_AS), (256 * 1024 * 1024,) * 2)
+            self.assertEqual(resource.prlimit(process.pid, resource.RLIMIT_CPU), (10, 15))
+        finally:
+            process.kill()
+            process.wait()
+
+    def test_rlimit_command(self):
+        import subprocess
+        cmd = rlimit_command(['python3', '-c', 'import resource; print(resource.getrlimit(resource.RLIMIT_AS), '
+                                               'resource.getrlimit(resource.RLIMIT_CPU))'],
+                             memory=512 * 1024 * 1024, cpu_time=10)
+        if cmd is None:
+            self.skipTest('prlimit is not installed')
+        self.assertEqual(subprocess.check_output(cmd), b'(536870912, 536870912) (10, 15)\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,153 +2,554 @@ import subprocess
 import os
 import shlex
 import signal
-from threading import Thread
+import selectors
+import itertools
+import traceback
+from threading import Thread, Lock, current_thread
 from time import sleep, time
 from queue import Queue
 
+import forkserver
+import process_stats
+from output_log import OutputLog
+from image_store import ImageStore, FrameReader
+
 base = '/home/xilinx/projects'
 
-# process variables
-start_time = 0
-running_process: subprocess.Popen = None
-stdin_buffer = Queue()
-output_buffer = Queue()
-handler_thread = None
-stdout_thread = None
-stderr_thread = None
+# how many programs may run side by side
+max_sessions = 2
+
+# how many finished sessions are kept so their output can still be read
+max_finished_sessions = 4
+
+# start programs from a pre-warmed interpreter instead of a fresh python3
+use_fork_server = False
+
+# longest a program may run for (seconds)
+max_run_time = 3600
+
+# per-run resource limits, None for no limit; a run may ask for tighter ones
+memory_limit = None  # address space in bytes
+cpu_time_limit = None  # CPU seconds
+cpu_quota = None  # share of CPU cores, only where cgroups are available
+
+# how often resource usage is sampled (seconds)
+stats_interval = 1
+
+# longest a terminal request may wait for output (seconds)
+max_terminal_wait = 30
+# long polls that can be held at the same time; further ones are answered straight away
+max_waiting_polls = 8
+
+waiting_polls = 0
+waiting_polls_lock = Lock()
 
+# longest partial line held back waiting for its end; longer ones are sent in pieces of this size
+max_line_bytes = 65536
 
 # output stream descriptors
 fd_stdout = 1
 fd_stderr = 2
 fd_imgout = 3
+fd_imgref = 4  # id of an image sent over the binary channel
+
+# session variables
+sessions = {}  # id -> Session, in order of creation
+sessions_lock = Lock()  # serialises changes to sessions
+starting = 0  # sessions being started, which count towards max_sessions
+session_ids = itertools.count(1)
+images = ImageStore()  # shared by all sessions, ids are unique
+forgotten_output_bytes = 0  # output of sessions no longer kept, so the total never goes down
+
+
+class Session:
+    """One run of a user program, with its own buffers and I/O loop"""
+
+    def __init__(self, session_id, project, target, cmd, start_seq=0, limits=None):
+        self.id = session_id
+        self.project = project
+        self.target = target
+        self.limits = limits or {}
+        self.start_time = time()
+        self.stats = process_stats.StatsRecorder(stats_interval)
+        self.image_bytes = 0
+        self.stdin_buffer = Queue()
+        self.log = OutputLog(start_seq=start_seq)
+        self.legacy_cursor = start_seq  # shared cursor for clients that do not track their own
+        self.legacy_cursor_lock = Lock()
+
+        # written to whenever stdin is queued, to wake up the I/O loop
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.wakeup_lock = Lock()
+
+        # binary channel for images, announced to sygnaller.terminal through the environment
+        image_r, image_w = os.pipe()
+        env = dict(os.environ, SYGNALLER_IMAGE_FD=str(image_w))
+
+        print("Starting Python process", target)
+        try:
+            self.process = _spawn(cmd, os.path.join(base, project, 'data'), env, image_w, self.limits)
+        except:
+            for fd in (image_r, self.wakeup_r, self.wakeup_w):
+                os.close(fd)
+            raise
+        finally:
+            os.close(image_w)
+
+        try:
+            self.cgroup = process_stats.join_cgroup('session%d' % self.id, self.process.pid,
+                                                    self.limits.get('memory'), self.limits.get('cpu_quota'))
+        except:
+            # never leave a program running that no session knows about
+            self.process.kill()
+            self.process.wait()
+            for fd in (image_r, self.wakeup_r, self.wakeup_w):
+                os.close(fd)
+            for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+                stream.close()
+            raise
+
+        # one thread multiplexes all of the standard streams
+        self.running = True
+        self.io_thread = Thread(target=self._handle_io, args=(image_r,))
+        self.io_thread.daemon = True
+        self.io_thread.start()
+
+    def describe(self):
+        return {
+            "session": self.id,
+            "project": self.project,
+            "target": self.target,
+            "start_time": self.start_time,
+            "running": self.running,
+            "limits": self.limits
+        }
+
+    def send_stdin(self, val):
+        self.stdin_buffer.put(val)
+        with self.wakeup_lock:
+            if self.wakeup_w is None:
+                return  # already finished
+            try:
+                os.write(self.wakeup_w, b'\0')
+            except BlockingIOError:
+                pass  # the loop already has a wakeup pending
+
+    def _handle_io(self, image_fd):
+        """Single loop serving stdin writes, stdout/stderr/image reads and process exit"""
+        process = self.process
+        log = self.log
+
+        selector = selectors.DefaultSelector()
+        streams = {process.stdout.fileno(): fd_stdout, process.stderr.fileno(): fd_stderr, image_fd: fd_imgref}
+        partial = {fd: bytearray() for fd in streams}
+        for fd in streams:
+            os.set_blocking(fd, False)
+            selector.register(fd, selectors.EVENT_READ)
+        frames = FrameReader(images.max_bytes)
+
+        stdin_fd = process.stdin.fileno()
+        os.set_blocking(stdin_fd, False)
+        pending_stdin = b''
+        selector.register(self.wakeup_r, selectors.EVENT_READ)
+
+        # a pidfd becomes readable when the process exits, otherwise fall back to polling
+        exit_fd = None
+        if hasattr(os, 'pidfd_open'):
+            try:
+                exit_fd = os.pidfd_open(process.pid)
+                selector.register(exit_fd, selectors.EVENT_READ)
+            except OSError:
+                exit_fd = None
+
+        def read_stream(fd):
+            """Read what is available: True if there was data, False at end of file, None if there is none yet"""
+            try:
+                chunk = os.read(fd, 65536)
+            except BlockingIOError:
+                return None
+            if fd == image_fd:
+                for mime, payload in frames.feed(chunk):
+                    self.image_bytes += len(payload)
+                    log.append(fd_imgref, str(images.add(mime, payload)))
+            else:
+                pending = partial[fd]
+                if chunk and b'\n' not in chunk and b'\r' not in chunk and not pending.endswith(b'\r'):
+                    # the line goes on: only the new bytes need looking at
+                    pending += chunk
+                    lines = []
+                else:
+                    lines, rest = _split_lines(bytes(pending) + chunk, final=chunk == b'')
+                    pending[:] = rest
+                while len(pending) > max_line_bytes:
+                    lines.append(_cut_line(pending, max_line_bytes))
+                log.extend(_output_entries(streams[fd], lines))
+            return chunk != b''
+
+        try:
+            interrupted_at = None
+            while process.poll() is None:
+                timeout = min(1 if exit_fd is not None else 0.1, self.stats.time_to_next())
+                for key, events in selector.select(timeout=timeout):
+                    fd = key.fd
+                    if fd in streams:
+                        if read_stream(fd) is False:
+                            selector.unregister(fd)
+                    elif fd == self.wakeup_r:
+                        try:
+                            os.read(self.wakeup_r, 4096)
+                        except BlockingIOError:
+                            pass
+                        had_pending = pending_stdin != b''
+                        while not self.stdin_buffer.empty():
+                            val = self.stdin_buffer.get_nowait()
+                            print("Stdin:", val)
+                            pending_stdin += val.encode('utf-8')
+                        if pending_stdin and not had_pending:
+                            selector.register(stdin_fd, selectors.EVENT_WRITE)
+                    elif fd == stdin_fd:
+                        try:
+                            pending_stdin = pending_stdin[os.write(stdin_fd, pending_stdin):]
+                        except BlockingIOError:
+                            pass
+                        except OSError:
+                            pending_stdin = b''  # program closed its stdin
+                        if not pending_stdin:
+                            selector.unregister(stdin_fd)
+
+                if self.stats.time_to_next() == 0:
+                    self.stats.sample(process.pid, log.total_bytes + self.image_bytes)
+
+                # enforce the time limit: interrupt first, then kill if it is ignored
+                if interrupted_at is None and time() > self.start_time + max_run_time:
+                    interrupted_at = time()
+                    process.send_signal(signal.SIGINT)
+                elif interrupted_at is not None and time() > interrupted_at + 5:
+                    process.kill()
+
+            # pick up whatever was written just before exiting; only what is already there, as a
+            # process the program left running in the background may keep the pipes open
+            for fd in streams:
+                if fd in selector.get_map():
+                    while read_stream(fd):
+                        pass
+                if partial[fd]:
+                    lines, partial[fd] = _split_lines(partial[fd], final=True)
+                    log.extend(_output_entries(streams[fd], lines))
+        except Exception as e:
+            print("I/O loop failed:", type(e).__name__, e)
+            traceback.print_exc()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        finally:
+            selector.close()
+            os.close(image_fd)
+            if self.cgroup is not None:
+                process_stats.remove_cgroup(self.cgroup)
+            if exit_fd is not None:
+                os.close(exit_fd)
+            for stream in (process.stdin, process.stdout, process.stderr):
+                stream.close()
+            with self.wakeup_lock:
+                os.close(self.wakeup_r)
+                os.close(self.wakeup_w)
+                self.wakeup_w = None
+
+            print("Python process exited")
+            log.append(fd_stderr, "Program terminated.")
+            self.running = False
+            log.close()
+
+    def stop(self):
+        if not self.running:
+            return
+
+        _interrupt(self.process)
+
+        if self.io_thread is not current_thread():
+            self.io_thread.join()  # wait for it to close
+
+
+def _spawn(cmd, cwd, env, image_fd, limits):
+    """Start a program with its resource limits already in place when it starts running"""
+    memory, cpu_time = limits.get('memory'), limits.get('cpu_time')
+    if use_fork_server:
+        try:
+            return forkserver.spawn(cmd, cwd, env, image_fd, {'memory': memory, 'cpu_time': cpu_time})
+        except Exception as e:
+            print("Fork server unavailable, starting cold:", type(e).__name__, e)
+
+    preexec_fn = None
+    if memory is not None or cpu_time is not None:
+        limited = process_stats.rlimit_command(cmd, memory, cpu_time)
+        if limited is not None:
+            cmd = limited
+        else:
+            # not safe with other threads running, so only as a last resort
+            preexec_fn = lambda: process_stats.apply_rlimits(0, memory, cpu_time)
+
+    return subprocess.Popen(cmd,
+                            cwd=cwd,
+                            bufsize=0,
+                            env=env,
+                            pass_fds=(image_fd,),
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            preexec_fn=preexec_fn)
+
+
+def warm_up():
+    """Get the fork server importing in the background so the first run is already fast"""
+    if use_fork_server:
+        Thread(target=forkserver.start, daemon=True).start()
 
 
 def is_running():
-    return running_process is not None
+    return any(session.running for session in list(sessions.values()))
 
 
-def run_python(data):
-    global running_process, handler_thread, stdout_thread, stderr_thread, start_time
+def _latest():
+    with sessions_lock:
+        return next(reversed(sessions.values()), None)
+
+
+def _find_session(data):
+    """The session a request refers to, defaulting to the most recently started one"""
+    if data is not None and data.get('session') is not None:
+        return sessions.get(int(data['session']))
+    return _latest()
 
-    if is_running():
-        return {'error': 'Process already running'}
 
+def run_python(data):
+    global forgotten_output_bytes, starting
     target_py = os.path.join(base, data['project'], data['target'])
 
-    # command with optional arguments
-    cmd = ['python3', '-u', target_py]
+    # command with optional arguments; the resolved path keeps the whole run,
+    # imports included, on the snapshot that was current when it started
+    cmd = ['python3', '-u', os.path.realpath(target_py)]
     if 'args' in data and data['args'] != '':
         cmd += shlex.split(data['args'])
 
-    # open process
-    print("Starting Python process", target_py)
-    start_time = time()
-    running_process = subprocess.Popen(cmd,
-                                       cwd=os.path.join(base, data['project'], 'data'),
-                                       bufsize=0,
-                                       universal_newlines=True,
-                                       stdin=subprocess.PIPE,
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE)
-
-    while not stdin_buffer.empty():
-        stdin_buffer.get(False)
-    while not output_buffer.empty():
-        output_buffer.get(False)
-
-    # start handling standard streams
-    handler_thread = Thread(target=_handle_subprocess)
-    handler_thread.daemon = True
-    handler_thread.start()
-    # stdout
-    stdout_thread = Thread(target=_handle_stdout)
-    stdout_thread.daemon = True
-    stdout_thread.start()
-    # stderr
-    stderr_thread = Thread(target=_handle_stderr)
-    stderr_thread.daemon = True
-    stderr_thread.start()
+    try:
+        limits = _run_limits(data)
+    except (TypeError, ValueError):
+        return {'error': 'Invalid limits'}
 
-    return {}
+    with sessions_lock:
+        if sum(session.running for session in sessions.values()) + starting >= max_sessions:
+            return {'error': 'Process already running'}
+        starting += 1
 
+        # sequence numbers carry on from the previous session so old cursors stay meaningful
+        previous = next(reversed(sessions.values()), None)
+        start_seq = previous.log.next_seq if previous is not None else 0
+        session_id = next(session_ids)
 
-def _handle_subprocess():
-    global running_process, handler_thread
+    # starting the program can take a while, so other requests are not held up meanwhile
+    try:
+        session = Session(session_id, data['project'], target_py, cmd, start_seq, limits)
+    finally:
+        with sessions_lock:
+            starting -= 1
+
+    with sessions_lock:
+        sessions[session.id] = session
+
+        # forget the oldest finished sessions
+        finished = [s for s in sessions.values() if not s.running]
+        for old in finished[:max(len(finished) - max_finished_sessions, 0)]:
+            forgotten_output_bytes += old.log.total_bytes
+            del sessions[old.id]
+
+    return {'session': session.id}
+
+
+def _run_limits(data):
+    """Configured limits, tightened by any the run asks for; ValueError if one is not a positive number"""
+    limits = {}
+    for key, field, default, kind in (('memory', 'memory_limit', memory_limit, int),
+                                      ('cpu_time', 'cpu_time_limit', cpu_time_limit, int),
+                                      ('cpu_quota', 'cpu_quota', cpu_quota, float)):
+        values = [kind(value) for value in (default, data.get(field)) if value is not None]
+        if any(value <= 0 for value in values):
+            raise ValueError("Invalid %s" % field)
+        if values:
+            limits[key] = min(values)
+    return limits
+
+
+def python_stats(data):
+    session = _find_session(data)
+    if session is None:
+        return {'error': 'No such session'}
+    return {
+        'session': session.id,
+        'running': session.running,
+        'interval': session.stats.interval,
+        'limits': session.limits,
+        'samples': session.stats.series(float(data.get('since') or 0))
+    }
 
-    while running_process is not None and running_process.poll() is None:  # is still running
-        while not stdin_buffer.empty():
-            val = stdin_buffer.get_nowait()
-            print("Stdin:", val)
-            running_process.stdin.write(val)
-        sleep(0.1)
-        if time() > start_time + 3600:
-            stop_python()
 
-    print("Python process exited")
-    output_buffer.put((fd_stderr, "Program terminated."))
-    running_process = None
-    handler_thread = None
+def list_sessions(data):
+    with sessions_lock:
+        return {'sessions': [session.describe() for session in sessions.values()]}
+
+
+def terminal_metrics():
+    """Per session queued stdin writes and output entries held, and bytes of output of all runs so far"""
+    with sessions_lock:
+        kept = list(sessions.values())
+        output_bytes = forgotten_output_bytes + sum(session.log.total_bytes for session in kept)
+    return {
+        'sessions': [{
+            'session': session.id,
+            'running': session.running,
+            'stdin_queue': session.stdin_buffer.qsize(),
+            'output_entries': len(session.log),
+            'output_bytes': session.log.total_bytes
+        } for session in kept],
+        'output_bytes': output_bytes
+    }
 
 
-def _handle_stdout():
-    global stdout_thread
+def _split_lines(data, final=False):
+    """Split bytes into complete lines of text and the incomplete remainder
 
-    while running_process is not None and running_process.poll() is None:  # is still running
-        line = running_process.stdout.readline()
-        if line != '':
-            if line.startswith('~data:image'):
-                output_buffer.put((fd_imgout, line[1:]))
-            else:
-                output_buffer.put((fd_stdout, line))  # blocking
-    stdout_thread = None
+    Like universal newlines, \\r, \\n and \\r\\n all end a line and become \\n.
+    """
+    lines = data.splitlines(True)
+    rest = b''
+    if lines and not final:
+        # a trailing \\r may be the first half of \\r\\n
+        if not lines[-1].endswith((b'\n', b'\r')) or data.endswith(b'\r'):
+            rest = lines.pop()
 
+    text = []
+    for line in lines:
+        if line.endswith(b'\r\n'):
+            line = line[:-2] + b'\n'
+        elif line.endswith(b'\r'):
+            line = line[:-1] + b'\n'
+        text.append(line.decode('utf-8', 'replace'))
+    return text, rest
 
-def _handle_stderr():
-    global stderr_thread
 
-    while running_process is not None and running_process.poll() is None:  # is still running
-        line = running_process.stderr.readline()
-        if line != '':
-            output_buffer.put((fd_stderr, line))  # blocking
-    stderr_thread = None
+def _cut_line(pending, size):
+    """Take a piece of at most size bytes, ending on a whole UTF-8 character, off the front of a long line"""
+    cut = size
+    while cut > size - 3 and pending[cut] & 0xc0 == 0x80:
+        cut -= 1
+    piece = pending[:cut].decode('utf-8', 'replace')
+    del pending[:cut]
+    return piece
 
 
-def stop_python():
-    global running_process, handler_thread, stdout_thread, stderr_thread
+def _output_entries(fd, lines):
+    if fd != fd_stdout:
+        return [(fd, line) for line in lines]
+    return [(fd_imgout, line[1:]) if line.startswith('~data:image') else (fd_stdout, line) for line in lines]
 
-    if running_process is None:
-        return {}
 
-    os.kill(running_process.pid, signal.SIGINT)
+def _interrupt(process):
+    try:
+        os.kill(process.pid, signal.SIGINT)
+    except ProcessLookupError:
+        return
 
     try:
-        running_process.wait(timeout=5000)
+        process.wait(timeout=5000)
     except:
-        running_process.kill()
+        process.kill()
+
 
-    if handler_thread is not None:
-        handler_thread.join()  # wait for it to close
-    if stdout_thread is not None:
-        stdout_thread.join()
-    if stderr_thread is not None:
-        stderr_thread.join()
+def stop_python(data=None):
+    with sessions_lock:
+        if data is not None and data.get('session') is not None:
+            to_stop = [sessions[int(data['session'])]] if int(data['session']) in sessions else []
+        else:
+            to_stop = list(sessions.values())  # stop everything
+
+    for session in to_stop:
+        session.stop()
 
     return {}
 
 
-def terminal(data):
-    response = {
-        "output": [],
-        "running": running_process is not None
+def get_image(data):
+    image = images.get(int(data['id']))
+    if image is None:
+        return {'error': 'Image not found'}
+    mime, payload = image
+    return {
+        'content': payload,
+        'content-type': mime
     }
-    if 'stdin' in data and data['stdin'] is not None:
-        stdin_buffer.put(data['stdin'])
-    while not output_buffer.empty():
-        fd, data = output_buffer.get_nowait()
-        response["output"].append([fd, data])
 
-    return response
+
+def _hold_poll():
+    """Take one of the max_waiting_polls slots, so long polls never hold every HTTP worker"""
+    global waiting_polls
+    with waiting_polls_lock:
+        if waiting_polls >= max_waiting_polls:
+            return False
+        waiting_polls += 1
+        return True
+
+
+def _release_poll():
+    global waiting_polls
+    with waiting_polls_lock:
+        waiting_polls -= 1
+
+
+def terminal(data):
+    session = _find_session(data)
+    if session is None:
+        return {
+            "output": [],
+            "running": False,
+            "cursor": 0,
+            "missed": 0
+        }
+
+    if 'stdin' in data and data['stdin'] is not None:
+        if not isinstance(data['stdin'], str):
+            return {'error': 'Invalid stdin'}
+        session.send_stdin(data['stdin'])
+
+    # long poll: hold the request until there is output to send
+    log = session.log
+    wait = min(float(data.get('wait') or 0), max_terminal_wait)
+    if not session.running:
+        wait = 0
+    if wait > 0 and not _hold_poll():
+        wait = 0
+    try:
+        if data.get('since') is not None:
+            output, cursor, missed = log.read(int(data['since']), wait)
+        else:
+            # clients without a cursor get everything since the last such poll
+            if wait > 0:
+                log.read(session.legacy_cursor, wait)
+            with session.legacy_cursor_lock:
+                output, cursor, missed = log.read(session.legacy_cursor)
+                session.legacy_cursor = cursor
+    finally:
+        if wait > 0:
+            _release_poll()
+
+    return {
+        "session": session.id,
+        "output": output,
+        "running": session.running,
+        "cursor": cursor,
+        "missed": missed
+    }
 
 
 # *****************************************
@@ -171,6 +572,15 @@ print('hello')
 sleep(3)
 """)
 
+    def tearDown(self):
+        stop_python()
+
+    def test_split_lines(self):
+        self.assertEqual(_split_lines(b'a\nb\r\nc'), (['a\n', 'b\n'], b'c'))
+        self.assertEqual(_split_lines(b'a\r'), ([], b'a\r'))
+        self.assertEqual(_split_lines(b'a\rb\n'), (['a\n', 'b\n'], b''))
+        self.assertEqual(_split_lines(b'prompt: ', final=True), (['prompt: '], b''))
+
     def test_no_running(self):
         self.assertFalse(is_running())
 
@@ -194,20 +604,386 @@ sleep(3)
         })
 
         # check
-        self.assertEqual(terminal({}), {
-            "output": [
-                [fd_stdout, "hello"]
-            ],
-            "running": True
-        })
+        result = terminal({"wait": 10})
+        self.assertEqual(result["output"], [
+            [fd_stdout, "hello\n"]
+        ])
+        self.assertTrue(result["running"])
         sleep(5)
-        self.assertEqual(terminal({}), {
-            "output": [
-                [fd_stderr, "Program terminated."]
-            ],
-            "running": False
+        result = terminal({})
+        self.assertEqual(result["output"], [
+            [fd_stderr, "Program terminated."]
+        ])
+        self.assertFalse(result["running"])
+
+    def test_background_child(self):
+        with open("/home/xilinx/projects/_test_dummy/main.py", 'w') as f:
+            f.write("""
+import subprocess
+subprocess.Popen(['sleep', '4'])
+print('bye')
+""")
+        session = sessions[run_python({
+            "project": "_test_dummy",
+            "target": "main.py"
+        })["session"]]
+        # finishes with the program, although sleep still holds its output open
+        session.io_thread.join(2)
+        self.assertFalse(session.running)
+        self.assertEqual(terminal({"session": session.id, "since": 0})["output"],
+                         [[fd_stdout, "bye\n"], [fd_stderr, "Program terminated."]])
+
+    def test_terminal_cursor(self):
+        with open("/home/xilinx/projects/_test_dummy/main.py", 'w') as f:
+            f.write("""
+print('one')
+print('two')
+""")
+        session = run_python({
+            "project": "_test_dummy",
+            "target": "main.py"
+        })["session"]
+        start = sessions[session].log.first_seq
+        sleep(2)
+
+        # readers with their own cursor do not consume each other's output
+        first = terminal({"since": start})
+        second = terminal({"since": start})
+        self.assertEqual(first, second)
+        self.assertEqual(first["output"], [
+            [fd_stdout, "one\n"],
+            [fd_stdout, "two\n"],
+            [fd_stderr, "Program terminated."]
+        ])
+        self.assertEqual(terminal({"since": first["cursor"]})["output"], [])
+        self.assertEqual(terminal({"since": start + 1})["output"][0], [fd_stdout, "two\n"])
+
+    def test_terminal_wait(self):
+        with open("/home/xilinx/projects/_test_dummy/main.py", 'w') as f:
+            f.write("""
+from time import sleep
+sleep(1)
+print('late')
+sleep(1)
+""")
+        run_python({
+            "project": "_test_dummy",
+            "target": "main.py"
+        })
+
+        # returns as soon as the line is printed, not at the end of the wait
+        started = time()
+        result = terminal({"wait": 10})
+        self.assertLess(time() - started, 5)
+        self.assertEqual(result["output"], [[fd_stdout, "late\n"]])
+        stop_python()
+
+    def test_terminal_wait_not_running(self):
+        started = time()
+        terminal({"wait": 10})
+        self.assertLess(time() - started, 1)
+
+    def test_waiting_polls_capped(self):
+        global waiting_polls
+        session = run_python({
+            "project": "_test_dummy",
+            "target": "main.py"
+        })["session"]
+        cursor = terminal({"since": sessions[session].log.first_seq, "wait": 5})["cursor"]
+
+        # every slot taken: the poll is answered straight away
+        waiting_polls = max_waiting_polls
+        try:
+            started = time()
+            self.assertEqual(terminal({"since": cursor, "wait": 2})["output"], [])
+            self.assertLess(time() - started, 1)
+        finally:
+            waiting_polls = 0
+
+        started = time()
+        terminal({"since": cursor, "wait": 0.5})
+        self.assertGreaterEqual(time() - started, 0.5)
+        self.assertEqual(waiting_polls, 0)
+
+    def test_invalid_stdin(self):
+        session = run_python({
+            "project": "_test_dummy",
+            "target": "main.py"
+        })["session"]
+        self.assertEqual(terminal({"session": session, "stdin": 5}), {'error': 'Invalid stdin'})
+        self.assertTrue(sessions[session].io_thread.is_alive())
+
+    def test_io_loop_failure(self):
+        session = run_python({
+            "project": "_test_dummy",
+            "target": "main.py"
+        })["session"]
+        # whatever goes wrong in the loop, the session is torn down and its slot given back
+        sessions[session].send_stdin(5)
+        sessions[session].io_thread.join(5)
+        self.assertFalse(sessions[session].running)
+        self.assertFalse(is_running())
+        self.assertIsNotNone(sessions[session].process.poll())
+        output = terminal({"session": session, "since": 0})["output"]
+        self.assertEqual(output[-1], [fd_stderr, "Program terminated."])
+
+    def test_long_line(self):
+        with open("/home/xilinx/projects/_test_dummy/main.py", 'w') as f:
+            f.write("import sys\nsys.stdout.write('\u00e9' * 300000)\nsys.stdout.flush()\n")
+        session = run_python({
+            "project": "_test_dummy",
+            "target": "main.py"
+        })["session"]
+        sessions[session].io_thread.join(10)
+        output = terminal({"session": session, "since": 0})["output"]
+        # sent in bounded pieces, none of them splitting a character
+        pieces = [line for fd, line in output if fd == fd_stdout]
+        self.assertEqual(''.join(pieces), '\u00e9' * 300000)
+        self.assertTrue(all(len(piece.encode('utf-8')) <= max_line_bytes for piece in pieces))
+
+    def test_benchmark_throughput(self):
+        count = 100000
+        with open("/home/xilinx/projects/_test_dummy/main.py", 'w') as f:
+            f.write("for i in range(%d):\n    print(i)\n" % count)
+        started = time()
+        session = run_python({
+            "project": "_test_dummy",
+            "target": "main.py"
+        })["session"]
+        start = sessions[session].log.first_seq
+        while is_running():
+            sleep(0.01)
+        elapsed = time() - started
+        lines = sessions[session].log.next_seq - start - 1
+        print("\nthroughput: %d lines in %.2f s (%.0f lines/s)" % (lines, elapsed, lines / elapsed))
+        self.assertEqual(lines, count)
+
+    def test_benchmark_stdin_latency(self):
+        with open("/home/xilinx/projects/_test_dummy/main.py", 'w') as f:
+            f.write("while True:\n    print(input())\n")
+        session = run_python({
+            "project": "_test_dummy",
+            "target": "main.py"
+        })["session"]
+        cursor = sessions[session].log.first_seq
+        latencies = []
+        for i in range(20):
+            started = time()
+            terminal({"stdin": "%d\n" % i, "since": cursor})
+            result = terminal({"since": cursor, "wait": 5})
+            latencies.append(time() - started)
+            self.assertEqual(result["output"], [[fd_stdout, "%d\n" % i]])
+            cursor = result["cursor"]
+        stop_python()
+        latencies.sort()
+        print("\nstdin round trip: %.1f ms median, %.1f ms max"
+              % (latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000))
+
+    def test_image_channel(self):
+        import transfer
+        transfer.upload_files({
+            "project": "_test_dummy",
+            "directory": "data",
+            "files": []
+        })
+        with open("/home/xilinx/projects/_test_dummy/data/pixel.png", 'wb') as f:
+            f.write(b'\x89PNG fake image' * 100000)
+        with open("/home/xilinx/projects/_test_dummy/main.py", 'w') as f:
+            f.write("""
+import sys
+sys.path.append('/home/xilinx/projects/_test_dummy/software')
+from sygnaller.terminal import imageFromFile
+print('before')
+imageFromFile('pixel.png')
+print('after')
+""")
+        session = run_python({
+            "project": "_test_dummy",
+            "target": "main.py"
+        })["session"]
+        start = sessions[session].log.first_seq
+        while is_running():
+            sleep(0.1)
+
+        output = terminal({"since": start})["output"]
+        self.assertIn([fd_stdout, "before\n"], output)
+        self.assertIn([fd_stdout, "after\n"], output)
+        refs = [line for fd, line in output if fd == fd_imgref]
+        self.assertEqual(len(refs), 1)
+        self.assertEqual(get_image({"id": refs[0]}), {
+            "content": b'\x89PNG fake image' * 100000,
+            "content-type": "image/png"
         })
 
+    def test_sessions(self):
+        with open("/home/xilinx/projects/_test_dummy/other.py", 'w') as f:
+            f.write("""
+from time import sleep
+print('other')
+sleep(3)
+""")
+        first = run_python({
+            "project": "_test_dummy",
+            "target": "main.py"
+        })["session"]
+        second = run_python({
+            "project": "_test_dummy",
+            "target": "other.py"
+        })["session"]
+        self.assertNotEqual(first, second)
+
+        # capped at max_sessions
+        self.assertEqual(run_python({
+            "project": "_test_dummy",
+            "target": "main.py"
+        }), {"error": "Process already running"})
+        self.assertEqual([s["running"] for s in list_sessions({})["sessions"][-2:]], [True, True])
+
+        # each session has its own output
+        sleep(1)
+        self.assertEqual(terminal({"session": first, "since": 0})["output"], [[fd_stdout, "hello\n"]])
+        self.assertEqual(terminal({"session": second, "since": 0})["output"], [[fd_stdout, "other\n"]])
+
+        # and can be stopped on its own
+        stop_python({"session": first})
+        self.assertFalse(sessions[first].running)
+        self.assertTrue(sessions[second].running)
+
+    def test_terminal_metrics(self):
+        before = terminal_metrics()['output_bytes']
+        session = run_python({
+            "project": "_test_dummy",
+            "target": "main.py"
+        })["session"]
+        sleep(1)
+        metrics = terminal_metrics()
+        current = [s for s in metrics['sessions'] if s['session'] == session][0]
+        self.assertTrue(current['running'])
+        self.assertEqual(current['stdin_queue'], 0)
+        self.assertEqual(current['output_entries'], 1)
+        self.assertEqual(current['output_bytes'], len('hello\n'))
+        self.assertEqual(metrics['output_bytes'], before + len('hello\n'))
+
+    def test_fork_server(self):
+        global use_fork_server
+        use_fork_server = True
+        forkserver.start()
+        try:
+            session = run_python({
+                "project": "_test_dummy",
+                "target": "main.py",
+                "args": "x"
+            })["session"]
+            self.assertIsInstance(sessions[session].process, forkserver.WarmProcess)
+            start = sessions[session].log.first_seq
+            self.assertEqual(terminal({"session": session, "since": start, "wait": 10})["output"],
+                             [[fd_stdout, "hello\n"]])
+            stop_python({"session": session})
+            self.assertFalse(sessions[session].running)
+        finally:
+            use_fork_server = False
+            forkserver.stop()
+
+    def test_limits_from_start(self):
+        global use_fork_server
+        with open("/home/xilinx/projects/_test_dummy/main.py", 'w') as f:
+            f.write("""
+import resource
+print(resource.getrlimit(resource.RLIMIT_AS)[0], resource.getrlimit(resource.RLIMIT_CPU)[0])
+""")
+        try:
+            forkserver.start()
+            for use_fork_server in (False, True):
+                session = run_python({
+                    "project": "_test_dummy",
+                    "target": "main.py",
+                    "memory_limit": 1e9,
+                    "cpu_time_limit": 60
+                })["session"]
+                output = terminal({"session": session, "since": sessions[session].log.first_seq, "wait": 10})
+                self.assertEqual(output["output"][0], [fd_stdout, "1000000000 60\n"])
+                sessions[session].io_thread.join(5)
+        finally:
+            use_fork_server = False
+            forkserver.stop()
+
+    def test_fork_server_not_ready(self):
+        global use_fork_server
+        use_fork_server = True
+        forkserver.stop()
+        try:
+            # the server is still importing, so this run starts cold rather than waiting
+            started = time()
+            session = run_python({
+                "project": "_test_dummy",
+                "target": "main.py"
+            })["session"]
+            self.assertLess(time() - started, 1)
+            self.assertNotIsInstance(sessions[session].process, forkserver.WarmProcess)
+        finally:
+            use_fork_server = False
+            forkserver.stop()
+
+    def test_stats(self):
+        with open("/home/xilinx/projects/_test_dummy/main.py", 'w') as f:
+            f.write("""
+from time import time
+data = bytearray(32 * 1024 * 1024)
+end = time() + 2.5
+while time() < end:
+    pass
+print('done')
+""")
+        session = run_python({
+            "project": "_test_dummy",
+            "target": "main.py",
+            "memory_limit": 1024 * 1024 * 1024
+        })["session"]
+        sleep(2)
+        stats = python_stats({"session": session})
+        self.assertEqual(stats["limits"], {"memory": 1024 * 1024 * 1024})
+        self.assertGreaterEqual(len(stats["samples"]), 1)
+        last = stats["samples"][-1]
+        self.assertGreater(last["rss"], 32 * 1024 * 1024)
+        self.assertGreater(last["cpu"], 50)
+        self.assertEqual(python_stats({"session": session, "since": last["time"]})["samples"], [])
+
+    def test_memory_limit(self):
+        with open("/home/xilinx/projects/_test_dummy/main.py", 'w') as f:
+            f.write("""
+from time import sleep
+sleep(0.5)
+data = bytearray(512 * 1024 * 1024)
+print('allocated')
+""")
+        session = run_python({
+            "project": "_test_dummy",
+            "target": "main.py",
+            "memory_limit": 256 * 1024 * 1024
+        })["session"]
+        start = sessions[session].log.first_seq
+        while sessions[session].running:
+            sleep(0.1)
+        output = "".join(line for fd, line in terminal({"session": session, "since": start})["output"])
+        self.assertIn("MemoryError", output)
+        self.assertNotIn("allocated", output)
+
+    def test_invalid_limits(self):
+        self.assertEqual(run_python({
+            "project": "_test_dummy",
+            "target": "main.py",
+            "memory_limit": "lots"
+        }), {"error": "Invalid limits"})
+        self.assertEqual(run_python({
+            "project": "_test_dummy",
+            "target": "main.py",
+            "cpu_time_limit": -1
+        }), {"error": "Invalid limits"})
+        self.assertFalse(is_running())
+
+        # floats are taken as whole bytes / seconds
+        self.assertEqual(_run_limits({"memory_limit": 5e8, "cpu_time_limit": 2.5}), {"memory": 500000000, "cpu_time": 2})
+
     def test_stopping(self):
         run_python({
             "project": "_test_dummy",
@@ -1,11 +1,89 @@
 import os
 import pwd
 import base64
+import json
+import time
+import hashlib
+import shutil
+import tarfile
+import uuid
+from contextlib import contextmanager
+from threading import Lock, Thread
 
 base = '/home/xilinx/projects'
 
 userid = pwd.getpwnam('xilinx')
 
+# tar member listing files to keep that were not re-sent
+keep_list_name = '.sygnaller-keep'
+
+# per-project record of the source files the daemon has written
+index_name = '.sygnaller-index.json'
+index_lock = Lock()
+
+# software and hardware are symlinks to the current one of their last few snapshots
+snapshot_categories = ['software', 'hardware']
+snapshots_name = '.snapshots'
+keep_snapshots = 5
+
+# the daemon's own files and directories in a project, which are not project content
+internal_names = {index_name, snapshots_name, '.overlay-download', '.overlay-cached'}
+snapshot_locks = {}  # project directory -> Lock, held while a snapshot is picked or switched to
+snapshot_locks_lock = Lock()  # also guards snapshots_deleting
+snapshots_deleting = set()  # old snapshot directories being deleted in the background
+
+# partially uploaded files, kept across daemon restarts
+uploads_dir = os.path.join(base, '.uploads')
+max_chunk_size = 8 * 1024 * 1024
+upload_expiry = 7 * 24 * 3600  # seconds before an abandoned upload is removed
+upload_locks = {}  # upload id -> Lock
+upload_locks_lock = Lock()
+
+# path -> (size, mtime, sha256) of files hashed so far
+hash_cache = {}
+hash_cache_lock = Lock()
+
+# sygnaller.terminal, the API user programs use to talk to the IDE
+terminal_api = """
+import os
+import sys
+import base64
+import struct
+import mimetypes
+from threading import Lock
+
+# binary channel to the daemon, if it opened one for this run
+_image_fd = int(os.environ['SYGNALLER_IMAGE_FD']) if 'SYGNALLER_IMAGE_FD' in os.environ else None
+_image_lock = Lock()
+
+def _sendImage(mime, payload):
+    if _image_fd is None:
+        print("~data:" + mime + ";base64," + base64.b64encode(payload).decode('utf-8'))
+        return
+    header = mime.encode('ascii')
+    frame = memoryview(struct.pack('>HI', len(header), len(payload)) + header + payload)
+    with _image_lock:
+        while frame:
+            frame = frame[os.write(_image_fd, frame):]
+
+def error(msg):
+    print(msg, file=sys.stderr)
+
+def imageFromDataURI(uri):
+    print("~"+uri)
+    
+def imageFromFile(filename):
+    with open(filename, "rb") as f:
+        _sendImage(mimetypes.guess_type(filename)[0] or 'image', f.read())
+
+def showFigure(plt):
+    import io
+    buf = io.BytesIO()
+    plt.gcf().savefig(buf, format='png')
+    _sendImage('image/png', buf.getvalue())
+
+"""
+
 
 def fix_owner_and_permissions(path):
     try:
@@ -15,80 +93,668 @@ def fix_owner_and_permissions(path):
         pass
 
 
-def upload_files(data):
+def _ensure_owner_and_permissions(path):
+    """fix_owner_and_permissions, skipped when the path is already right"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    if stat.st_mode & 0o777 != 0o777 or stat.st_uid != userid.pw_uid or stat.st_gid != userid.pw_gid:
+        fix_owner_and_permissions(path)
+
+
+def file_hash(path):
+    """SHA-256 of a file, only re-read when its size or mtime have changed"""
+    stat = os.stat(path)
+    with hash_cache_lock:
+        cached = hash_cache.get(path)
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with hash_cache_lock:
+        hash_cache[path] = (stat.st_size, stat.st_mtime_ns, digest)
+    return digest
+
+
+def project_manifest(data):
+    """Hashes of every file in a project (or one of its directories), keyed by project-relative path"""
     project_dir = os.path.join(base, data['project'])
-    data_dir = os.path.join(base, data['project'], 'data')
-    api_dir = os.path.join(base, data['project'], 'software', 'sygnaller')
+    if data.get('directory'):
+        tops = [os.path.join(project_dir, data['directory'])]
+    else:
+        # the snapshotted directories are symlinks, which os.walk does not follow
+        tops = [project_dir] + [os.path.join(project_dir, category) for category in snapshot_categories]
+
+    manifest = {}
+    for top in tops:
+        for r, d, f in os.walk(top):
+            if r == project_dir:
+                d[:] = [name for name in d if name not in internal_names]
+                f = [name for name in f if name not in internal_names]
+            for file in f:
+                if file.endswith('.uploading'):
+                    continue  # being written
+                fullpath = os.path.join(r, file)
+                try:
+                    manifest[os.path.relpath(fullpath, project_dir)] = file_hash(fullpath)
+                except OSError:
+                    pass  # removed while walking
+
+    return {'files': manifest}
+
+
+def _unchanged(fullpath, contents):
+    try:
+        return os.path.getsize(fullpath) == len(contents) and \
+            file_hash(fullpath) == hashlib.sha256(contents).hexdigest()
+    except OSError:
+        return False
+
+
+def _remember_hash(fullpath, contents, written):
+    stat = os.stat(written)
+    with hash_cache_lock:
+        hash_cache[fullpath] = (stat.st_size, stat.st_mtime_ns, hashlib.sha256(contents).hexdigest())
+
+
+def _prepare_project(project):
+    project_dir = os.path.join(base, project)
+    data_dir = os.path.join(base, project, 'data')
+    api_dir = os.path.join(base, project, 'software', 'sygnaller')
     os.makedirs(project_dir, exist_ok=True)
     os.makedirs(data_dir, exist_ok=True)
-    os.makedirs(api_dir, exist_ok=True)
-    fix_owner_and_permissions(project_dir)
-    fix_owner_and_permissions(data_dir)
+    _ensure_owner_and_permissions(project_dir)
+    _ensure_owner_and_permissions(data_dir)
+    return project_dir, api_dir
 
-    files = data['files']
 
-    files_to_keep = set()
+def _project_path(project_dir, path):
+    """Full path of a project-relative path, refusing anything that would land outside the project"""
+    fullpath = os.path.normpath(os.path.join(project_dir, path))
+    if not fullpath.startswith(project_dir + os.sep):
+        raise ValueError("Path outside project: " + path)
+    return fullpath
+
+
+def _load_index(project_dir):
+    try:
+        with open(os.path.join(project_dir, index_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    # update any changed files
-    for f in files:
-        containing_dir = os.path.join(project_dir, os.path.dirname(f['path']))
-        fullpath = os.path.join(project_dir, f['path'])
 
-        files_to_keep.add(fullpath)
+def _save_index(project_dir, index):
+    path = os.path.join(project_dir, index_name)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
 
-        if f['contents'] is None:
+
+def _add_to_index(project_dir, category, fullpath):
+    """Record a file added outside of a whole-category upload, so later snapshots keep it"""
+    with index_lock:
+        index = _load_index(project_dir)
+        path = os.path.relpath(fullpath, project_dir)
+        if category in index and path not in index[category]:
+            index[category] = sorted(index[category] + [path])
+            _save_index(project_dir, index)
+
+
+def _walk_sources(project_dir, category):
+    prefix = len(project_dir) + 1
+    found = set()
+    for r, d, f in os.walk(os.path.join(project_dir, category)):
+        if r.endswith('sygnaller'):
             continue
+        for file in f:
+            found.add(os.path.join(r, file)[prefix:])
+    return found
 
-        os.makedirs(containing_dir, exist_ok=True)
-        fix_owner_and_permissions(containing_dir)
 
-        with open(fullpath, "wb") as fh:
-            fh.write(base64.decodebytes(bytes(f['contents'], encoding='utf-8')))
-        fix_owner_and_permissions(fullpath)
+def _remove_stale_files(project_dir, category, files_to_keep, stage):
+    """Get rid of source files that have been deleted
 
-    # get rid of source files that have been deleted
-    category = data['directory']
-    if category in ['software', 'hardware']:
-        for r, d, f in os.walk(os.path.join(project_dir, category)):
-            if r.endswith('sygnaller'):
-                continue
-            for file in f:
-                found = os.path.join(r, file)
-                if found not in files_to_keep:
-                    try:
-                        os.remove(found)
-                    except:
-                        pass
-
-    # make sure the API files are still there
-    if not os.path.exists(os.path.join(api_dir, 'terminal.py')):
-        with open(os.path.join(api_dir, 'terminal.py'), 'w') as f:
-            f.write("""
-import sys
-import base64
+    The project index lists the files of each category as of the last upload,
+    so deletions are a set difference rather than a walk of the whole tree.
+    A category without an index entry is walked once to seed it. Files are
+    removed from wherever `stage` maps them to, i.e. the snapshot being built.
+    """
+    if category not in ['software', 'hardware']:
+        return
 
-def error(msg):
-    print(msg, file=sys.stderr)
+    category_prefix = os.path.join(project_dir, category) + os.sep
+    prefix = len(project_dir) + 1
+    kept = {path[prefix:] for path in files_to_keep if path.startswith(category_prefix)}
 
-def imageFromDataURI(uri):
-    print("~"+uri)
-    
-def imageFromFile(filename):
-    with open(filename, "rb") as f:
-        print("~data:image;base64,"+ base64.b64encode(f.read()).decode('utf-8'))
+    with index_lock:
+        index = _load_index(project_dir)
+        if category in index:
+            known = set(index[category])
+        else:
+            known = _walk_sources(project_dir, category)
+
+        for stale in known - kept:
+            try:
+                os.remove(stage(os.path.join(project_dir, stale)))
+            except:
+                pass
+
+        if known != kept or category not in index:
+            index[category] = sorted(kept)
+            _save_index(project_dir, index)
 
-def showFigure(plt):
-    import io
-    buf = io.BytesIO()
-    plt.gcf().savefig(buf, format='png')
-    buf.seek(0)
-    print("~data:image;base64,"+ base64.b64encode(buf.read()).decode('utf-8'))
 
-""")
+def _write_file(path, contents):
+    """Replace a file rather than rewriting it, as it may be hard-linked into older snapshots"""
+    with open(path + '.uploading', 'wb') as fh:
+        fh.write(contents)
+    os.replace(path + '.uploading', path)
+
+
+def _install_api(api_dir):
+    """Make sure the API files are still there and up to date"""
+    os.makedirs(api_dir, exist_ok=True)
+    _ensure_owner_and_permissions(api_dir)
+    terminal_py = os.path.join(api_dir, 'terminal.py')
+    current_api = None
+    if os.path.exists(terminal_py):
+        with open(terminal_py) as f:
+            current_api = f.read()
+    if current_api != terminal_api:
+        _write_file(terminal_py, terminal_api.encode('utf-8'))
     if not os.path.exists(os.path.join(api_dir, '__init__.py')):
         with open(os.path.join(api_dir, '__init__.py'), 'w') as f:
             f.write("")
 
+
+def _snapshot_numbers(project_dir, category):
+    try:
+        return sorted(int(name) for name in os.listdir(os.path.join(project_dir, snapshots_name, category))
+                      if name.isdigit())
+    except FileNotFoundError:
+        return []
+
+
+def _switch_snapshot(project_dir, category, number):
+    """Point the category directory at another snapshot in a single rename"""
+    live = os.path.join(project_dir, category)
+    temp = live + '.switching'
+    try:
+        os.remove(temp)
+    except FileNotFoundError:
+        pass
+    os.symlink(os.path.join(snapshots_name, category, str(number)), temp)
+    os.replace(temp, live)
+
+
+def _current_snapshot(project_dir, category):
+    """Number of the snapshot the category directory points to, or None if there is nothing yet
+
+    A plain directory, as left by older versions of the daemon, becomes the
+    first snapshot.
+    """
+    live = os.path.join(project_dir, category)
+    if os.path.islink(live):
+        return int(os.path.basename(os.readlink(live)))
+    if not os.path.isdir(live):
+        return None
+
+    number = max(_snapshot_numbers(project_dir, category), default=0) + 1
+    snapshot_dir = os.path.join(project_dir, snapshots_name, category, str(number))
+    os.makedirs(os.path.dirname(snapshot_dir), exist_ok=True)
+    os.rename(live, snapshot_dir)  # the directory is briefly missing, but only this once
+    _switch_snapshot(project_dir, category, number)
+    return number
+
+
+def _link_snapshot(project_dir, category, source, destination):
+    """Fill a new snapshot with hard links to the files of the current one
+
+    Only the files in the project index, plus the sygnaller API, are linked,
+    so nothing but the API directory has to be walked.
+
+    This makes a save cost one link per file, however little changed (about
+    10 ms per thousand files). It buys snapshots that are plain, complete
+    directories: runs pinned to one by its real path, rollback, the manifest
+    and stale file cleanup all work on them unchanged, which sharing
+    directories between snapshots would not allow. The loop itself is kept to
+    string operations so the links are most of the cost.
+    """
+    with index_lock:
+        index = _load_index(project_dir)
+    if category in index:
+        prefix = len(category) + 1
+        files = [path[prefix:] for path in index[category]]
+        api_dir = os.path.join(source, 'sygnaller')
+        for r, d, f in os.walk(api_dir):
+            files.extend(os.path.join(r, file)[len(source) + 1:] for file in f)
+    else:
+        files = [os.path.join(r, file)[len(source) + 1:] for r, d, f in os.walk(source) for file in f]
+
+    source += os.sep
+    destination += os.sep
+    made_dirs = {''}
+    link = os.link
+    for path in files:
+        containing_dir = path.rpartition(os.sep)[0]
+        if containing_dir not in made_dirs:
+            os.makedirs(destination + containing_dir, exist_ok=True)
+            _ensure_owner_and_permissions(destination + containing_dir)
+            made_dirs.add(containing_dir)
+        try:
+            link(source + path, destination + path)
+        except FileNotFoundError:
+            pass
+
+
+def _snapshot_lock(project_dir):
+    with snapshot_locks_lock:
+        lock = snapshot_locks.get(project_dir)
+        if lock is None:
+            lock = snapshot_locks[project_dir] = Lock()
+        return lock
+
+
+@contextmanager
+def _staged(project_dir, category):
+    """Stage changes to a category directory in a new snapshot, switched in when the block completes
+
+    Yields a function giving the path a project file should be written to (or
+    removed from). Programs started in the meantime only ever see whole
+    snapshots. Categories that are not snapshotted are written in place.
+
+    The files are written without holding the project's snapshot lock, so a
+    slow upload does not hold up others. If another save was switched in
+    meanwhile, what it changed is carried over into this one, except where
+    this one wrote the same files.
+    """
+    if category not in snapshot_categories:
+        yield lambda path: path
+        return
+
+    category_dir = os.path.join(project_dir, snapshots_name, category)
+    with _snapshot_lock(project_dir):
+        current = _current_snapshot(project_dir, category)
+    staging_dir = os.path.join(category_dir, '.staging-%d-%s' % (os.getpid(), uuid.uuid4().hex))
+    os.makedirs(staging_dir)
+    _ensure_owner_and_permissions(category_dir)
+    _ensure_owner_and_permissions(staging_dir)
+    if current is not None:
+        _link_snapshot(project_dir, category, os.path.join(category_dir, str(current)), staging_dir)
+
+    live_prefix = os.path.join(project_dir, category) + os.sep
+    touched = set()  # paths within the category given out to be written
+
+    def stage(path):
+        if not path.startswith(live_prefix):
+            return path
+        touched.add(path[len(live_prefix):])
+        return staging_dir + path[len(live_prefix) - 1:]
+
+    try:
+        yield stage
+        with _snapshot_lock(project_dir):
+            latest = _current_snapshot(project_dir, category)
+            if latest != current:
+                _carry_over(os.path.join(category_dir, str(current)) if current is not None else None,
+                            os.path.join(category_dir, str(latest)), staging_dir, touched)
+            number = max(_snapshot_numbers(project_dir, category), default=0) + 1
+            os.rename(staging_dir, os.path.join(category_dir, str(number)))
+            _switch_snapshot(project_dir, category, number)
+            _prune_snapshots(project_dir, category)
+    except BaseException:
+        shutil.rmtree(staging_dir, True)
+        raise
+
+
+def _carry_over(base_dir, latest_dir, staging_dir, touched):
+    """Apply to a staged snapshot what was saved since base_dir, other than the paths it wrote itself"""
+    def files(directory):
+        if directory is None:
+            return {}
+        return {os.path.relpath(os.path.join(r, file), directory): os.path.join(r, file)
+                for r, d, f in os.walk(directory) for file in f}
+
+    def was_touched(path):
+        while path:
+            if path in touched:
+                return True
+            path = os.path.dirname(path)
+        return False
+
+    base_files, latest_files = files(base_dir), files(latest_dir)
+    for path, source in latest_files.items():
+        if was_touched(path):
+            continue
+        if path in base_files and os.path.samefile(base_files[path], source):
+            continue
+        target = os.path.join(staging_dir, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.remove(target)
+        except FileNotFoundError:
+            pass
+        os.link(source, target)
+    for path in base_files:
+        if path not in latest_files and not was_touched(path):
+            try:
+                os.remove(os.path.join(staging_dir, path))
+            except FileNotFoundError:
+                pass
+
+
+def _prune_snapshots(project_dir, category):
+    """Drop all but the newest snapshots; the files are deleted in the background, off the save"""
+    def delete(path):
+        shutil.rmtree(path, True)
+        with snapshot_locks_lock:
+            snapshots_deleting.discard(path)
+
+    category_dir = os.path.join(project_dir, snapshots_name, category)
+    doomed = [os.path.join(category_dir, name) for name in os.listdir(category_dir)
+              if name.endswith('.deleting') or
+              name.startswith('.staging-') and name.split('-')[1] != str(os.getpid())]  # from an earlier run
+    for old in _snapshot_numbers(project_dir, category)[:-keep_snapshots]:
+        old_dir = os.path.join(category_dir, str(old))
+        os.rename(old_dir, old_dir + '.deleting')
+        doomed.append(old_dir + '.deleting')
+
+    # including any left behind when the daemon stopped part way through
+    with snapshot_locks_lock:
+        doomed = [path for path in doomed if path not in snapshots_deleting]
+        snapshots_deleting.update(doomed)
+    for path in doomed:
+        Thread(target=delete, args=(path,), daemon=True).start()
+
+
+def project_snapshots(data):
+    """Snapshots kept of a project's software or hardware directory"""
+    project_dir = os.path.join(base, data['project'])
+    live = os.path.join(project_dir, data['directory'])
+    return {
+        'current': int(os.path.basename(os.readlink(live))) if os.path.islink(live) else None,
+        'snapshots': _snapshot_numbers(project_dir, data['directory'])
+    }
+
+
+def rollback_project(data):
+    """Switch a project's software or hardware directory back to an earlier snapshot"""
+    project_dir = os.path.join(base, data['project'])
+    category = data['directory']
+    if category not in snapshot_categories:
+        return {'error': 'Not a snapshotted directory'}
+
+    with _snapshot_lock(project_dir):
+        current = _current_snapshot(project_dir, category)
+        numbers = _snapshot_numbers(project_dir, category)
+        if data.get('snapshot') is not None:
+            number = int(data['snapshot'])
+        else:
+            earlier = [n for n in numbers if current is not None and n < current]
+            number = earlier[-1] if earlier else None
+        if number not in numbers:
+            return {'error': 'No such snapshot'}
+
+        _switch_snapshot(project_dir, category, number)
+        # the index described the snapshot we just left; the next upload walks this one instead
+        with index_lock:
+            index = _load_index(project_dir)
+            if index.pop(category, None) is not None:
+                _save_index(project_dir, index)
+
+    return {'current': number}
+
+
+def upload_files(data):
+    project_dir, api_dir = _prepare_project(data['project'])
+
+    files = data['files']
+
+    files_to_keep = set()
+
+    with _staged(project_dir, data['directory']) as stage:
+        # update any changed files
+        for f in files:
+            fullpath = _project_path(project_dir, f['path'])
+
+            files_to_keep.add(fullpath)
+
+            if f['contents'] is None:
+                continue
+
+            # byte-identical files are left alone (they are already linked into the snapshot)
+            target = stage(fullpath)
+            contents = base64.decodebytes(bytes(f['contents'], encoding='utf-8'))
+            if os.path.exists(target) and _unchanged(fullpath, contents):
+                continue
+
+            containing_dir = os.path.dirname(target)
+            os.makedirs(containing_dir, exist_ok=True)
+            _ensure_owner_and_permissions(containing_dir)
+
+            _write_file(target, contents)
+            fix_owner_and_permissions(target)
+            _remember_hash(fullpath, contents, target)
+
+        _remove_stale_files(project_dir, data['directory'], files_to_keep, stage)
+        _install_api(stage(api_dir))
+
+    return {}
+
+
+def _extract_member(tar, member, fullpath, target):
+    """Stream one file out of the archive, replacing the old file only if the contents differ"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    _ensure_owner_and_permissions(os.path.dirname(target))
+
+    temp_path = target + '.uploading'
+    h = hashlib.sha256()
+    source = tar.extractfile(member)
+    with open(temp_path, 'wb') as fh:
+        for chunk in iter(lambda: source.read(65536), b''):
+            h.update(chunk)
+            fh.write(chunk)
+    digest = h.hexdigest()
+
+    try:
+        unchanged = os.path.exists(target) and os.path.getsize(fullpath) == member.size and \
+            file_hash(fullpath) == digest
+    except OSError:
+        unchanged = False
+    if unchanged:
+        os.remove(temp_path)
+        return
+
+    os.replace(temp_path, target)
+    fix_owner_and_permissions(target)
+    stat = os.stat(target)
+    with hash_cache_lock:
+        hash_cache[fullpath] = (stat.st_size, stat.st_mtime_ns, digest)
+
+
+def upload_tar(params, stream):
+    """Extract a (optionally compressed) tar stream of project files straight to disk
+
+    Paths in the archive are project-relative, as in upload_files. Files that
+    have not changed can be left out of the archive and listed, one path per
+    line, in a member named .sygnaller-keep so they survive the stale file
+    cleanup.
+    """
+    project_dir, api_dir = _prepare_project(params['project'])
+
+    files_to_keep = set()
+    try:
+        # an invalid archive leaves the current snapshot as it was
+        with _staged(project_dir, params.get('directory')) as stage:
+            with tarfile.open(fileobj=stream, mode='r|*') as tar:
+                for member in tar:
+                    if member.name == keep_list_name:
+                        keep_list = tar.extractfile(member).read().decode('utf-8')
+                        files_to_keep.update(_project_path(project_dir, path) for path in keep_list.splitlines() if path)
+                        continue
+
+                    fullpath = _project_path(project_dir, member.name)
+                    if member.isdir():
+                        os.makedirs(stage(fullpath), exist_ok=True)
+                        _ensure_owner_and_permissions(stage(fullpath))
+                    elif member.isfile():
+                        files_to_keep.add(fullpath)
+                        _extract_member(tar, member, fullpath, stage(fullpath))
+
+            _remove_stale_files(project_dir, params.get('directory'), files_to_keep, stage)
+            _install_api(stage(api_dir))
+    except tarfile.TarError:
+        return {'error': 'Invalid archive'}
+
+    return {}
+
+
+def _upload_paths(upload_id):
+    if not upload_id.isalnum():
+        raise ValueError("Invalid upload id")
+    return os.path.join(uploads_dir, upload_id + '.json'), os.path.join(uploads_dir, upload_id + '.part')
+
+
+def _upload_lock(upload_id):
+    with upload_locks_lock:
+        return upload_locks.setdefault(upload_id, Lock())
+
+
+def _load_upload(upload_id):
+    meta_path, part_path = _upload_paths(upload_id)
+    with open(meta_path) as f:
+        meta = json.load(f)
+    meta['offset'] = os.path.getsize(part_path)
+    return meta
+
+
+def _expire_uploads():
+    for file in os.listdir(uploads_dir):
+        path = os.path.join(uploads_dir, file)
+        try:
+            if time.time() - os.path.getmtime(path) > upload_expiry:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def upload_begin(data):
+    """Start (or find again) a chunked upload of one large project file
+
+    The id depends only on the file's project, path, size and hash, so a
+    client that lost the id, or talks to a restarted daemon, gets the same
+    upload back along with how much of it has already arrived. The hash is
+    required: without it a different file of the same size would resume onto
+    the old one's chunks.
+    """
+    project_dir = os.path.join(base, data['project'])
+    _project_path(project_dir, data['path'])
+    size = int(data['size'])
+    sha256 = data['sha256'].lower()
+    if len(sha256) != 64 or not all(c in '0123456789abcdef' for c in sha256):
+        return {'error': 'Invalid sha256'}
+    key = '\n'.join([data['project'], data['path'], str(size), sha256])
+    upload_id = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+    os.makedirs(uploads_dir, exist_ok=True)
+    meta_path, part_path = _upload_paths(upload_id)
+    with _upload_lock(upload_id):
+        if not os.path.exists(meta_path):
+            _expire_uploads()
+            open(part_path, 'ab').close()
+            with open(meta_path + '.tmp', 'w') as f:
+                json.dump({
+                    'project': data['project'],
+                    'path': data['path'],
+                    'size': size,
+                    'sha256': sha256
+                }, f)
+            os.replace(meta_path + '.tmp', meta_path)
+        meta = _load_upload(upload_id)
+
+    return {'upload_id': upload_id, 'offset': meta['offset'], 'size': size}
+
+
+def upload_status(data):
+    try:
+        meta = _load_upload(data['upload_id'])
+    except OSError:
+        return {'error': 'Unknown upload'}
+    return {'upload_id': data['upload_id'], 'offset': meta['offset'], 'size': meta['size']}
+
+
+def upload_chunk(params, stream):
+    """Write one chunk of a chunked upload at the given offset, after checking its SHA-256"""
+    upload_id = params['upload_id']
+    offset = int(params['offset'])
+    if stream.remaining > max_chunk_size:
+        return {'error': 'Chunk too large'}
+
+    chunk = stream.read()
+    if hashlib.sha256(chunk).hexdigest() != params['sha256']:
+        return {'error': 'Checksum mismatch'}
+
+    with _upload_lock(upload_id):
+        try:
+            meta = _load_upload(upload_id)
+        except OSError:
+            return {'error': 'Unknown upload'}
+        # chunks may be re-sent, but may not leave a gap
+        if offset > meta['offset'] or offset + len(chunk) > meta['size']:
+            return {'error': 'Bad offset', 'offset': meta['offset']}
+
+        meta_path, part_path = _upload_paths(upload_id)
+        with open(part_path, 'r+b') as f:
+            f.seek(offset)
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.utime(meta_path)  # still active, so not to be expired
+        return {'upload_id': upload_id, 'offset': os.path.getsize(part_path), 'size': meta['size']}
+
+
+def upload_commit(data):
+    """Check a completed chunked upload and atomically move it into place"""
+    upload_id = data['upload_id']
+    with _upload_lock(upload_id):
+        try:
+            meta = _load_upload(upload_id)
+        except OSError:
+            return {'error': 'Unknown upload'}
+        if meta['offset'] != meta['size']:
+            return {'error': 'Upload incomplete', 'offset': meta['offset']}
+
+        meta_path, part_path = _upload_paths(upload_id)
+        digest = file_hash(part_path)
+        if digest != meta['sha256']:
+            os.remove(part_path)
+            os.remove(meta_path)
+            return {'error': 'Checksum mismatch'}
+
+        project_dir, _ = _prepare_project(meta['project'])
+        fullpath = _project_path(project_dir, meta['path'])
+        category = os.path.relpath(fullpath, project_dir).split(os.sep)[0]
+        # software and hardware files go in through a new snapshot, like any other upload
+        with _staged(project_dir, category) as stage:
+            target = stage(fullpath)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _ensure_owner_and_permissions(os.path.dirname(target))
+            fix_owner_and_permissions(part_path)
+            os.replace(part_path, target)
+            _add_to_index(project_dir, category, fullpath)
+        stat = os.stat(fullpath)
+        with hash_cache_lock:
+            hash_cache[fullpath] = (stat.st_size, stat.st_mtime_ns, digest)
+        os.remove(meta_path)
+
+    with upload_locks_lock:
+        upload_locks.pop(upload_id, None)
     return {}
 
 
@@ -169,6 +835,314 @@ class TestTransfer(unittest.TestCase):
         self.assertTrue(os.path.exists('/home/xilinx/projects/_test_dummy/software/main.py'))
         self.assertFalse(os.path.exists('/home/xilinx/projects/_test_dummy/software/todelete.py'))
 
+    def test_manifest(self):
+        import hashlib
+        data = {
+            "project": "_test_dummy",
+            "directory": "software",
+            "files": [
+                {
+                    "path": "software/main.py",
+                    "contents": base64.b64encode(b"print(1)\n").decode()
+                }
+            ]
+        }
+        upload_files(data)
+        manifest = project_manifest({"project": "_test_dummy", "directory": "software"})["files"]
+        self.assertEqual(manifest["software/main.py"], hashlib.sha256(b"print(1)\n").hexdigest())
+        self.assertIn("software/sygnaller/terminal.py", manifest)
+
+        # changes on disk are picked up
+        with open('/home/xilinx/projects/_test_dummy/software/main.py', 'w') as f:
+            f.write("print(22)\n")
+        manifest = project_manifest({"project": "_test_dummy"})["files"]
+        self.assertEqual(manifest["software/main.py"], hashlib.sha256(b"print(22)\n").hexdigest())
+
+        # the daemon's own files are not project content
+        os.makedirs('/home/xilinx/projects/_test_dummy/.overlay-download', exist_ok=True)
+        for path in ('.overlay-download/overlay.bit', 'software/big.bin.uploading'):
+            with open(os.path.join('/home/xilinx/projects/_test_dummy', path), 'w') as f:
+                f.write("partial")
+        manifest = project_manifest({"project": "_test_dummy"})["files"]
+        self.assertTrue(os.path.exists(os.path.join('/home/xilinx/projects/_test_dummy', index_name)))
+        self.assertEqual([path for path in manifest if not path.startswith('software/')], [])
+        self.assertNotIn('software/big.bin.uploading', manifest)
+
+    def test_upload_identical(self):
+        data = {
+            "project": "_test_dummy",
+            "directory": "software",
+            "files": [
+                {
+                    "path": "software/main.py",
+                    "contents": base64.b64encode(b"print(1)\n").decode()
+                }
+            ]
+        }
+        upload_files(data)
+        before = os.stat('/home/xilinx/projects/_test_dummy/software/main.py')
+        upload_files(data)
+        after = os.stat('/home/xilinx/projects/_test_dummy/software/main.py')
+        self.assertEqual(before.st_mtime_ns, after.st_mtime_ns)
+
+        # a change is still written
+        data["files"][0]["contents"] = base64.b64encode(b"print(2)\n").decode()
+        upload_files(data)
+        with open('/home/xilinx/projects/_test_dummy/software/main.py', 'rb') as f:
+            self.assertEqual(f.read(), b"print(2)\n")
+
+    def test_upload_cleanup_index(self):
+        data = {
+            "project": "_test_dummy",
+            "directory": "hardware",
+            "files": [
+                {"path": "hardware/top.v", "contents": ""},
+                {"path": "hardware/sub/old.v", "contents": ""}
+            ]
+        }
+        upload_files(data)
+        self.assertEqual(_load_index('/home/xilinx/projects/_test_dummy')["hardware"],
+                         ["hardware/sub/old.v", "hardware/top.v"])
+
+        data["files"] = [{"path": "hardware/top.v", "contents": None}]
+        upload_files(data)
+        self.assertFalse(os.path.exists('/home/xilinx/projects/_test_dummy/hardware/sub/old.v'))
+        self.assertEqual(_load_index('/home/xilinx/projects/_test_dummy')["hardware"], ["hardware/top.v"])
+
+    def test_snapshots(self):
+        project_dir = '/home/xilinx/projects/_test_dummy'
+
+        def save(main, lib):
+            upload_files({"project": "_test_dummy", "directory": "software", "files": [
+                {"path": "software/main.py", "contents": base64.b64encode(main).decode()},
+                {"path": "software/lib.py", "contents": lib and base64.b64encode(lib).decode()}
+            ]})
+
+        save(b"v1", b"lib")
+        first = project_snapshots({"project": "_test_dummy", "directory": "software"})["current"]
+        save(b"v2", None)
+        self.assertTrue(os.path.islink(os.path.join(project_dir, 'software')))
+        with open(os.path.join(project_dir, 'software/main.py'), 'rb') as f:
+            self.assertEqual(f.read(), b"v2")
+
+        # the old snapshot is untouched and the unchanged file is shared, not copied
+        old_dir = os.path.join(project_dir, snapshots_name, 'software', str(first))
+        with open(os.path.join(old_dir, 'main.py'), 'rb') as f:
+            self.assertEqual(f.read(), b"v1")
+        self.assertEqual(os.stat(os.path.join(old_dir, 'lib.py')).st_ino,
+                         os.stat(os.path.join(project_dir, 'software/lib.py')).st_ino)
+        self.assertEqual(os.stat(os.path.join(old_dir, 'sygnaller/terminal.py')).st_ino,
+                         os.stat(os.path.join(project_dir, 'software/sygnaller/terminal.py')).st_ino)
+
+        self.assertEqual(rollback_project({"project": "_test_dummy", "directory": "software"}), {"current": first})
+        with open(os.path.join(project_dir, 'software/main.py'), 'rb') as f:
+            self.assertEqual(f.read(), b"v1")
+        self.assertEqual(rollback_project({"project": "_test_dummy", "directory": "software", "snapshot": 99}),
+                         {"error": "No such snapshot"})
+
+        # only the most recent snapshots are kept
+        for i in range(keep_snapshots + 2):
+            save(b"v%d" % (i + 3), None)
+        snapshots = project_snapshots({"project": "_test_dummy", "directory": "software"})
+        self.assertEqual(len(snapshots["snapshots"]), keep_snapshots)
+        self.assertEqual(snapshots["current"], snapshots["snapshots"][-1])
+        with open(os.path.join(project_dir, 'software/lib.py'), 'rb') as f:
+            self.assertEqual(f.read(), b"lib")
+
+    def test_overlapping_saves(self):
+        project_dir = '/home/xilinx/projects/_test_dummy'
+        upload_files({"project": "_test_dummy", "directory": "software", "files": [
+            {"path": "software/a.py", "contents": base64.b64encode(b"a1").decode()},
+            {"path": "software/b.py", "contents": base64.b64encode(b"b1").decode()}
+        ]})
+
+        # a slow save holds no lock while it writes, so other saves go ahead
+        with _staged(project_dir, 'software') as stage:
+            with open(stage(os.path.join(project_dir, 'software/a.py')), 'wb') as f:
+                f.write(b"a2")
+            done = Thread(target=upload_files, args=({"project": "_test_dummy", "directory": "software", "files": [
+                {"path": "software/b.py", "contents": base64.b64encode(b"b2").decode()}
+            ]},))
+            done.start()
+            done.join(5)
+            self.assertFalse(done.is_alive())
+
+        # and neither save loses what the other wrote
+        for name, contents in (('a.py', b"a2"), ('b.py', b"b2")):
+            with open(os.path.join(project_dir, 'software', name), 'rb') as f:
+                self.assertEqual(f.read(), contents)
+
+    def test_snapshot_migration(self):
+        project_dir = '/home/xilinx/projects/_test_dummy'
+        os.makedirs(os.path.join(project_dir, 'hardware'))
+        with open(os.path.join(project_dir, 'hardware/top.v'), 'w') as f:
+            f.write("module top(); endmodule")
+
+        upload_files({"project": "_test_dummy", "directory": "hardware", "files": [
+            {"path": "hardware/top.v", "contents": None},
+            {"path": "hardware/new.v", "contents": ""}
+        ]})
+        self.assertTrue(os.path.islink(os.path.join(project_dir, 'hardware')))
+        self.assertEqual(project_snapshots({"project": "_test_dummy", "directory": "hardware"}),
+                         {"current": 2, "snapshots": [1, 2]})
+        with open(os.path.join(project_dir, 'hardware/top.v')) as f:
+            self.assertEqual(f.read(), "module top(); endmodule")
+        self.assertEqual(sorted(project_manifest({"project": "_test_dummy", "directory": "hardware"})["files"]),
+                         ["hardware/new.v", "hardware/top.v"])
+
+    def test_benchmark_repeated_saves(self):
+        from time import time
+        count = 3000
+        files = [{"path": "software/pkg%d/mod%d.py" % (i % 30, i), "contents": ""} for i in range(count)]
+        upload_files({"project": "_test_dummy", "directory": "software", "files": files})
+
+        # each save changes one file and keeps the rest
+        timings = []
+        for save in range(10):
+            files = [{"path": f["path"], "contents": None} for f in files]
+            files[save]["contents"] = base64.b64encode(b"x = %d\n" % save).decode()
+            started = time()
+            upload_files({"project": "_test_dummy", "directory": "software", "files": files})
+            timings.append(time() - started)
+
+        # the walk the index replaces, for comparison
+        started = time()
+        _walk_sources('/home/xilinx/projects/_test_dummy', 'software')
+        walk = time() - started
+
+        timings.sort()
+        print("\n%d-file project: %.1f ms median per save (full os.walk alone: %.1f ms)"
+              % (count, timings[len(timings) // 2] * 1000, walk * 1000))
+        self.assertEqual(len(_load_index('/home/xilinx/projects/_test_dummy')["software"]), count)
+
+    def _tar(self, files):
+        import io
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for path, contents in files:
+                info = tarfile.TarInfo(path)
+                info.size = len(contents)
+                tar.addfile(info, io.BytesIO(contents))
+        archive.seek(0)
+        return archive
+
+    def test_upload_tar(self):
+        upload_tar({"project": "_test_dummy", "directory": "software"}, self._tar([
+            ("software/main.py", b"print(1)\n"),
+            ("software/lib/util.py", b"x = 1\n"),
+            ("software/todelete.py", b"")
+        ]))
+        self.assertTrue(os.path.exists('/home/xilinx/projects/_test_dummy/software/lib/util.py'))
+        self.assertTrue(os.path.exists('/home/xilinx/projects/_test_dummy/software/sygnaller/terminal.py'))
+
+        # unchanged files are listed rather than re-sent, anything else is cleaned up
+        before = os.stat('/home/xilinx/projects/_test_dummy/software/main.py')
+        upload_tar({"project": "_test_dummy", "directory": "software"}, self._tar([
+            (keep_list_name, b"software/lib/util.py\n"),
+            ("software/main.py", b"print(1)\n")
+        ]))
+        self.assertEqual(os.stat('/home/xilinx/projects/_test_dummy/software/main.py').st_mtime_ns,
+                         before.st_mtime_ns)
+        self.assertTrue(os.path.exists('/home/xilinx/projects/_test_dummy/software/lib/util.py'))
+        self.assertFalse(os.path.exists('/home/xilinx/projects/_test_dummy/software/todelete.py'))
+
+    def test_upload_tar_outside_project(self):
+        with self.assertRaises(ValueError):
+            upload_tar({"project": "_test_dummy", "directory": "data"}, self._tar([
+                ("../escaped.txt", b"nope")
+            ]))
+        self.assertFalse(os.path.exists('/home/xilinx/projects/escaped.txt'))
+
+    def test_upload_tar_invalid(self):
+        import io
+        result = upload_tar({"project": "_test_dummy", "directory": "data"}, io.BytesIO(b"not a tar file" * 100))
+        self.assertEqual(result, {"error": "Invalid archive"})
+
+        # a broken upload does not replace the current snapshot
+        upload_tar({"project": "_test_dummy", "directory": "software"}, self._tar([("software/main.py", b"ok")]))
+        before = project_snapshots({"project": "_test_dummy", "directory": "software"})
+        archive = self._tar([("software/main.py", b"broken")]).getvalue()
+        result = upload_tar({"project": "_test_dummy", "directory": "software"}, io.BytesIO(archive[:600]))
+        self.assertEqual(result, {"error": "Invalid archive"})
+        with open('/home/xilinx/projects/_test_dummy/software/main.py', 'rb') as f:
+            self.assertEqual(f.read(), b"ok")
+        self.assertEqual(project_snapshots({"project": "_test_dummy", "directory": "software"}), before)
+
+    def _put_chunk(self, upload_id, offset, chunk, checksum=None):
+        import io
+
+        class Body(io.BytesIO):
+            remaining = len(chunk)
+
+        return upload_chunk({
+            "upload_id": upload_id,
+            "offset": str(offset),
+            "sha256": checksum or hashlib.sha256(chunk).hexdigest()
+        }, Body(chunk))
+
+    def test_chunked_upload(self):
+        contents = os.urandom(300000)
+        begin = upload_begin({
+            "project": "_test_dummy",
+            "path": "data/dataset.bin",
+            "size": len(contents),
+            "sha256": hashlib.sha256(contents).hexdigest()
+        })
+        upload_id = begin["upload_id"]
+        self.assertEqual(begin["offset"], 0)
+
+        self.assertEqual(self._put_chunk(upload_id, 0, contents[:100000])["offset"], 100000)
+        self.assertEqual(self._put_chunk(upload_id, 100000, contents[100000:200000], "0" * 64),
+                         {"error": "Checksum mismatch"})
+        self.assertEqual(self._put_chunk(upload_id, 150000, contents[150000:200000])["error"], "Bad offset")
+        self.assertEqual(upload_commit({"upload_id": upload_id})["error"], "Upload incomplete")
+
+        # starting again (e.g. after a restart) resumes where it left off
+        begin = upload_begin({
+            "project": "_test_dummy",
+            "path": "data/dataset.bin",
+            "size": len(contents),
+            "sha256": hashlib.sha256(contents).hexdigest()
+        })
+        self.assertEqual(begin, {"upload_id": upload_id, "offset": 100000, "size": len(contents)})
+        self.assertEqual(upload_status({"upload_id": upload_id})["offset"], 100000)
+
+        self._put_chunk(upload_id, 100000, contents[100000:])
+        self.assertEqual(upload_commit({"upload_id": upload_id}), {})
+        with open('/home/xilinx/projects/_test_dummy/data/dataset.bin', 'rb') as f:
+            self.assertEqual(f.read(), contents)
+        self.assertEqual(upload_status({"upload_id": upload_id}), {"error": "Unknown upload"})
+
+    def test_chunked_upload_snapshot(self):
+        upload_files({"project": "_test_dummy", "directory": "software", "files": [
+            {"path": "software/main.py", "contents": ""}
+        ]})
+        before = project_snapshots({"project": "_test_dummy", "directory": "software"})["current"]
+        contents = os.urandom(1000)
+        upload_id = upload_begin({
+            "project": "_test_dummy",
+            "path": "software/model.bin",
+            "size": len(contents),
+            "sha256": hashlib.sha256(contents).hexdigest()
+        })["upload_id"]
+        self._put_chunk(upload_id, 0, contents)
+        self.assertEqual(upload_commit({"upload_id": upload_id}), {})
+        self.assertGreater(project_snapshots({"project": "_test_dummy", "directory": "software"})["current"], before)
+
+        # and later saves carry it into their snapshots
+        upload_files({"project": "_test_dummy", "directory": "software", "files": [
+            {"path": "software/main.py", "contents": None},
+            {"path": "software/model.bin", "contents": None}
+        ]})
+        with open('/home/xilinx/projects/_test_dummy/software/model.bin', 'rb') as f:
+            self.assertEqual(f.read(), contents)
+
+    def test_chunked_upload_needs_hash(self):
+        with self.assertRaises(KeyError):
+            upload_begin({"project": "_test_dummy", "path": "data/a.bin", "size": 10})
+        self.assertEqual(upload_begin({"project": "_test_dummy", "path": "data/a.bin", "size": 10, "sha256": "abc"}),
+                         {"error": "Invalid sha256"})
+
     def test_api(self):
         data = {
             "project": "_test_dummy",
@@ -0,0 +1,422 @@
+import os
+import json
+import time
+import random
+import socket
+import http.client
+import urllib.parse
+from threading import Lock
+
+# defaults for calls to an upstream server
+default_timeout = 8  # seconds to wait for a response
+default_connect_timeout = 4
+default_retries = 2  # extra attempts for idempotent calls
+default_backoff = 0.2  # seconds before the first retry, doubled each time and jittered
+default_pool_size = 4  # idle connections kept open
+
+# consecutive failed calls before the circuit opens, and how long it stays open (seconds)
+failure_threshold = 5
+circuit_cooldown = 10
+
+
+class UpstreamError(OSError):
+    """The server answered with an error status"""
+
+    def __init__(self, status, reason):
+        super().__init__('%d %s' % (status, reason))
+        self.status = status
+
+
+class UpstreamUnavailable(OSError):
+    """Calls are failing fast because the server has been down"""
+
+
+class UpstreamClient:
+    """HTTP client for one server, sharing keep-alive connections between threads
+
+    Idempotent calls are retried with jittered exponential backoff on
+    connection errors, timeouts and 5xx answers. After failure_threshold calls
+    in a row have failed, the circuit opens and calls fail immediately for
+    circuit_cooldown seconds; then a single call is let through to find out
+    whether the server is back.
+    """
+
+    def __init__(self, base_url, timeout=default_timeout, connect_timeout=default_connect_timeout,
+                 retries=default_retries, backoff=default_backoff, pool_size=default_pool_size, stats=None):
+        url = urllib.parse.urlsplit(base_url)
+        self.base_url = base_url
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.host = url.hostname
+        self.port = url.port
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.stats = stats  # a metrics.CallStats to record each call's latency and outcome in, by path
+
+        self.idle = []  # connections ready to be reused
+        self.failures = 0  # consecutive failed calls
+        self.open_until = 0
+        self.trial = False  # a call is testing whether the server is back
+        self.lock = Lock()
+
+    def _connection(self, reuse=True):
+        """An idle connection if there is one (and reuse allows), otherwise a new one; and whether it was reused"""
+        with self.lock:
+            if reuse and self.idle:
+                return self.idle.pop(), True
+        return self.connection_class(self.host, self.port, timeout=self.connect_timeout), False
+
+    def _release(self, connection):
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def _check_circuit(self):
+        with self.lock:
+            if self.failures < failure_threshold:
+                return
+            if time.time() < self.open_until or self.trial:
+                raise UpstreamUnavailable("%s is not responding" % self.base_url)
+            self.trial = True
+
+    def _record(self, success):
+        with self.lock:
+            self.trial = False
+            if success:
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.failures >= failure_threshold:
+                    self.open_until = time.time() + circuit_cooldown
+
+    def _attempt(self, connection, path, body, headers, timeout, read):
+        try:
+            if connection.sock is None:
+                connection.connect()
+                connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection.sock.settimeout(timeout)
+            connection.request('POST', self.prefix + path, body, headers)
+            response = connection.getresponse()
+            payload = response.read() if response.status >= 400 else read(response)
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+        return response, payload
+
+    def _call(self, path, body, headers, idempotent, timeout, read):
+        """Send a request, retrying as allowed; read(response) consumes a successful response's body"""
+        if self.stats is None:
+            return self._send(path, body, headers, idempotent, timeout, read)
+        started = time.time()
+        try:
+            result = self._send(path, body, headers, idempotent, timeout, read)
+        except Exception:
+            self.stats.record(path, time.time() - started, error=True)
+            raise
+        self.stats.record(path, time.time() - started)
+        return result
+
+    def _send(self, path, body, headers, idempotent, timeout, read):
+        self._check_circuit()
+        try:
+            return self._attempts(path, body, headers, idempotent, timeout, read)
+        finally:
+            # whatever happened, this call is no longer the one testing the server
+            with self.lock:
+                self.trial = False
+
+    def _attempts(self, path, body, headers, idempotent, timeout, read):
+        attempt = 0
+        while True:
+            # a request that must not be sent twice gets a new connection, as an idle one may
+            # turn out to have been closed by the server only once the request is on its way
+            connection, reused = self._connection(reuse=idempotent)
+            try:
+                response, payload = self._attempt(connection, path, body, dict(headers(), **{
+                    'Content-Type': 'application/json'
+                }), timeout or self.timeout, read)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                if reused:
+                    continue  # the server had closed this idle connection; the request never reached it
+                error = e
+            except (http.client.HTTPException, OSError) as e:
+                error = e
+            else:
+                if response.status < 500:
+                    self._record(True)
+                    if response.status >= 400:
+                        raise UpstreamError(response.status, response.reason)
+                    return response, payload
+                error = UpstreamError(response.status, response.reason)
+
+            if not idempotent or attempt >= self.retries:
+                self._record(False)
+                raise error
+            attempt += 1
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def post(self, path, body, headers=None, idempotent=False, timeout=None):
+        """POST a body and return the response body, raising UpstreamError for error statuses"""
+        response, payload = self._call(path, body, lambda: headers or {}, idempotent, timeout,
+                                       lambda response: response.read())
+        return payload
+
+    def download(self, path, body, destination, progress=None, timeout=None):
+        """POST a request for a file and stream the answer to destination, returning the response headers
+
+        Downloads are idempotent. If destination already holds part of the file
+        (from an earlier, interrupted call) only the rest is requested, and a
+        retry after a dropped connection carries on from where it stopped.
+        progress(bytes so far, total bytes) is called as data arrives.
+        """
+        def headers():
+            offset = os.path.getsize(destination) if os.path.exists(destination) else 0
+            return {'Range': 'bytes=%d-' % offset} if offset else {}
+
+        def read(response):
+            offset = 0
+            mode = 'wb'
+            if response.status == 206:
+                offset = int(response.headers['Content-Range'].split()[1].split('-')[0])
+                mode = 'r+b'
+            length = response.headers.get('Content-Length')
+            total = offset + int(length) if length is not None else None
+            with open(destination, mode) as f:
+                f.seek(offset)
+                f.truncate()
+                done = offset
+                for chunk in iter(lambda: response.read(65536), b''):
+                    f.write(chunk)
+                    done += len(chunk)
+                    if progress is not None:
+                        progress(done, total)
+            if total is not None and done < total:
+                raise http.client.IncompleteRead(b'', total - done)
+
+        try:
+            response, _ = self._call(path, body, headers, True, timeout, read)
+        except UpstreamError as e:
+            if e.status != 416:
+                raise
+            # the partial file is no use, e.g. it is longer than the file on the server
+            os.remove(destination)
+            response, _ = self._call(path, body, headers, True, timeout, read)
+        return response.headers
+
+    def post_json(self, path, data, idempotent=False, timeout=None):
+        response = self.post(path, json.dumps(data).encode('utf-8'), idempotent=idempotent, timeout=timeout)
+        return json.loads(response.decode())
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+
+# *****************************************
+# Unit tests
+# *****************************************
+
+import unittest
+import http.server
+from threading import Thread
+
+
+class StandInServer(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True
+
+    connections = set()  # client ports seen
+    failures = 0  # how many requests still to answer with 503
+
+    file = b''  # served at /file, with Range support
+    drop_after = None  # bytes of /file to send before hanging up, once
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['content-length']))
+        StandInServer.connections.add(self.client_address[1])
+        if self.path == '/file':
+            self._send_file()
+            return
+        if StandInServer.failures > 0:
+            StandInServer.failures -= 1
+            self.send_response(503)
+            payload = b'{}'
+        else:
+            self.send_response(200)
+            payload = json.dumps({'path': self.path}).encode('utf-8')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_file(self):
+        start = 0
+        if self.headers['Range'] is not None:
+            start = int(self.headers['Range'][len('bytes='):-1])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(self.file) - 1, len(self.file)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(self.file) - start))
+        self.end_headers()
+        if StandInServer.drop_after is not None:
+            self.wfile.write(self.file[start:start + StandInServer.drop_after])
+            StandInServer.drop_after = None
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        self.wfile.write(self.file[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestUpstream(unittest.TestCase):
+
+    def setUp(self):
+        StandInServer.connections = set()
+        StandInServer.failures = 0
+        StandInServer.drop_after = None
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInServer)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.client = UpstreamClient(self.url, backoff=0.01)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for i in range(10):
+            self.assertEqual(self.client.post_json('/build_progress', {}, idempotent=True),
+                             {'path': '/build_progress'})
+        self.assertEqual(len(StandInServer.connections), 1)
+
+    def test_retry_idempotent(self):
+        StandInServer.failures = 2
+        self.assertEqual(self.client.post_json('/build_progress', {}, idempotent=True), {'path': '/build_progress'})
+
+        StandInServer.failures = 1
+        with self.assertRaises(UpstreamError):
+            self.client.post_json('/compile', {})
+
+    def test_reconnect(self):
+        self.client.post_json('/build_progress', {})
+        # the server goes away and comes back, closing the idle connection
+        port = self.server.server_address[1]
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), StandInServer)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.assertEqual(self.client.post_json('/compile', {}), {'path': '/compile'})
+
+    def test_download_resume(self):
+        StandInServer.file = os.urandom(1000000)
+        StandInServer.drop_after = 300000
+        try:
+            os.remove('/tmp/_upstream_download')
+        except FileNotFoundError:
+            pass
+
+        progress = []
+        self.client.download('/file', b'{}', '/tmp/_upstream_download', lambda done, total: progress.append(done))
+        with open('/tmp/_upstream_download', 'rb') as f:
+            self.assertEqual(f.read(), StandInServer.file)
+        # the retry carried on from where the dropped connection stopped
+        self.assertLessEqual(progress[0], 300000)
+        self.assertEqual(sorted(progress), progress)
+
+        # a partial file left behind by an earlier call is completed too
+        with open('/tmp/_upstream_download', 'r+b') as f:
+            f.truncate(500000)
+        progress.clear()
+        self.client.download('/file', b'{}', '/tmp/_upstream_download', lambda done, total: progress.append(done))
+        self.assertGreater(progress[0], 500000)
+        with open('/tmp/_upstream_download', 'rb') as f:
+            self.assertEqual(f.read(), StandInServer.file)
+
+    def test_circuit_breaker(self):
+        client = UpstreamClient('http://127.0.0.1:1', retries=0)
+        for i in range(failure_threshold):
+            with self.assertRaises(ConnectionRefusedError):
+                client.post_json('/build_progress', {})
+        started = time.time()
+        with self.assertRaises(UpstreamUnavailable):
+            client.post_json('/build_progress', {})
+        self.assertLess(time.time() - started, 0.1)
+
+        # after the cool down one call is let through again
+        client.open_until = 0
+        with self.assertRaises(ConnectionRefusedError):
+            client.post_json('/build_progress', {})
+
+    def test_stats(self):
+        import metrics
+        stats = metrics.CallStats()
+        client = UpstreamClient(self.url, retries=0, stats=stats)
+        client.post_json('/build_progress', {})
+        StandInServer.failures = 1
+        with self.assertRaises(UpstreamError):
+            client.post_json('/build_progress', {})
+        client.close()
+        report = stats.report()['/build_progress']
+        self.assertEqual((report['count'], report['errors']), (2, 1))
+        self.assertGreater(report['latency']['max'], 0)
+
+    def test_trial_ends_on_any_error(self):
+        client = UpstreamClient(self.url, retries=0)
+        client.failures = failure_threshold
+        StandInServer.file = b'x' * 10
+        try:
+            os.remove('/tmp/_upstream_trial')
+        except FileNotFoundError:
+            pass
+        with self.assertRaises(TypeError):
+            client.download('/file', b'{}', '/tmp/_upstream_trial', progress=lambda done: None)
+        self.assertFalse(client.trial)
+        client.close()
+
+    def test_no_resend(self):
+        self.client.post_json('/build_progress', {})
+        self.assertEqual(len(self.client.idle), 1)
+        # a call that must not be repeated leaves the idle connection alone
+        self.client.post_json('/compile', {})
+        self.assertEqual(len(StandInServer.connections), 2)
+
+    def test_benchmark_latency(self):
+        from urllib.request import Request, urlopen
+
+        def median(samples):
+            return sorted(samples)[len(samples) // 2]
+
+        fresh = []
+        for i in range(50):
+            started = time.time()
+            urlopen(Request(self.url + '/build_progress', b'{}'), timeout=8).read()
+            fresh.append(time.time() - started)
+
+        pooled = []
+        for i in range(50):
+            started = time.time()
+            self.client.post_json('/build_progress', {}, idempotent=True)
+            pooled.append(time.time() - started)
+
+        print("\nper call latency: urlopen %.2f ms, pooled keep-alive %.2f ms (median of 50)"
+              % (median(fresh) * 1000, median(pooled) * 1000))
+        self.assertLess(median(pooled), median(fresh))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,40 +1,388 @@
+import io
 import os
 import time
+import uuid
+import struct
+import select
+import ctypes
+from collections import OrderedDict
+from threading import Thread, Lock, Condition
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 
-last_served = 0
+video_dir = '/home/xilinx/projects'
 
+# MJPEG streams: frame rate when the client does not ask for one, the most it may ask for,
+# and how many streams may be open at once (each holds a server thread)
+default_stream_fps = 15
+max_stream_fps = 30
+max_streams = 4
+stale_timeout = 15  # seconds without a new frame before the video counts as inactive
 
-def get_last_frame(data):
-    global last_served
+# how often the frame files are checked when inotify is not available (seconds)
+poll_interval = 0.02
 
-    # does it exist at all?
-    if not os.path.exists("/home/xilinx/projects/videoSELECT.txt"):
-        return {"video-error": "No active video"}
+# re-encoded variants of the frame: the narrowest allowed, how many are kept, how many of the most
+# recently asked for are re-encoded for each new frame, and for how long after they were last
+# asked for (seconds)
+min_variant_width = 32
+default_variant_quality = 75
+variant_cache_size = 16
+max_active_variants = 4
+variant_idle_timeout = 10
+variant_wait = 5  # longest a request waits for the first encode of a variant
 
-    with open("/home/xilinx/projects/videoSELECT.txt") as f:
-        sel = f.read()
-        if len(sel) != 1:
-            sel = "A"
+streams = 0
+streams_lock = Lock()
 
-    if not os.path.exists(f"/home/xilinx/projects/video{sel}.jpg"):
-        return {"video-error": "No active video"}
+variants = None
+
+# the last frame given to a client that does not send seq, as before seq existed
+last_served = None
+last_served_lock = Lock()
+
+watcher = None
+watcher_lock = Lock()
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_DELETE = 0x200
+IN_CLOEXEC = 0o2000000
+inotify_event = struct.Struct('iIII')
+
+
+def _inotify_watch(directory):
+    """An inotify fd watching a directory for completed writes, or None if inotify cannot be used"""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class FrameWatcher:
+    """Keeps the latest complete frame of the ping-pong buffer in memory
+
+    The files are only looked at when inotify reports that one of them has
+    changed (or, without inotify, every poll_interval), so serving a frame
+    needs no disk access. Every new frame gets the next sequence number.
+    """
+
+    names = ['videoSELECT.txt', 'videoA.jpg', 'videoB.jpg']
+
+    def __init__(self, directory=video_dir, use_inotify=True):
+        self.directory = directory
+        self.instance = uuid.uuid4().hex[:8]  # keeps ETags from an earlier run from matching
+        self.seq = 0
+        self.jpeg = None
+        self.mtime = 0
+        self.key = None  # (selected file, mtime, size) of the frame held
+        self.condition = Condition()
+        self.listeners = []  # called with (seq, jpeg) for every new frame
+        self.stopped = False
+        self.fd = _inotify_watch(directory) if use_inotify else None
+        self._load()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.directory, 'videoSELECT.txt')) as f:
+                sel = f.read()
+                if len(sel) != 1:
+                    sel = "A"
+            path = os.path.join(self.directory, f"video{sel}.jpg")
+            stat = os.stat(path)
+        except OSError:
+            with self.condition:
+                self.key = self.jpeg = None
+            return
+
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        if key == self.key:
+            return
+        try:
+            with open(path, 'rb') as f:
+                jpeg = f.read()
+        except OSError:
+            return
+        with self.condition:
+            self.key = key
+            self.jpeg = jpeg
+            self.mtime = stat.st_mtime
+            self.seq += 1
+            seq = self.seq
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener(seq, jpeg)
+
+    def _run(self):
+        while not self.stopped:
+            if self.fd is None:
+                time.sleep(poll_interval)
+                self._load()
+                continue
+
+            if not select.select([self.fd], [], [], 1)[0]:
+                continue
+            events = os.read(self.fd, 4096)
+            changed = False
+            while events:
+                wd, mask, cookie, length = inotify_event.unpack_from(events)
+                name = events[inotify_event.size:inotify_event.size + length].rstrip(b'\0').decode()
+                changed = changed or name in self.names
+                events = events[inotify_event.size + length:]
+            if changed:
+                self._load()
+        if self.fd is not None:
+            os.close(self.fd)
+
+    def stop(self):
+        self.stopped = True
+
+    def latest(self):
+        """(sequence number, JPEG bytes) of the current frame, or None if the video is not active"""
+        with self.condition:
+            if self.jpeg is None or time.time() - self.mtime > stale_timeout:
+                return None
+            return self.seq, self.jpeg
+
+    def wait(self, seq, timeout):
+        """Wait until there is an active frame other than seq, then return it as latest() does"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.stopped or self.seq != seq and self.jpeg is not None and
+                                    time.time() - self.mtime <= stale_timeout, timeout)
+        return self.latest()
+
+    def etag(self, seq):
+        return '"%s-%d"' % (self.instance, seq)
+
+
+class VariantCache:
+    """Downscaled / re-encoded copies of the current frame, made on a background thread
+
+    A (width, quality) variant is encoded at most once per frame. Variants
+    that have been asked for recently are re-encoded as soon as a new frame
+    arrives, and until the new copy is ready requests get the previous one,
+    so encoding never holds up a request once a variant is under way.
+    """
+
+    def __init__(self, frames, cache_size=variant_cache_size):
+        self.frames = frames
+        self.cache_size = cache_size
+        self.variants = OrderedDict()  # (width, quality) -> (seq, jpeg), least recently used first
+        self.pending = {}  # (width, quality) -> (seq, future) of the encode in progress
+        self.requested = {}  # (width, quality) -> time last asked for
+        self.encodes = 0
+        self.lock = Lock()
+        self.encoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='video-encode')
+        frames.listeners.append(self._frame_changed)
 
-    # has video been updating in the past 15 seconds?
-    last_updated = os.path.getmtime(f"/home/xilinx/projects/video{sel}.jpg")
-    if time.time() - last_updated > 15:
+    def _encode(self, key, seq, jpeg):
+        from PIL import Image
+        width, quality = key
+        image = Image.open(io.BytesIO(jpeg))
+        if width < image.width:
+            image.draft('RGB', (width, width * image.height // image.width))  # lets the decoder skip detail
+            image = image.convert('RGB').resize((width, max(round(image.height * width / image.width), 1)),
+                                                Image.BILINEAR)
+        out = io.BytesIO()
+        image.convert('RGB').save(out, 'JPEG', quality=quality)
+        self.encodes += 1
+        return out.getvalue()
+
+    def _submit(self, key, seq, jpeg):
+        """Start encoding a frame for a variant, unless an encode of it is already running; call with lock held"""
+        if key in self.pending:
+            return self.pending[key][1]
+        future = self.encoder.submit(self._encoded, key, seq, jpeg)
+        self.pending[key] = (seq, future)
+        return future
+
+    def _encoded(self, key, seq, jpeg):
+        """Encode on the encoder thread and keep the result; never called with the lock held"""
+        try:
+            variant = self._encode(key, seq, jpeg)
+        except Exception as e:
+            print("Could not encode video variant:", type(e).__name__, e)
+            variant = None
+
+        with self.lock:
+            del self.pending[key]
+            if variant is not None and (key not in self.variants or self.variants[key][0] < seq):
+                self.variants[key] = (seq, variant)
+                self.variants.move_to_end(key)
+                while len(self.variants) > self.cache_size:
+                    self.variants.popitem(last=False)
+
+            # frames that arrived during the encode were skipped; catch up with the latest
+            latest = self.frames.latest()
+            if latest is not None and latest[0] > seq and self._active(key):
+                self._submit(key, *latest)
+
+    def _active(self, key):
+        return time.time() - self.requested.get(key, 0) < variant_idle_timeout
+
+    def _frame_changed(self, seq, jpeg):
+        with self.lock:
+            for key in list(self.requested):
+                if self._active(key):
+                    self._submit(key, seq, jpeg)
+                else:
+                    del self.requested[key]
+
+    def get(self, width, quality):
+        """(seq, jpeg) of the newest encoded copy of a variant, or None if there is none in time"""
+        frame = self.frames.latest()
+        if frame is None:
+            return None
+        key = (width, quality)
+        with self.lock:
+            # only the most recently asked for variants are kept up to date with new frames
+            self.requested.pop(key, None)
+            self.requested[key] = time.time()
+            while len(self.requested) > max_active_variants:
+                del self.requested[next(iter(self.requested))]
+            cached = self.variants.get(key)
+            if cached is not None:
+                self.variants.move_to_end(key)
+                if cached[0] != frame[0]:
+                    self._submit(key, *frame)
+                return cached
+            future = self._submit(key, *frame)
+
+        # the first request for a variant has to wait for it
+        try:
+            future.result(variant_wait)
+        except FutureTimeout:
+            return None
+        with self.lock:
+            return self.variants.get(key)
+
+
+def _watcher():
+    global watcher
+    with watcher_lock:
+        if watcher is None:
+            watcher = FrameWatcher()
+        return watcher
+
+
+def _variants():
+    global variants
+    frames = _watcher()
+    with watcher_lock:
+        if variants is None:
+            variants = VariantCache(frames)
+        return variants
+
+
+def get_last_frame(data):
+    """The current frame, unless the client's seq (or ETag) says it already has it
+
+    With a width and/or quality the frame is scaled down to that width and
+    re-encoded at that JPEG quality (1-95). A client that sends neither seq
+    nor a variant is answered USE_CACHED if the frame has not changed since
+    it was last given to such a client, as before seq existed.
+    """
+    global last_served
+
+    frames = _watcher()
+    if data.get('width') is not None or data.get('quality') is not None:
+        width = max(int(data.get('width') or 1 << 16), min_variant_width)
+        quality = min(max(int(data.get('quality') or default_variant_quality), 1), 95)
+        frame = _variants().get(width, quality)
+        variant = '-%d-%d' % (width, quality)
+    else:
+        frame = None
+    if frame is None:
+        # no variant asked for, or none ready in time: the frame as it is
+        frame = frames.latest()
+        variant = ''
+    if frame is None:
         return {"video-error": "No active video"}
+    seq, jpeg = frame
 
-    # has it been updated since the last time it was sent?
-    if last_served == last_updated and data['flushCache'] is not True:
-        return {"video-error": "USE_CACHED"}
+    if data.get('seq') is not None:
+        if int(data['seq']) == seq and data.get('flushCache') is not True:
+            return {"video-error": "USE_CACHED"}
+    elif not variant:
+        with last_served_lock:
+            if last_served == seq and data.get('flushCache') is not True:
+                return {"video-error": "USE_CACHED"}
+            last_served = seq
 
-    # serve it!
-    last_served = last_updated
     return {
-        "file": f"/home/xilinx/projects/video{sel}.jpg"
+        "content": jpeg,
+        "content-type": "image/jpeg",
+        "etag": frames.etag(seq)[:-1] + variant + '"',
+        "headers": {"X-Frame-Seq": str(seq)}
     }
 
 
+def _frames(fps):
+    """Each new frame's JPEG bytes, at most fps a second, until the video stops
+
+    Only the latest frame is ever sent, so a client that is slow to take them
+    simply skips the frames that arrived in the meantime.
+    """
+    frames = _watcher()
+    sent = None
+    next_time = 0
+    while True:
+        frame = frames.wait(sent, stale_timeout)
+        if frame is None:
+            return
+        if time.time() < next_time:
+            time.sleep(next_time - time.time())
+            frame = frames.latest() or frame
+        sent = frame[0]
+        next_time = time.time() + 1 / fps
+        yield frame[1]
+
+
+class FrameStream:
+    """Iterator over a stream's frames that gives up its stream slot when closed"""
+
+    def __init__(self, fps):
+        self.frames = _frames(fps)
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.frames)
+
+    def close(self):
+        global streams
+        if not self.closed:
+            self.closed = True
+            self.frames.close()
+            with streams_lock:
+                streams -= 1
+
+
+def stream_frames(data):
+    """Live MJPEG stream of the video, as a multipart/x-mixed-replace response"""
+    global streams
+    fps = min(float((data or {}).get('max_fps', default_stream_fps)), max_stream_fps)
+    if fps <= 0:
+        return {"video-error": "Invalid frame rate"}
+
+    with streams_lock:
+        if streams >= max_streams:
+            return {"video-error": "Too many streams"}
+        streams += 1
+    return {"stream": FrameStream(fps), "content-type": "image/jpeg"}
+
+
 # *****************************************
 # Unit tests
 # *****************************************
@@ -44,11 +392,16 @@ import unittest
 
 class TestVideo(unittest.TestCase):
 
+    def setUp(self):
+        global last_served
+        last_served = None
+
     def test_no_select_file(self):
         try:
             os.remove("/home/xilinx/projects/videoSELECT.jpg")
         except:
             pass
+        time.sleep(0.1)  # the frame watcher catches up
         result = get_last_frame({"flushCache": False})
         self.assertEqual(result, {"video-error": "No active video"})
 
@@ -61,6 +414,7 @@ class TestVideo(unittest.TestCase):
         # set ping pong selector
         with open("/home/xilinx/projects/videoSELECT.txt", 'w') as f:
             f.write("A")
+        time.sleep(0.1)
         # run
         result = get_last_frame({"flushCache": False})
         self.assertEqual(result, {"video-error": "No active video"})
@@ -72,9 +426,70 @@ class TestVideo(unittest.TestCase):
         # set ping pong selector
         with open("/home/xilinx/projects/videoSELECT.txt", 'w') as f:
             f.write("A")
+        time.sleep(0.1)
         # run
         result = get_last_frame({"flushCache": False})
-        self.assertEqual(result, {"file": "/home/xilinx/projects/videoA.jpg"})
+        with open("/home/xilinx/projects/videoA.jpg", 'rb') as f:
+            self.assertEqual(result["content"], f.read())
+        self.assertEqual(result["content-type"], "image/jpeg")
+
+    def test_per_client_freshness(self):
+        from PIL import Image
+        Image.new('RGB', (1280, 720)).save("/home/xilinx/projects/videoA.jpg")
+        with open("/home/xilinx/projects/videoSELECT.txt", 'w') as f:
+            f.write("A")
+        time.sleep(0.1)
+
+        # two viewers each get the frame once, whatever order they poll in
+        first = get_last_frame({"flushCache": False, "seq": 0})
+        seq = int(first["headers"]["X-Frame-Seq"])
+        second = get_last_frame({"flushCache": False, "seq": 0})
+        self.assertEqual(second["etag"], first["etag"])
+        self.assertEqual(get_last_frame({"flushCache": False, "seq": seq}), {"video-error": "USE_CACHED"})
+        self.assertEqual(get_last_frame({"flushCache": False, "seq": seq}), {"video-error": "USE_CACHED"})
+        self.assertIn("content", get_last_frame({"flushCache": True, "seq": seq}))
+
+        Image.new('RGB', (1280, 720), (255, 255, 255)).save("/home/xilinx/projects/videoB.jpg")
+        with open("/home/xilinx/projects/videoSELECT.txt", 'w') as f:
+            f.write("B")
+        time.sleep(0.1)
+        self.assertGreater(int(get_last_frame({"flushCache": False, "seq": seq})["headers"]["X-Frame-Seq"]), seq)
+
+    def test_without_seq(self):
+        from PIL import Image
+        Image.new('RGB', (1280, 720), (0, 0, 1)).save("/home/xilinx/projects/videoA.jpg")
+        with open("/home/xilinx/projects/videoSELECT.txt", 'w') as f:
+            f.write("A")
+        time.sleep(0.1)
+
+        # clients that predate seq get each frame once, and again when they flush their cache
+        self.assertIn("content", get_last_frame({"flushCache": False}))
+        self.assertEqual(get_last_frame({"flushCache": False}), {"video-error": "USE_CACHED"})
+        self.assertIn("content", get_last_frame({"flushCache": True}))
+
+        Image.new('RGB', (1280, 720), (0, 0, 2)).save("/home/xilinx/projects/videoB.jpg")
+        with open("/home/xilinx/projects/videoSELECT.txt", 'w') as f:
+            f.write("B")
+        time.sleep(0.1)
+        self.assertIn("content", get_last_frame({"flushCache": False}))
+
+    def test_watcher_without_inotify(self):
+        import shutil
+        from PIL import Image
+        directory = '/tmp/_video_watcher_test'
+        shutil.rmtree(directory, True)
+        os.makedirs(directory)
+        frames = FrameWatcher(directory, use_inotify=False)
+        try:
+            self.assertIsNone(frames.latest())
+            Image.new('RGB', (64, 48)).save(os.path.join(directory, "videoA.jpg"))
+            with open(os.path.join(directory, "videoSELECT.txt"), 'w') as f:
+                f.write("A")
+            seq, jpeg = frames.wait(0, 5)
+            with open(os.path.join(directory, "videoA.jpg"), 'rb') as f:
+                self.assertEqual(jpeg, f.read())
+        finally:
+            frames.stop()
 
     def test_stale_video(self):
         # create image
@@ -90,5 +505,154 @@ class TestVideo(unittest.TestCase):
         self.assertEqual(result, {"video-error": "No active video"})
 
 
+class TestVideoVariants(unittest.TestCase):
+
+    def _write_frame(self, sel, color):
+        from PIL import Image
+        Image.new('RGB', (1280, 720), color).save(f"/home/xilinx/projects/video{sel}.jpg")
+        with open("/home/xilinx/projects/videoSELECT.txt", 'w') as f:
+            f.write(sel)
+        time.sleep(0.1)
+
+    def test_downscaled(self):
+        from PIL import Image
+        self._write_frame("A", (200, 100, 0))
+        cache = _variants()
+        encodes = cache.encodes
+
+        result = get_last_frame({"flushCache": False, "width": 320, "quality": 50})
+        image = Image.open(io.BytesIO(result["content"]))
+        self.assertEqual(image.size, (320, 180))
+        full = get_last_frame({"flushCache": False})
+        self.assertLess(len(result["content"]), len(full["content"]))
+        self.assertNotEqual(result["etag"], full["etag"])
+
+        # encoded once per frame, however many viewers ask
+        for i in range(5):
+            self.assertEqual(get_last_frame({"flushCache": False, "width": 320, "quality": 50})["content"],
+                             result["content"])
+        self.assertEqual(cache.encodes, encodes + 1)
+
+        # a new frame is encoded in the background for variants in use
+        seq = int(result["headers"]["X-Frame-Seq"])
+        self._write_frame("B", (0, 0, 255))
+        cache.encoder.submit(lambda: None).result(5)  # queued behind the encodes
+        newer = get_last_frame({"flushCache": False, "width": 320, "quality": 50, "seq": seq})
+        self.assertEqual(int(newer["headers"]["X-Frame-Seq"]), _watcher().latest()[0])
+        self.assertGreater(cache.encodes, encodes + 1)
+
+    def test_encoded_off_request_thread(self):
+        import threading
+        self._write_frame("A", (0, 255, 0))
+        threads = []
+        encode = VariantCache._encode
+        VariantCache._encode = lambda *args: threads.append(threading.current_thread().name) or encode(*args)
+        try:
+            get_last_frame({"flushCache": False, "width": 200})
+        finally:
+            VariantCache._encode = encode
+        self.assertTrue(threads)
+        self.assertTrue(all(name.startswith('video-encode') for name in threads))
+
+    def test_active_variants_capped(self):
+        self._write_frame("A", (1, 2, 3))
+        cache = _variants()
+        for width in range(100, 100 + 2 * max_active_variants):
+            get_last_frame({"flushCache": False, "width": width})
+        self.assertEqual(len(cache.requested), max_active_variants)
+
+        encodes = cache.encodes
+        self._write_frame("B", (4, 5, 6))
+        cache.encoder.submit(lambda: None).result(5)
+        self.assertEqual(cache.encodes, encodes + max_active_variants)
+
+    def test_encode_timeout(self):
+        global variant_wait
+        self._write_frame("A", (7, 8, 9))
+        encode = VariantCache._encode
+        VariantCache._encode = lambda *args: time.sleep(0.5) or encode(*args)
+        variant_wait = 0.05
+        try:
+            result = get_last_frame({"flushCache": False, "width": 99})
+        finally:
+            VariantCache._encode = encode
+            variant_wait = 5
+        # the full frame rather than an error
+        self.assertEqual(result["etag"], _watcher().etag(int(result["headers"]["X-Frame-Seq"])))
+        _variants().encoder.submit(lambda: None).result(5)
+
+    def test_benchmark_variant_serving(self):
+        self._write_frame("A", (10, 20, 30))
+        data = {"flushCache": False, "width": 160, "quality": 60}
+        started = time.time()
+        get_last_frame(data)
+        first = time.time() - started
+
+        started = time.time()
+        for i in range(100):
+            get_last_frame(data)
+        cached = (time.time() - started) / 100
+        print("\n160 px wide variant of a 1280x720 frame: first request %.1f ms (encode), then %.3f ms"
+              % (first * 1000, cached * 1000))
+        self.assertLess(cached, first)
+
+
+class TestVideoStream(unittest.TestCase):
+
+    def _write_frame(self, sel, color):
+        from PIL import Image
+        other = "B" if sel == "A" else "A"
+        Image.new('RGB', (320, 240), color).save(f"/home/xilinx/projects/video{sel}.jpg")
+        with open("/home/xilinx/projects/videoSELECT.txt", 'w') as f:
+            f.write(sel)
+        return other
+
+    def test_stream(self):
+        sel = self._write_frame("A", (255, 0, 0))
+        response = stream_frames({"max_fps": 100})
+        frames = response["stream"]
+        self.assertEqual(streams, 1)
+
+        first = next(frames)
+        self.assertTrue(first.startswith(b'\xff\xd8'))
+        self._write_frame(sel, (0, 255, 0))
+        second = next(frames)
+        self.assertNotEqual(first, second)
+
+        frames.close()
+        self.assertEqual(streams, 0)
+
+    def test_frame_rate(self):
+        from threading import Thread, Event
+        stop = Event()
+
+        def writer():
+            sel, i = "A", 0
+            while not stop.is_set():
+                sel = self._write_frame(sel, (i % 256, 0, 0))
+                i += 1
+                time.sleep(0.005)
+
+        Thread(target=writer, daemon=True).start()
+        try:
+            frames = stream_frames({"max_fps": 10})["stream"]
+            started = time.time()
+            for i in range(6):
+                next(frames)
+            # the first frame goes out straight away, then one every 0.1 s
+            self.assertGreater(time.time() - started, 0.45)
+            frames.close()
+        finally:
+            stop.set()
+
+    def test_stream_limit(self):
+        self._write_frame("A", (0, 0, 0))
+        open_streams = [stream_frames({})["stream"] for i in range(max_streams)]
+        self.assertEqual(stream_frames({}), {"video-error": "Too many streams"})
+        for frames in open_streams:
+            frames.close()
+        self.assertEqual(streams, 0)
+
+
 if __name__ == '__main__':
     unittest.main()